@@ -0,0 +1,94 @@
+import time
+
+
+##############################################################################
+class CommitPolicy:
+    """
+    Decides when process_data commits. Files are grouped into one
+    transaction until a file count, row, byte or time limit is reached.
+    The file count limit adapts to the observed commit latency: it doubles
+    while commits take more than target_overhead of the batch time, which
+    is what happens with many tiny song files, halves again while they take
+    less than a quarter of it, as once the files get larger, and drops back
+    to the number of files that fit when a row, byte or time limit cuts a
+    batch short.
+    A file is the smallest unit committed, a single file above the limits
+    is loaded in one transaction.
+    """
+
+    def __init__(self, max_rows=50000, max_bytes=64 * 2 ** 20,
+                 max_seconds=5.0, target_overhead=0.1, max_files=1000):
+        """
+        :param max_rows: commit once this many rows were loaded
+        :param max_bytes: commit once this many input bytes were read
+        :param max_seconds: commit once the batch ran this long
+        :param target_overhead: share of the batch time commits may take
+        :param max_files: upper bound of the adaptive file count limit
+        """
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.target_overhead = target_overhead
+        self.max_files = max_files
+        self.batch_files = 1
+        self.reset()
+
+    def reset(self):
+        """
+        Starts a new batch
+        :return:
+        """
+        self.files = []
+        self.rows = 0
+        self.bytes = 0
+        self.started = time.perf_counter()
+
+    def add(self, file_path, rows, num_bytes):
+        """
+        Records a processed file in the current batch
+        :param file_path: path of the file
+        :param rows: number of rows loaded from it
+        :param num_bytes: size of the file
+        :return:
+        """
+        self.files.append((file_path, rows or 0))
+        self.rows += rows or 0
+        self.bytes += num_bytes
+
+    def limit_reached(self):
+        """
+        :return: name of the row, byte or time limit the batch reached, or
+        None
+        """
+        if self.rows >= self.max_rows:
+            return 'rows'
+        if self.bytes >= self.max_bytes:
+            return 'bytes'
+        if time.perf_counter() - self.started >= self.max_seconds:
+            return 'seconds'
+        return None
+
+    def should_commit(self):
+        """
+        :return: True when the current batch should be committed
+        """
+        return len(self.files) >= self.batch_files or \
+            self.limit_reached() is not None
+
+    def committed(self, commit_seconds):
+        """
+        Adjusts the file count limit after a commit and starts a new batch
+        :param commit_seconds: time the commit took
+        :return:
+        """
+        work_seconds = time.perf_counter() - self.started - commit_seconds
+        overhead = commit_seconds / max(work_seconds + commit_seconds, 1e-9)
+        if self.limit_reached() is not None:
+            self.batch_files = max(1, len(self.files))
+        elif overhead > self.target_overhead:
+            self.batch_files = min(self.max_files, self.batch_files * 2)
+        elif overhead < self.target_overhead / 4:
+            # fewer files per batch cost little here and lose less work when
+            # a transaction is rolled back
+            self.batch_files = max(1, self.batch_files // 2)
+        self.reset()
@@ -0,0 +1,103 @@
+import os
+import bz2
+import gzip
+import time
+import argparse
+import tempfile
+import statistics
+import pandas as pd
+from inputs import find_data_files, open_data_file
+
+
+##############################################################################
+def write_inputs(log_data, directory, copies):
+    """
+    Writes the log events as one plain and one file per compression format
+    :param log_data: directory with log json files
+    :param directory: directory to write the files to
+    :param copies: number of times the events are repeated
+    :return: dict of format name to file path, and uncompressed size
+    """
+    lines = []
+    for file_path in sorted(find_data_files(log_data)):
+        with open_data_file(file_path) as f:
+            lines.extend(line for line in f if line.strip())
+    text = ''.join(
+        line if line.endswith('\n') else line + '\n' for line in lines
+    ) * copies
+    raw = text.encode('utf8')
+
+    paths = {'json': os.path.join(directory, 'events.json')}
+    with open(paths['json'], 'wb') as f:
+        f.write(raw)
+    paths['gz'] = paths['json'] + '.gz'
+    with gzip.open(paths['gz'], 'wb') as f:
+        f.write(raw)
+    paths['bz2'] = paths['json'] + '.bz2'
+    with bz2.open(paths['bz2'], 'wb') as f:
+        f.write(raw)
+    try:
+        import zstandard
+        paths['zst'] = paths['json'] + '.zst'
+        with open(paths['zst'], 'wb') as f:
+            f.write(zstandard.ZstdCompressor().compress(raw))
+    except ImportError:
+        print("zstandard not installed, skipping .zst")
+    return paths, len(raw)
+
+
+def time_read(file_path, parse, repeat):
+    """
+    Median time to read a file, optionally parsing it with pandas
+    :param file_path: file to read
+    :param parse: parse the events with pd.read_json as etl.py does
+    :param repeat: number of reads
+    :return: seconds
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with open_data_file(file_path) as f:
+            if parse:
+                pd.read_json(f, lines=True)
+            else:
+                while f.read(1 << 20):
+                    pass
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compares reading plain and compressed log files."
+    )
+    parser.add_argument("--log-data", default="data/log_data",
+                        help="Directory with log json files.")
+    parser.add_argument("--copies", type=int, default=20,
+                        help="Number of times the events are repeated.")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of reads per format.")
+    args = parser.parse_args()
+    if not find_data_files(args.log_data):
+        parser.error(f"no log files found in {args.log_data}, pass "
+                     f"--log-data (e.g. ../data/log_data when run from src)")
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths, raw_size = write_inputs(args.log_data, directory, args.copies)
+        print(f"{raw_size / 2 ** 20:.1f} MB of events\n")
+        print(f"{'format':<8} {'size MB':>8} {'ratio':>6} {'read MB/s':>10}"
+              f" {'read+parse MB/s':>16} {'vs plain':>9}")
+        plain = None
+        for name, file_path in paths.items():
+            size = os.path.getsize(file_path)
+            read = time_read(file_path, False, args.repeat)
+            parse = time_read(file_path, True, args.repeat)
+            plain = plain or parse
+            print(f"{name:<8} {size / 2 ** 20:>8.2f} {raw_size / size:>6.1f}"
+                  f" {raw_size / 2 ** 20 / read:>10.1f}"
+                  f" {raw_size / 2 ** 20 / parse:>16.1f}"
+                  f" {plain / parse:>8.2f}x")
+
+
+if __name__ == '__main__':
+    main()
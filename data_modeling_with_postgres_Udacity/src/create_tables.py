@@ -1,12 +1,14 @@
 import psycopg2
 from sql_queries import create_table_queries
 from sql_queries import drop_table_queries
+from sql_queries import load_version_insert
 
 
 ##############################################################################
-def create_database():
+def create_database(cursor_factory=None):
     """
     Creates and connects to sparkifydb
+    :param cursor_factory: cursor class for the sparkifydb connection
     :return: cursor and connection to sparkifydb
     """
     # connect to default database
@@ -27,7 +29,8 @@ def create_database():
 
     # conenct to sparkify database
     conn = psycopg2.connect(
-        "host=127.0.0.1 dbname=sparkifydb user=student password=student"
+        "host=127.0.0.1 dbname=sparkifydb user=student password=student",
+        cursor_factory=cursor_factory
     )
     cur = conn.cursor()
 
@@ -48,7 +51,7 @@ def drop_tables(cur, conn):
 
 def create_tables(cur, conn):
     """
-    Executes all queries to create tables
+    Executes all queries to create tables and seeds the load version
     :param cur: cursor to the database
     :param conn: connection to the database
     :return:
@@ -57,14 +60,18 @@ def create_tables(cur, conn):
         cur.execute(query)
         conn.commit()
 
+    cur.execute(load_version_insert)
+    conn.commit()
 
-def main():
+
+def main(cursor_factory=None):
     """
     Executes all functions: defines cursor and connections, drops existing
     tables, and creates new tables
+    :param cursor_factory: cursor class, main.py --profile times statements
     :return:
     """
-    cur, conn = create_database()
+    cur, conn = create_database(cursor_factory)
 
     drop_tables(cur, conn)
     create_tables(cur, conn)
@@ -1,13 +1,29 @@
 import os
-import glob
+import argparse
+import time
+import functools
 import psycopg2
 import pandas as pd
+from psycopg2.extras import execute_batch, execute_values
 from sql_queries import song_table_insert
 from sql_queries import artist_table_insert
 from sql_queries import user_table_insert
 from sql_queries import time_table_insert
+from sql_queries import time_hour_table_insert
 from sql_queries import songplay_table_insert
 from sql_queries import song_select
+from sql_queries import load_version_bump
+from sql_queries import load_file_insert
+from sql_queries import loaded_files_select
+from sessions import SessionAggregator
+from sketches import SketchAggregator
+from inputs import find_data_files, open_data_file
+from parallel_log import parse_log_file_parallel
+from commit_policy import CommitPolicy
+
+MS_PER_HOUR = 3600000
+# plain log files of at least this size are parsed by a process pool
+PARALLEL_MIN_BYTES = 256 * 2 ** 20
 
 
 ##############################################################################
@@ -17,13 +33,14 @@ def process_song_file(cur, file_path):
     artist_table
     :param cur: cursor to database
     :param file_path: path to song files 
-    :return:
+    :return: number of songs read
     """
 
     # open song file 
-    df = pd.DataFrame(
-        [pd.read_json(file_path, typ='series', convert_dates=False)]
-    )
+    with open_data_file(file_path) as f:
+        df = pd.DataFrame(
+            [pd.read_json(f, typ='series', convert_dates=False)]
+        )
 
     for val in df.values:
         num_songs, artist_id, artist_lat, artist_long, \
@@ -43,118 +60,363 @@ def process_song_file(cur, file_path):
         cur.execute(song_table_insert, song_data)
 
     print(f"Successfully inserted record for file: {file_path}")
+    return len(df)
 
 
-def process_log_file(cur, file_path):
+def process_log_file(cur, file_path, sessions=None, sketches=None):
     """
     Processes log files and insert into user_table, time_table, and
     songplay_table
     :param cur: cursor to database
     :param file_path: path to database
-    :return:
+    :param sessions: SessionAggregator folding the events into sessions
+    :param sketches: SketchAggregator folding the songplays into sketches
+    :return: number of events read
     """
 
+    # large plain files are split and parsed in parallel
+    if file_path.endswith('.json') and \
+            os.path.getsize(file_path) >= PARALLEL_MIN_BYTES:
+        return process_large_log_file(cur, file_path, sessions, sketches)
+
     # open log file 
-    df = pd.read_json(file_path, lines=True)
+    with open_data_file(file_path) as f:
+        df = pd.read_json(f, lines=True)
 
-    # filter by NextSong action and convert timestamp column to datetime
-    df = df[df['page'] == "NextSong"].astype({'ts': 'datetime64[ms]'})
-    t = pd.Series(df['ts'], index=df.index)
+    process_log_events(cur, df, sessions, sketches)
+    return len(df)
 
-    # insert time data records
-    time_data = []
-    column_labels = [
-        "timestamp", "hour", "day", "weekofyear", "month", "year", "weekday"
-    ]
-    for val in t:
-        time_data.append([
-            val,
-            val.hour,
-            val.day,
-            val.weekofyear,
-            val.month,
-            val.year,
-            val.day_name()
-        ])
 
-    time_df = pd.DataFrame.from_records(data=time_data, columns=column_labels)
+def process_log_events(cur, df, sessions=None, sketches=None):
+    """
+    Runs raw log events of a file or of a streaming micro-batch through the
+    sessions summary, the time, user and songplay inserts and the sketches
+    :param cur: cursor to database
+    :param df: log events, all pages included
+    :param sessions: SessionAggregator folding the events into sessions
+    :param sketches: SketchAggregator folding the songplays into sketches
+    :return:
+    """
+    # update the sessions summary from all events, before the page filter
+    if sessions is not None:
+        sessions.update(df)
+        sessions.flush(cur)
+
+    load_log_events(cur, df[df['page'] == "NextSong"], sketches)
+    if sketches is not None:
+        sketches.flush(cur)
 
-    for i, row in time_df.iterrows():
-        cur.execute(time_table_insert, list(row))
 
-    # load user table
-    user_df = df[
+def process_large_log_file(cur, file_path, sessions=None, sketches=None,
+                           workers=None):
+    """
+    Processes a large log file whose byte ranges are parsed and filtered by
+    a process pool. The ranges come back in file order and go through the
+    same stages as in process_log_file.
+    :param cur: cursor to database
+    :param file_path: path to a plain json log file
+    :param sessions: SessionAggregator folding the events into sessions
+    :param sketches: SketchAggregator folding the songplays into sketches
+    :param workers: number of worker processes, defaults to the cpu count
+    :return: number of events read, all pages included as in
+    process_log_file
+    """
+    num_events = 0
+    for df, grouped, parsed in parse_log_file_parallel(file_path, workers):
+        if sessions is not None and grouped is not None:
+            sessions.merge(grouped)
+        if not df.empty:
+            load_log_events(cur, df, sketches)
+        num_events += parsed
+    if sessions is not None:
+        sessions.flush(cur)
+    if sketches is not None:
+        sketches.flush(cur)
+    return num_events
+
+
+def frame_rows(frame):
+    """
+    Turns a DataFrame into the rows an execute_batch/execute_values writer
+    takes, without a Python loop over its rows
+    :param frame: DataFrame in the column order of the insert
+    :return: list of lists of Python values, missing values as None
+    """
+    values = frame.astype(object)
+    return values.where(frame.notna(), None).to_numpy().tolist()
+
+
+def time_rows(start_time):
+    """
+    :param start_time: Series of play times (datetime64)
+    :return: DataFrame in the column order of time_table_insert, one row per
+    distinct play time
+    """
+    t = start_time.drop_duplicates()
+    return pd.DataFrame({
+        'start_time': t,
+        'hour': t.dt.hour,
+        'day': t.dt.day,
+        'week': t.dt.isocalendar().week.astype(int),
+        'month': t.dt.month,
+        'year': t.dt.year,
+        'weekday': t.dt.day_name()
+    })
+
+
+def time_hour_rows(time_key):
+    """
+    :param time_key: Series of hours since the epoch
+    :return: DataFrame in the column order of time_hour_table_insert, one row
+    per distinct hour
+    """
+    keys = pd.Series(time_key.unique())
+    hour_start = pd.to_datetime(keys * MS_PER_HOUR, unit='ms')
+    return pd.DataFrame({
+        'time_key': keys,
+        'hour_start': hour_start,
+        'hour': hour_start.dt.hour,
+        'day': hour_start.dt.day,
+        'week': hour_start.dt.isocalendar().week.astype(int),
+        'month': hour_start.dt.month,
+        'year': hour_start.dt.year,
+        'weekday': hour_start.dt.day_name()
+    })
+
+
+def user_rows(df):
+    """
+    :param df: log events filtered on page NextSong
+    :return: DataFrame in the column order of user_table_insert, one row per
+    user with the level of its latest event, as the upserts in event order
+    would leave it
+    """
+    return df[
         ['userId', 'firstName', 'lastName', 'gender', 'level']
+    ].drop_duplicates('userId', keep='last')
+
+
+def match_songs(df, matches):
+    """
+    Attaches the song_id and artist_id of every played song
+    :param df: log events filtered on page NextSong
+    :param matches: DataFrame with song, artist, length, song_id and
+    artist_id columns, as returned by song_select
+    :return: DataFrame with song_id and artist_id columns on the index of df,
+    None where no song matched
+    """
+    keys = ['song', 'artist', 'length']
+    # the first match of a song wins, as with one lookup per event
+    matches = matches.drop_duplicates(keys)
+    ids = df[keys].merge(matches, how='left', on=keys)[
+        ['song_id', 'artist_id']
     ]
+    ids.index = df.index
+    return ids.astype(object).where(ids.notna(), None)
 
-    # insert user records
-    for i, row in user_df.iterrows():
-        cur.execute(user_table_insert, row)
 
-    # insert songplay records
-    for index, row in df.iterrows():
+def resolve_songs(cur, df):
+    """
+    Looks up the song_id and artist_id of all played songs in one query
+    :param cur: cursor to database
+    :param df: log events filtered on page NextSong
+    :return: output of match_songs
+    """
+    columns = ['song', 'artist', 'length', 'song_id', 'artist_id']
+    played = df[['song', 'artist', 'length']].dropna().drop_duplicates()
+    rows = []
+    if not played.empty:
+        cur.execute(song_select, (played['song'].tolist(),
+                                  played['artist'].tolist(),
+                                  played['length'].astype(float).tolist()))
+        rows = cur.fetchall()
+    return match_songs(df, pd.DataFrame(rows, columns=columns))
+
+
+def songplay_rows(df, songs):
+    """
+    Assembles songplays with column operations
+    :param df: log events filtered on page NextSong, ts as datetime and
+    with a time_key column
+    :param songs: output of match_songs
+    :return: DataFrame in the column order of songplay_table_insert
+    """
+    return pd.DataFrame({
+        'start_time': df['ts'],
+        'time_key': df['time_key'],
+        'user_id': df['userId'],
+        'level': df['level'],
+        'song_id': songs['song_id'],
+        'artist_id': songs['artist_id'],
+        'session_id': df['sessionId'],
+        'item_in_session': df['itemInSession'],
+        'location': df['location'],
+        'user_agent': df['userAgent']
+    })
+
+
+def load_log_events(cur, df, sketches=None):
+    """
+    Inserts NextSong events into time_table, time_hour_table, user_table and
+    songplay_table. Every table gets its rows as one batch.
+    :param cur: cursor to database
+    :param df: log events filtered on page NextSong
+    :param sketches: SketchAggregator the songplays are folded into, flushed
+    by the caller
+    :return:
+    """
+    if df.empty:
+        return
+
+    # hours since the epoch, the key of the compact time dimension
+    df = df.assign(time_key=df['ts'] // MS_PER_HOUR)
+
+    # convert timestamp column to datetime
+    df = df.astype({'ts': 'datetime64[ms]'})
 
-        # get songid and artistid from song and artist tables
-        cur.execute(song_select, (row.song, row.artist, row.length))
-        results = cur.fetchone()
+    # insert time data records
+    execute_batch(cur, time_table_insert, frame_rows(time_rows(df['ts'])),
+                  page_size=500)
+
+    # insert one time_hours record per hour
+    execute_batch(cur, time_hour_table_insert,
+                  frame_rows(time_hour_rows(df['time_key'])))
+
+    # insert user records
+    execute_batch(cur, user_table_insert, frame_rows(user_rows(df)))
 
-        if results:
-            songid, artistid = results
-        else:
-            songid, artistid = None, None
+    # insert songplay records, plays already loaded are skipped
+    songplays = songplay_rows(df, resolve_songs(cur, df))
+    inserted = len(execute_values(cur, songplay_table_insert,
+                                  frame_rows(songplays), page_size=1000,
+                                  fetch=True))
 
-        # insert songplay record
-        songplay_data = (row.ts, row.userId, row.level, songid, artistid,
-                         row.sessionId, row.location, row.userAgent)
-        cur.execute(songplay_table_insert, songplay_data)
+    if sketches is not None:
+        sketches.update(songplays)
 
+    if inserted < len(df):
+        print(f"{len(df) - inserted} of {len(df)} songplays already loaded, "
+              f"skipped")
 
-def process_data(cur, conn, filepath, func):
+
+def process_data(cur, conn, filepath, func, policy=None, reload_func=None):
     """
     This function loads data from files and executes functions to process song
-    and log files
+    and log files. Files are committed in batches chosen by a CommitPolicy,
+    every transaction records the files it loaded in load_files, so files
+    of a failed transaction are simply loaded again on the next run.
     :param cur: cursor to database
     :param conn: connection to database
     :param filepath: path to files
-    :param func: functions to process files
+    :param func: functions to process files, returning the rows read
+    :param policy: CommitPolicy, defaults to CommitPolicy()
+    :param reload_func: when given, files committed by an earlier run are
+    processed again with it instead of being skipped
     :return:
     """
-
-    # get all files matching extension from directory
-    all_files = []
-    for root, dirs, files in os.walk(filepath):
-        files = glob.glob(os.path.join(root, "*.json"))
-        for f in files:
-            all_files.append(os.path.abspath(f))
+    policy = policy or CommitPolicy()
+
+    # get all plain and compressed json files from directory, skipping the
+    # ones committed by an earlier run
+    all_files = find_data_files(filepath)
+    cur.execute(loaded_files_select)
+    loaded = {row[0] for row in cur.fetchall()}
+    conn.commit()
+    if reload_func is None:
+        pending = [(f, func) for f in all_files if f not in loaded]
+    else:
+        pending = [(f, reload_func if f in loaded else func)
+                   for f in all_files]
 
     # get total number of files found
-    num_files = len(all_files)
-    print(f"{num_files} files found in {filepath}")
-
-    # iterate over files and process
-    for i, datafile in enumerate(all_files, 1):
-        func(cur, datafile)
+    num_files = len(pending)
+    print(f"{len(all_files)} files found in {filepath}, "
+          f"{len(loaded.intersection(all_files))} already loaded")
+
+    def commit():
+        # every commit bumps the load version so cached query results are
+        # invalidated, the new version tags the files of the transaction
+        start = time.perf_counter()
+        cur.execute(load_version_bump)
+        version = cur.fetchone()[0]
+        execute_batch(cur, load_file_insert, [
+            (file_path, version, rows) for file_path, rows in policy.files
+        ])
         conn.commit()
-        print(f"{i}/{num_files} files processed.")
+        policy.committed(time.perf_counter() - start)
 
-
-def main():
+    # iterate over files and process
+    policy.reset()
+    for i, (datafile, process) in enumerate(pending, 1):
+        try:
+            rows = process(cur, datafile)
+        except Exception:
+            conn.rollback()
+            print(f"Rolled back {datafile} and the {len(policy.files)} "
+                  f"uncommitted files before it:")
+            for file_path, rows in policy.files:
+                print(f"  {file_path}")
+            raise
+        policy.add(datafile, rows, os.path.getsize(datafile))
+        if policy.should_commit() or i == num_files:
+            files = len(policy.files)
+            commit()
+            print(f"{i}/{num_files} files processed, committed {files} "
+                  f"(next batch up to {policy.batch_files} files).")
+
+
+def main(cursor_factory=None, reload=False, profiler=None):
     """
     Drives functions to process files and load them in sparkifydb
+    :param cursor_factory: cursor class, main.py --profile times statements
+    :param reload: process the files of earlier runs again, only rows not
+    loaded yet are inserted
+    :param profiler: StageProfiler of main.py --profile, the song and the
+    log files are recorded as its song_data and log_data stages
     :return:
     """
 
     conn = psycopg2.connect(
-        "host=127.0.0.1 dbname=sparkifydb user=student password=student"
+        "host=127.0.0.1 dbname=sparkifydb user=student password=student",
+        cursor_factory=cursor_factory
     )
     cur = conn.cursor()
-
-    process_data(cur, conn, filepath="data/song_data", func=process_song_file)
-    process_data(cur, conn, filepath='data/log_data', func=process_log_file)
+    if profiler is not None:
+        run = profiler.run
+    else:
+        def run(name, stage):
+            return stage()
+
+    # process_data takes a func argument of its own, so the stages get
+    # partials
+    run('song_data', functools.partial(
+        process_data, cur, conn, filepath="data/song_data",
+        func=process_song_file,
+        reload_func=process_song_file if reload else None
+    ))
+    sessions = SessionAggregator()
+    sketches = SketchAggregator()
+    # neither sessions nor sketches change when events are added twice, so
+    # reloaded files go through the same function
+    process_log = functools.partial(process_log_file, sessions=sessions,
+                                    sketches=sketches)
+    run('log_data', functools.partial(
+        process_data, cur, conn, filepath='data/log_data', func=process_log,
+        reload_func=process_log if reload else None
+    ))
 
     conn.close()
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(
+        description="Loads the song and log files into sparkifydb, skipping "
+                    "files an earlier run committed."
+    )
+    parser.add_argument("--reload", action="store_true",
+                        help="Process the files of earlier runs again. Plays "
+                             "already in songplays are skipped.")
+    args = parser.parse_args()
+
+    main(reload=args.reload)
     print("Finished processing and loading")
@@ -0,0 +1,54 @@
+import io
+import os
+import bz2
+import glob
+import gzip
+
+##############################################################################
+# Discovery and reading of the json input files. Compressed files are
+# decompressed while they are read, nothing is written to disk.
+
+DATA_EXTENSIONS = ('.json', '.json.gz', '.json.bz2', '.json.zst')
+
+
+def find_data_files(filepath):
+    """
+    Finds all plain and compressed json files under a directory
+    :param filepath: directory to search
+    :return: list of absolute file paths
+    """
+    all_files = []
+    for root, dirs, files in os.walk(filepath):
+        for extension in DATA_EXTENSIONS:
+            files = glob.glob(os.path.join(root, "*" + extension))
+            for f in files:
+                all_files.append(os.path.abspath(f))
+    return all_files
+
+
+def _open_zstd(file_path):
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError(
+            f"Reading {file_path} needs the zstandard package: "
+            f"pip install zstandard"
+        )
+    return zstandard.ZstdDecompressor().stream_reader(open(file_path, 'rb'),
+                                                      closefd=True)
+
+
+def open_data_file(file_path):
+    """
+    Opens a json input file as text, decompressing it on the fly based on
+    its extension
+    :param file_path: path to a file with one of DATA_EXTENSIONS
+    :return: text file object
+    """
+    if file_path.endswith('.gz'):
+        return gzip.open(file_path, 'rt', encoding='utf8')
+    if file_path.endswith('.bz2'):
+        return bz2.open(file_path, 'rt', encoding='utf8')
+    if file_path.endswith('.zst'):
+        return io.TextIOWrapper(_open_zstd(file_path), encoding='utf8')
+    return open(file_path, encoding='utf8')
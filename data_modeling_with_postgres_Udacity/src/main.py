@@ -1,10 +1,36 @@
+import argparse
 from create_tables import main as create_tables_main
 from etl import main as etl_main
+from profiling import StageProfiler
 
 
 ##############################################################################
 if __name__ == '__main__':
-    create_tables_main()
-    print("Tables created successfully")
-    etl_main()
-    print("data inserted successfully")
\ No newline at end of file
+    parser = argparse.ArgumentParser(
+        description="Creates the sparkifydb tables and loads the data."
+    )
+    parser.add_argument("--profile", action="store_true",
+                        help="Profile the run with cProfile and tracemalloc "
+                             "and time every SQL statement.")
+    parser.add_argument("--profile-dir", default="profile",
+                        help="Directory the profile output is written to.")
+    parser.add_argument("--profile-top", type=int, default=15,
+                        help="Number of functions and statements in the "
+                             "profile summary.")
+    args = parser.parse_args()
+
+    if args.profile:
+        profiler = StageProfiler()
+        profiler.run('create_tables', create_tables_main,
+                     profiler.cursor_factory)
+        print("Tables created successfully")
+        # etl.py runs the song and the log files as stages of the profiler
+        etl_main(profiler.cursor_factory, profiler=profiler)
+        print("data inserted successfully")
+        print(profiler.write(args.profile_dir, args.profile_top))
+        print(f"Profile written to {args.profile_dir}")
+    else:
+        create_tables_main()
+        print("Tables created successfully")
+        etl_main()
+        print("data inserted successfully")
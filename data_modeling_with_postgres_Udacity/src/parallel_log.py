@@ -0,0 +1,84 @@
+import io
+import os
+import mmap
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from sessions import summarize_events
+
+##############################################################################
+# Intra-file parallel parsing of large NDJSON log files. The file is memory
+# mapped, cut into byte ranges that end on line boundaries and the ranges are
+# parsed and filtered by a process pool. Results are handed back in file
+# order, so later stages see the events in the same order as when the file
+# is read in one go (the user level upsert keeps the last level seen).
+
+DEFAULT_CHUNK_BYTES = 64 * 2 ** 20
+
+
+def line_boundary_index(file_path, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """
+    Splits a NDJSON file into byte ranges of about chunk_bytes which start
+    and end on line boundaries. Only one offset per range is kept, a full
+    per line index would cost 8 bytes per event for no gain here.
+    :param file_path: plain, uncompressed json file
+    :param chunk_bytes: target size of a range
+    :return: list of (start, end) byte offsets
+    """
+    size = os.path.getsize(file_path)
+    if size == 0:
+        return []
+    ranges = []
+    with open(file_path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        start = 0
+        while start < size:
+            end = mm.find(b'\n', min(start + chunk_bytes, size) - 1)
+            end = size if end == -1 else end + 1
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def parse_range(task):
+    """
+    Parses one byte range of a log file in a worker process
+    :param task: tuple of (file_path, start, end)
+    :return: tuple of (NextSong events, output of summarize_events,
+    number of events parsed)
+    """
+    file_path, start, end = task
+    with open(file_path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        data = mm[start:end]
+    if not data.strip():
+        return pd.DataFrame(), None, 0
+    df = pd.read_json(io.BytesIO(data), lines=True)
+    return df[df['page'] == "NextSong"], summarize_events(df), len(df)
+
+
+def parse_log_file_parallel(file_path, workers=None,
+                            chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """
+    Parses a large log file with a process pool, yielding the results of
+    every range in file order. At most two ranges per worker are in flight,
+    so memory stays bounded when the database is slower than the parsing.
+    :param file_path: plain, uncompressed json file
+    :param workers: number of worker processes, defaults to the cpu count
+    :param chunk_bytes: target size of a range
+    :return: generator of (NextSong events, session aggregates, number of
+    events parsed)
+    """
+    workers = workers or os.cpu_count() or 1
+    tasks = iter(
+        (file_path, start, end)
+        for start, end in line_boundary_index(file_path, chunk_bytes)
+    )
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        in_flight = deque()
+        for task in tasks:
+            in_flight.append(pool.submit(parse_range, task))
+            if len(in_flight) >= 2 * workers:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
@@ -0,0 +1,219 @@
+import io
+import os
+import re
+import time
+import pstats
+import cProfile
+import tracemalloc
+from psycopg2.extensions import cursor as base_cursor
+
+##############################################################################
+# Profiling support for main.py --profile. Collects cProfile stats, the peak
+# memory of every stage and the time spent in every SQL statement, and writes
+# them as a pstats dump, collapsed stacks for flamegraph tools and a short
+# text summary.
+
+# a parenthesized row, one level of nested parentheses allowed, followed by
+# more rows
+VALUES_ROWS = re.compile(
+    r'(\((?:[^()]|\([^()]*\))*\))(?:\s*,\s*\((?:[^()]|\([^()]*\))*\))+'
+)
+
+
+class TimedCursor(base_cursor):
+    """
+    Cursor reporting the time spent executing every statement to its
+    profiler. Connections take StageProfiler.cursor_factory, the subclass
+    bound to one profiler.
+    """
+    profiler = None
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            if self.profiler is not None:
+                self.profiler.record_statement(
+                    query, time.perf_counter() - start
+                )
+
+
+def statement_key(query):
+    """
+    Groups executions of the same statement. Batches sent by execute_batch
+    and execute_values arrive with their values filled in, those are
+    replaced by placeholders (before splitting on ';', which values such as
+    user agents contain), the batch is keyed by its first statement and
+    the rows of a multi-row VALUES list collapse into one.
+    :param query: statement text or bytes
+    :return: key of StageProfiler.statements
+    """
+    if isinstance(query, bytes):
+        query = query.decode('utf8', 'replace')
+        query = re.sub(r"'(?:[^']|'')*'|\bNULL\b", '%s', query)
+        query = re.sub(r'(?<![\w%])-?\d+(?:\.\d+)?\b', '%s', query)
+        query = re.sub(VALUES_ROWS, r'\1', query.split(';')[0])
+        query = '[batch] ' + query
+    return ' '.join(query.split())
+
+
+def _label(func):
+    filename, line, name = func
+    if filename == '~':
+        return name
+    return f"{os.path.basename(filename)}:{line}:{name}"
+
+
+def collapsed_stacks(stats, max_depth=64, min_fraction=0.0005):
+    """
+    Turns cProfile stats into collapsed stacks ('a;b;c microseconds' lines)
+    as read by flamegraph.pl and speedscope. cProfile only keeps caller and
+    callee pairs, so a function reached over several paths has its time
+    split between them in proportion to the time each call edge took.
+    :param stats: pstats.Stats
+    :param max_depth: stacks are cut at this depth
+    :param min_fraction: branches below this share of the total time are
+    folded into their caller, the number of paths grows quickly on deep
+    call graphs
+    :return: list of lines
+    """
+    callees = {}
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((func, edge[3]))
+
+    roots = [func for func, row in stats.stats.items() if not row[4]]
+    min_seconds = min_fraction * sum(stats.stats[f][3] for f in roots)
+    labels = {func: _label(func) for func in stats.stats}
+    totals = {}
+
+    def walk(path, key, share):
+        # share is the part of the function's time spent below this path
+        cc, nc, tt, ct, callers = stats.stats[path[-1]]
+        own = tt * share
+        for callee, edge_time in callees.get(path[-1], []):
+            if callee in path or stats.stats[callee][3] <= 0:
+                # recursion is folded into the first frame of the function
+                continue
+            if len(path) >= max_depth or share * edge_time < min_seconds:
+                own += share * edge_time
+            else:
+                walk(path + (callee,), f"{key};{labels[callee]}",
+                     share * edge_time / stats.stats[callee][3])
+        totals[key] = totals.get(key, 0.0) + own
+
+    for root in roots:
+        walk((root,), labels[root], 1.0)
+
+    return [
+        f"{key} {int(seconds * 1e6)}"
+        for key, seconds in totals.items() if seconds * 1e6 >= 1
+    ]
+
+
+class StageProfiler:
+    """
+    Runs the stages of a load under cProfile and tracemalloc and collects
+    the statement times of the cursors it hands out
+    """
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+        self.stages = []
+        self.statements = {}
+        self.cursor_factory = type('TimedCursor', (TimedCursor,),
+                                   {'profiler': self})
+
+    def record_statement(self, query, seconds):
+        """
+        Adds one execution of a statement to the statement stats
+        :param query: statement text, parameters not filled in
+        :param seconds: time the execution took
+        :return:
+        """
+        key = statement_key(query)
+        stats = self.statements.setdefault(
+            key, {'calls': 0, 'total': 0.0, 'max': 0.0}
+        )
+        stats['calls'] += 1
+        stats['total'] += seconds
+        stats['max'] = max(stats['max'], seconds)
+
+    def slowest_statements(self, limit=10):
+        """
+        Statements sorted by total execution time
+        :param limit: number of statements to return
+        :return: list of (statement, stats dict)
+        """
+        ranked = sorted(self.statements.items(),
+                        key=lambda item: -item[1]['total'])
+        return ranked[:limit]
+
+    def run(self, name, func, *args, **kwargs):
+        """
+        Runs one stage, recording its duration and peak memory
+        :param name: stage name for the summary
+        :param func: function running the stage
+        :return: result of func
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        self.profile.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.profile.disable()
+            seconds = time.perf_counter() - start
+            self.stages.append({
+                'stage': name,
+                'seconds': seconds,
+                'peak_mb': tracemalloc.get_traced_memory()[1] / 2 ** 20
+            })
+
+    def summary(self, top=15):
+        """
+        Text summary of stages, hottest functions and slowest statements
+        :param top: number of functions and statements listed
+        :return: summary string
+        """
+        out = io.StringIO()
+        out.write(f"{'stage':<20} {'seconds':>10} {'peak MB':>10}\n")
+        for stage in self.stages:
+            out.write(f"{stage['stage']:<20} {stage['seconds']:>10.3f}"
+                      f" {stage['peak_mb']:>10.1f}\n")
+
+        out.write(f"\nTop {top} functions by own time\n")
+        stats = pstats.Stats(self.profile)
+        rows = sorted(stats.stats.items(), key=lambda item: -item[1][2])
+        out.write(f"{'own s':>8} {'cum s':>8} {'calls':>9}  function\n")
+        for func, (cc, nc, tt, ct, callers) in rows[:top]:
+            out.write(f"{tt:>8.3f} {ct:>8.3f} {nc:>9}  {_label(func)}\n")
+
+        out.write(f"\nTop {top} statements by total time\n")
+        out.write(f"{'total s':>8} {'max ms':>8} {'calls':>9}  statement\n")
+        for query, s in self.slowest_statements(top):
+            out.write(f"{s['total']:>8.3f} {s['max'] * 1000:>8.2f}"
+                      f" {s['calls']:>9}  {query[:80]}\n")
+        return out.getvalue()
+
+    def write(self, directory, top=15):
+        """
+        Writes main.prof (pstats dump, for snakeviz or flameprof),
+        main.folded (collapsed stacks for flamegraph.pl or speedscope) and
+        summary.txt to a directory
+        :param directory: output directory, created if missing
+        :param top: number of functions and statements in the summary
+        :return: summary string
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.profile.dump_stats(os.path.join(directory, 'main.prof'))
+        with open(os.path.join(directory, 'main.folded'), 'w') as f:
+            f.write('\n'.join(collapsed_stacks(pstats.Stats(self.profile))))
+            f.write('\n')
+        summary = self.summary(top)
+        with open(os.path.join(directory, 'summary.txt'), 'w') as f:
+            f.write(summary)
+        return summary
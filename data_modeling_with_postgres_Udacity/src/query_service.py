@@ -0,0 +1,214 @@
+import re
+import time
+import argparse
+from collections import OrderedDict
+import psycopg2
+from sql_queries import load_version_select
+
+
+##############################################################################
+# Catalog of named analytical queries over the star schema. Each entry holds
+# the query and the default value of every parameter it takes.
+
+QUERY_CATALOG = {
+    'top_songs': ("""
+        SELECT songs.title, artists.name, COUNT(*) AS plays
+        FROM songplays
+        JOIN songs ON songplays.song_id = songs.song_id
+        JOIN artists ON songplays.artist_id = artists.artist_id
+        GROUP BY songs.title, artists.name
+        ORDER BY plays DESC, songs.title
+        LIMIT %(limit)s
+    """, {'limit': 10}),
+
+    'top_artists': ("""
+        SELECT artists.name, COUNT(*) AS plays
+        FROM songplays
+        JOIN artists ON songplays.artist_id = artists.artist_id
+        GROUP BY artists.name
+        ORDER BY plays DESC, artists.name
+        LIMIT %(limit)s
+    """, {'limit': 10}),
+
+    'plays_per_hour': ("""
+        SELECT time_hours.hour, COUNT(*) AS plays
+        FROM songplays
+        JOIN time_hours ON songplays.time_key = time_hours.time_key
+        GROUP BY time_hours.hour
+        ORDER BY time_hours.hour
+    """, {}),
+
+    'plays_per_weekday': ("""
+        SELECT time_hours.weekday, COUNT(*) AS plays
+        FROM songplays
+        JOIN time_hours ON songplays.time_key = time_hours.time_key
+        GROUP BY time_hours.weekday
+        ORDER BY plays DESC
+    """, {}),
+
+    'plays_per_day': ("""
+        SELECT songplays.start_time::date AS day, COUNT(*) AS plays,
+               COUNT(DISTINCT songplays.user_id) AS listeners
+        FROM songplays
+        WHERE songplays.start_time >= %(start)s
+        AND songplays.start_time < %(end)s
+        GROUP BY day
+        ORDER BY day
+    """, {'start': '1970-01-01', 'end': '2100-01-01'}),
+
+    'users_by_level': ("""
+        SELECT level, COUNT(*) AS users
+        FROM users
+        GROUP BY level
+        ORDER BY level
+    """, {}),
+
+    'plays_by_level': ("""
+        SELECT songplays.level, COUNT(*) AS plays,
+               COUNT(DISTINCT songplays.user_id) AS listeners
+        FROM songplays
+        GROUP BY songplays.level
+        ORDER BY songplays.level
+    """, {}),
+
+    'top_users': ("""
+        SELECT users.user_id, users.first_name, users.last_name,
+               users.level, COUNT(*) AS plays
+        FROM songplays
+        JOIN users ON songplays.user_id = users.user_id
+        GROUP BY users.user_id
+        ORDER BY plays DESC, users.user_id
+        LIMIT %(limit)s
+    """, {'limit': 10}),
+
+    'plays_by_location': ("""
+        SELECT location, COUNT(*) AS plays
+        FROM songplays
+        GROUP BY location
+        ORDER BY plays DESC
+        LIMIT %(limit)s
+    """, {'limit': 10}),
+
+    'session_stats': ("""
+        SELECT COUNT(*) AS sessions,
+               AVG(end_time - start_time) AS avg_length,
+               AVG(num_songs) AS avg_songs,
+               AVG(first_play_time - start_time) AS avg_time_to_first_play
+        FROM sessions
+    """, {})
+}
+
+
+class QueryService:
+    """
+    Runs catalog queries against sparkifydb and keeps results in a bounded
+    LRU cache keyed by query, parameters and load version. The ETL bumps the
+    load version on every commit, so cached results stay valid until new
+    data lands. The version is paired with the time it was set, because
+    rebuilding the database starts counting at 0 again.
+    """
+
+    def __init__(self, conn, max_entries=256, version_ttl=1.0):
+        """
+        :param conn: connection to sparkifydb
+        :param max_entries: maximum number of cached results
+        :param version_ttl: seconds a load version lookup is reused for,
+        0 checks the version on every read
+        """
+        self.conn = conn
+        self.max_entries = max_entries
+        self.version_ttl = version_ttl
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._version = None
+        self._version_checked = 0.0
+
+    def load_version(self):
+        """
+        Current load version, looked up at most once per version_ttl
+        :return: tuple of (load version number, time it was set)
+        """
+        now = time.monotonic()
+        if self._version is None or \
+                now - self._version_checked >= self.version_ttl:
+            with self.conn.cursor() as cur:
+                cur.execute(load_version_select)
+                self._version = cur.fetchone()
+            self.conn.commit()
+            self._version_checked = now
+        return self._version
+
+    def run(self, name, **params):
+        """
+        Runs a catalog query, answering from the cache when possible
+        :param name: name of the query in QUERY_CATALOG
+        :param params: values overriding the query defaults
+        :return: list of result rows
+        """
+        if name not in QUERY_CATALOG:
+            raise KeyError(f"Unknown query: {name}")
+        query, defaults = QUERY_CATALOG[name]
+        unknown = set(params) - set(defaults)
+        if unknown:
+            raise ValueError(
+                f"Unknown parameters for {name}: {', '.join(sorted(unknown))}"
+            )
+        values = dict(defaults, **params)
+
+        key = (name, tuple(sorted(values.items())), self.load_version())
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return self.cache[key]
+
+        self.misses += 1
+        with self.conn.cursor() as cur:
+            cur.execute(query, values)
+            rows = cur.fetchall()
+        self.conn.commit()
+
+        self.cache[key] = rows
+        if len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+        return rows
+
+    def clear(self):
+        """
+        Empties the cache
+        :return:
+        """
+        self.cache.clear()
+
+
+def parse_param(value):
+    """
+    Parses a name=value command line parameter, numbers become int
+    :param value: parameter string
+    :return: tuple of (name, value)
+    """
+    name, _, raw = value.partition('=')
+    return name, int(raw) if re.fullmatch(r'-?\d+', raw) else raw
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Runs a named analytical query against sparkifydb."
+    )
+    parser.add_argument("query", choices=sorted(QUERY_CATALOG),
+                        help="Name of the query to run.")
+    parser.add_argument("-p", "--param", type=parse_param, action="append",
+                        default=[], help="Query parameter as name=value.")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(
+        "host=127.0.0.1 dbname=sparkifydb user=student password=student"
+    )
+    service = QueryService(conn)
+    for row in service.run(args.query, **dict(args.param)):
+        print(row)
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,388 @@
+import io
+import os
+import json
+import time
+import argparse
+import numpy as np
+import pandas as pd
+import psycopg2
+from sql_queries import create_table_queries, drop_table_queries
+from sql_queries import load_version_insert
+from query_service import QUERY_CATALOG
+
+##############################################################################
+# Read benchmark of the sparkifydb schema. Loads synthetic data at several
+# scales into a separate database, runs the catalog queries of
+# query_service.py, records latency percentiles and saves the EXPLAIN
+# (ANALYZE, BUFFERS) plan of every query, flagging sequential scans on
+# large tables.
+
+DEFAULT_SCALES = [10000, 100000, 1000000]
+
+WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday',
+            'Saturday', 'Sunday']
+
+
+def create_benchmark_database(dbname):
+    """
+    Creates an empty benchmark database next to sparkifydb
+    :param dbname: name of the benchmark database
+    :return: connection to the benchmark database
+    """
+    conn = psycopg2.connect(
+        "host=127.0.0.1 dbname=studentdb user=student password=student"
+    )
+    conn.set_session(autocommit=True)
+    cur = conn.cursor()
+    cur.execute(f"DROP DATABASE IF EXISTS {dbname}")
+    cur.execute(
+        f"CREATE DATABASE {dbname} WITH ENCODING 'utf8' TEMPLATE template0"
+    )
+    conn.close()
+
+    return psycopg2.connect(
+        f"host=127.0.0.1 dbname={dbname} user=student password=student"
+    )
+
+
+def synthetic_tables(num_songplays, match_ratio=0.5, days=30, seed=0):
+    """
+    Generates star schema rows with the shape of the Sparkify logs: a few
+    dimension rows per thousand plays, plays spread over the given days and
+    part of them matched to a song
+    :param num_songplays: number of songplays
+    :param match_ratio: share of songplays with song_id and artist_id
+    :param days: number of days the plays are spread over
+    :param seed: random seed
+    :return: dict of table name to DataFrame, in load order
+    """
+    rng = np.random.default_rng(seed)
+    num_artists = max(100, num_songplays // 200)
+    num_songs = max(500, num_songplays // 50)
+    num_users = max(100, num_songplays // 1000)
+
+    artists = pd.DataFrame({
+        'artist_id': [f"AR{i:016d}" for i in range(num_artists)],
+        'name': [f"Artist {i}" for i in range(num_artists)],
+        'location': [f"City {i % 500}" for i in range(num_artists)],
+        'latitude': rng.uniform(-80, 80, num_artists).round(5),
+        'longitude': rng.uniform(-170, 170, num_artists).round(5)
+    })
+    song_artist = rng.integers(0, num_artists, num_songs)
+    songs = pd.DataFrame({
+        'song_id': [f"SO{i:016d}" for i in range(num_songs)],
+        'title': [f"Song {i}" for i in range(num_songs)],
+        'artist_id': artists['artist_id'].values[song_artist],
+        'year': rng.integers(1960, 2019, num_songs),
+        'duration': rng.uniform(60, 600, num_songs).round(5)
+    })
+    users = pd.DataFrame({
+        'user_id': np.arange(1, num_users + 1),
+        'first_name': [f"First{i}" for i in range(num_users)],
+        'last_name': [f"Last{i}" for i in range(num_users)],
+        'gender': rng.choice(['F', 'M'], num_users),
+        'level': rng.choice(['free', 'paid'], num_users, p=[0.3, 0.7])
+    })
+
+    # popular songs and heavy users, as in the logs
+    song_index = np.minimum(
+        rng.zipf(1.3, num_songplays) - 1, num_songs - 1
+    )
+    user_index = np.minimum(
+        rng.zipf(1.5, num_songplays) - 1, num_users - 1
+    )
+    start = pd.Timestamp('2018-11-01')
+    ms = np.sort(rng.choice(days * 86400000, num_songplays, replace=False))
+    start_time = start + pd.to_timedelta(ms, unit='ms')
+    time_key = (start.value // 10 ** 6 + ms) // 3600000
+    matched = rng.random(num_songplays) < match_ratio
+    songplays = pd.DataFrame({
+        'start_time': start_time,
+        'time_key': time_key,
+        'user_id': users['user_id'].values[user_index],
+        'level': users['level'].values[user_index],
+        'song_id': np.where(matched, songs['song_id'].values[song_index],
+                            None),
+        'artist_id': np.where(matched,
+                              songs['artist_id'].values[song_index], None),
+        'session_id': user_index * 1000 + ms // 3600000 % 1000,
+        'item_in_session': np.arange(num_songplays),
+        'location': [f"City {i % 500}" for i in user_index],
+        'user_agent': rng.choice([
+            'Mozilla/5.0 (Windows NT 6.1; WOW64)',
+            'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4)',
+            'Mozilla/5.0 (X11; Linux x86_64)'
+        ], num_songplays)
+    })
+    time_table = pd.DataFrame({
+        'start_time': start_time,
+        'hour': start_time.hour,
+        'day': start_time.day,
+        'week': start_time.isocalendar().week.values,
+        'month': start_time.month,
+        'year': start_time.year,
+        'weekday': [WEEKDAYS[d] for d in start_time.weekday]
+    })
+    hour_keys = np.unique(time_key)
+    hour_start = pd.to_datetime(hour_keys * 3600000, unit='ms')
+    time_hours = pd.DataFrame({
+        'time_key': hour_keys,
+        'hour_start': hour_start,
+        'hour': hour_start.hour,
+        'day': hour_start.day,
+        'week': hour_start.isocalendar().week.values,
+        'month': hour_start.month,
+        'year': hour_start.year,
+        'weekday': [WEEKDAYS[d] for d in hour_start.weekday]
+    })
+    return {
+        'artists': artists, 'songs': songs, 'users': users,
+        'time': time_table, 'time_hours': time_hours, 'songplays': songplays
+    }
+
+
+def copy_frame(cur, table, df):
+    """
+    Bulk loads a DataFrame with COPY ... FROM STDIN
+    :param cur: cursor to the database
+    :param table: table to load
+    :param df: rows, columns named as in the table
+    :return:
+    """
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    cur.copy_expert(
+        f"COPY {table} ({', '.join(df.columns)}) FROM STDIN WITH CSV", buffer
+    )
+
+
+def load_scale(conn, num_songplays, seed=0):
+    """
+    Recreates the schema of create_tables.py and loads synthetic data
+    :param conn: connection to the benchmark database
+    :param num_songplays: number of songplays
+    :param seed: random seed
+    :return: dict of table name to row count
+    """
+    cur = conn.cursor()
+    for query in drop_table_queries + create_table_queries:
+        cur.execute(query)
+    cur.execute(load_version_insert)
+
+    counts = {}
+    for table, df in synthetic_tables(num_songplays, seed=seed).items():
+        copy_frame(cur, table, df)
+        counts[table] = len(df)
+
+    cur.execute("""
+        INSERT INTO sessions
+        SELECT session_id, user_id, MIN(start_time), MAX(start_time),
+               COUNT(*), COUNT(*), MIN(start_time), COUNT(*),
+               ARRAY_AGG(item_in_session), ARRAY_AGG(item_in_session)
+        FROM songplays
+        GROUP BY session_id, user_id
+    """)
+    counts['sessions'] = cur.rowcount
+    conn.commit()
+
+    # VACUUM can not run inside a transaction block
+    conn.autocommit = True
+    cur.execute("VACUUM ANALYZE")
+    conn.autocommit = False
+    return counts
+
+
+def percentile(values, pct):
+    """
+    :param values: sorted latencies
+    :param pct: percentile, 0 to 100
+    :return: latency at the percentile, nearest rank
+    """
+    rank = max(1, int(np.ceil(pct / 100 * len(values))))
+    return values[rank - 1]
+
+
+def time_query(cur, query, params, repeat, warmup=1):
+    """
+    Runs a query repeatedly and measures its latency
+    :param cur: cursor to the database
+    :param query: sql query
+    :param params: query parameters
+    :param repeat: number of timed runs
+    :param warmup: number of untimed runs first
+    :return: dict of latency percentiles in milliseconds
+    """
+    latencies = []
+    for i in range(warmup + repeat):
+        start = time.perf_counter()
+        cur.execute(query, params)
+        cur.fetchall()
+        if i >= warmup:
+            latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    return {
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'max': latencies[-1]
+    }
+
+
+def plan_nodes(plan):
+    """
+    Walks an EXPLAIN (FORMAT JSON) plan
+    :param plan: plan node dict
+    :return: generator of plan node dicts
+    """
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+
+
+def explain(cur, query, params):
+    """
+    Captures the EXPLAIN (ANALYZE, BUFFERS) plan of a query
+    :param cur: cursor to the database
+    :param query: sql query
+    :param params: query parameters
+    :return: tuple of (json plan, text plan)
+    """
+    cur.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query, params)
+    json_plan = cur.fetchone()[0][0]
+    cur.execute("EXPLAIN (ANALYZE, BUFFERS) " + query, params)
+    text_plan = '\n'.join(row[0] for row in cur.fetchall())
+    return json_plan, text_plan
+
+
+def seq_scan_flags(json_plan, counts, large_rows):
+    """
+    Finds sequential scans on tables with at least large_rows rows
+    :param json_plan: plan returned by explain
+    :param counts: dict of table name to row count
+    :param large_rows: row count from which a table is large
+    :return: list of flag strings
+    """
+    flags = []
+    for node in plan_nodes(json_plan['Plan']):
+        table = node.get('Relation Name')
+        if node['Node Type'] == 'Seq Scan' and \
+                counts.get(table, 0) >= large_rows:
+            blocks = node.get('Shared Hit Blocks', 0) + \
+                node.get('Shared Read Blocks', 0)
+            flags.append(f"Seq Scan on {table} ({counts[table]} rows, "
+                         f"{blocks} blocks)")
+    return flags
+
+
+def run_scale(conn, num_songplays, queries, repeat, large_rows, plan_dir):
+    """
+    Loads one scale and benchmarks the queries on it
+    :param conn: connection to the benchmark database
+    :param num_songplays: number of songplays
+    :param queries: names of catalog queries
+    :param repeat: number of timed runs per query
+    :param large_rows: row count from which a table is large
+    :param plan_dir: directory the plans are saved to
+    :return: list of result dicts
+    """
+    start = time.perf_counter()
+    counts = load_scale(conn, num_songplays)
+    print(f"\nscale {num_songplays} songplays, loaded in "
+          f"{time.perf_counter() - start:.1f}s")
+
+    scale_dir = os.path.join(plan_dir, str(num_songplays))
+    os.makedirs(scale_dir, exist_ok=True)
+    results = []
+    cur = conn.cursor()
+    for name in queries:
+        query, params = QUERY_CATALOG[name]
+        latency = time_query(cur, query, params, repeat)
+        json_plan, text_plan = explain(cur, query, params)
+        conn.rollback()
+        with open(os.path.join(scale_dir, f"{name}.json"), 'w') as f:
+            json.dump(json_plan, f, indent=2)
+        with open(os.path.join(scale_dir, f"{name}.txt"), 'w') as f:
+            f.write(text_plan)
+        results.append(dict(
+            latency, scale=num_songplays, query=name,
+            flags=seq_scan_flags(json_plan, counts, large_rows)
+        ))
+    return results
+
+
+def print_results(results):
+    """
+    Prints the latency table and the seq scan flags
+    :param results: list of result dicts
+    :return:
+    """
+    print(f"{'scale':>9} {'query':<20} {'p50 ms':>9} {'p95 ms':>9}"
+          f" {'p99 ms':>9}  flags")
+    for r in results:
+        print(f"{r['scale']:>9} {r['query']:<20} {r['p50']:>9.2f}"
+              f" {r['p95']:>9.2f} {r['p99']:>9.2f}  {'; '.join(r['flags'])}")
+
+
+def compare(results, baseline):
+    """
+    Prints the p50 latency change against an earlier run
+    :param results: list of result dicts
+    :param baseline: results.json of an earlier run
+    :return:
+    """
+    before = {(r['scale'], r['query']): r for r in baseline}
+    print(f"\n{'scale':>9} {'query':<20} {'base p50':>9} {'p50 ms':>9}"
+          f" {'change':>8}")
+    for r in results:
+        old = before.get((r['scale'], r['query']))
+        if old:
+            print(f"{r['scale']:>9} {r['query']:<20} {old['p50']:>9.2f}"
+                  f" {r['p50']:>9.2f} {r['p50'] / old['p50'] - 1:>+8.0%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the catalog queries on synthetic sparkifydb "
+                    "data at several scales."
+    )
+    parser.add_argument("--scales", type=int, nargs='+',
+                        default=DEFAULT_SCALES,
+                        help="Numbers of songplays to benchmark.")
+    parser.add_argument("--queries", nargs='+', choices=sorted(QUERY_CATALOG),
+                        default=sorted(QUERY_CATALOG),
+                        help="Catalog queries to run.")
+    parser.add_argument("--repeat", type=int, default=20,
+                        help="Number of timed runs per query.")
+    parser.add_argument("--large-rows", type=int, default=100000,
+                        help="Flag sequential scans on tables with at "
+                             "least this many rows.")
+    parser.add_argument("--dbname", default="sparkifydb_bench",
+                        help="Benchmark database, dropped and recreated.")
+    parser.add_argument("--output", default="read_benchmark",
+                        help="Directory for plans and results.json.")
+    parser.add_argument("--baseline", default=None,
+                        help="results.json of an earlier run to compare "
+                             "with.")
+    args = parser.parse_args()
+
+    conn = create_benchmark_database(args.dbname)
+    results = []
+    for scale in args.scales:
+        scale_results = run_scale(conn, scale, args.queries, args.repeat,
+                                  args.large_rows, args.output)
+        print_results(scale_results)
+        results.extend(scale_results)
+    conn.close()
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+    with open(os.path.join(args.output, 'results.json'), 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nPlans and results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
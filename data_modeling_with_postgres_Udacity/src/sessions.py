@@ -0,0 +1,116 @@
+import pandas as pd
+from psycopg2.extras import execute_batch
+from sql_queries import session_table_upsert
+
+
+##############################################################################
+def summarize_events(df):
+    """
+    Aggregates raw log events per session. Runs without database access, so
+    it can run in the worker processes parsing parts of a large log file.
+    :param df: log events with sessionId, userId, itemInSession, ts and
+    page columns, all pages included
+    :return: DataFrame indexed by (sessionId, userId) with start, end,
+    first_play, last_item, items and song_items columns, the last two
+    arrays of the distinct itemInSession values of all events and of the
+    NextSong events
+    """
+    events = df[['sessionId', 'userId', 'itemInSession', 'ts', 'page']]
+    events = events.assign(
+        userId=pd.to_numeric(events['userId'], errors='coerce')
+    ).dropna(subset=['userId', 'sessionId', 'ts'])
+
+    is_song = events['page'] == 'NextSong'
+    return events.assign(
+        play_ts=events['ts'].where(is_song),
+        play_item=events['itemInSession'].where(is_song)
+    ).groupby(['sessionId', 'userId']).agg(
+        start=('ts', 'min'),
+        end=('ts', 'max'),
+        first_play=('play_ts', 'min'),
+        last_item=('itemInSession', 'max'),
+        items=('itemInSession', 'unique'),
+        song_items=('play_item', 'unique')
+    )
+
+
+class SessionAggregator:
+    """
+    Builds the sessions summary table in a single pass over the log events.
+    Every chunk of events is folded into per session deltas which are
+    upserted with merge semantics (min start, max end, union of the items
+    seen), so a session spanning several files or chunks ends up as one row
+    without self-joins over songplays, and events loaded twice, by a reload
+    or a replayed stream, are not counted twice.
+    """
+
+    def __init__(self):
+        self.pending = {}
+
+    def update(self, df):
+        """
+        Folds a chunk of raw log events into the pending session deltas
+        :param df: log events with sessionId, userId, itemInSession, ts and
+        page columns, all pages included
+        :return:
+        """
+        self.merge(summarize_events(df))
+
+    def merge(self, grouped):
+        """
+        Folds per session aggregates into the pending session deltas
+        :param grouped: output of summarize_events
+        :return:
+        """
+        if grouped.empty:
+            return
+
+        for (session_id, user_id), row in zip(grouped.index,
+                                              grouped.itertuples()):
+            key = (int(session_id), int(user_id))
+            first_play = None if pd.isna(row.first_play) \
+                else int(row.first_play)
+            items = {int(i) for i in row.items}
+            song_items = {int(i) for i in row.song_items if not pd.isna(i)}
+            delta = self.pending.get(key)
+            if delta is None:
+                self.pending[key] = {
+                    'start': int(row.start),
+                    'end': int(row.end),
+                    'items': items,
+                    'song_items': song_items,
+                    'first_play': first_play,
+                    'last_item': int(row.last_item)
+                }
+            else:
+                delta['start'] = min(delta['start'], int(row.start))
+                delta['end'] = max(delta['end'], int(row.end))
+                delta['items'] |= items
+                delta['song_items'] |= song_items
+                if first_play is not None:
+                    delta['first_play'] = first_play \
+                        if delta['first_play'] is None \
+                        else min(delta['first_play'], first_play)
+                delta['last_item'] = max(delta['last_item'],
+                                         int(row.last_item))
+
+    def flush(self, cur):
+        """
+        Upserts the pending session deltas, to be called inside the
+        transaction of the file the events came from. The deltas are dropped
+        even if the upsert fails, a retry folds the events in again.
+        :param cur: cursor to database
+        :return: number of sessions written
+        """
+        def to_time(ms):
+            return None if ms is None else pd.Timestamp(ms, unit='ms')
+
+        rows = [
+            (session_id, user_id, to_time(d['start']), to_time(d['end']),
+             len(d['items']), len(d['song_items']), to_time(d['first_play']),
+             d['last_item'], sorted(d['items']), sorted(d['song_items']))
+            for (session_id, user_id), d in self.pending.items()
+        ]
+        self.pending = {}
+        execute_batch(cur, session_table_upsert, rows, page_size=500)
+        return len(rows)
@@ -0,0 +1,178 @@
+import json
+import time
+import argparse
+from read_benchmark import create_benchmark_database, load_scale
+from read_benchmark import synthetic_tables, time_query, percentile
+from sketches import SketchAggregator, distinct_count, distinct_counts
+
+##############################################################################
+# Compares the HyperLogLog sketches of sketches.py with the exact
+# COUNT(DISTINCT) queries on synthetic data: the relative error of every
+# estimate and the latency of both ways of answering the same question.
+
+DEFAULT_SCALES = [100000, 1000000]
+
+# name -> (exact query, sketch helper, helper arguments); queries returning
+# one row per bucket are compared with the per bucket estimates
+COMPARISONS = {
+    'users_total': ("""
+        SELECT COUNT(DISTINCT user_id) FROM songplays
+    """, distinct_count, ('day', 'users')),
+    'users_first_week': ("""
+        SELECT COUNT(DISTINCT user_id) FROM songplays
+        WHERE start_time >= '2018-11-01' AND start_time < '2018-11-08'
+    """, distinct_count, ('day', 'users', '2018-11-01', '2018-11-07')),
+    'songs_total': ("""
+        SELECT COUNT(DISTINCT song_id) FROM songplays
+    """, distinct_count, ('day', 'songs')),
+    'users_per_day': ("""
+        SELECT to_char(start_time, 'YYYY-MM-DD'), COUNT(DISTINCT user_id)
+        FROM songplays
+        GROUP BY 1
+    """, distinct_counts, ('day', 'users')),
+    'users_per_hour': ("""
+        SELECT to_char(start_time, 'YYYY-MM-DD HH24'), COUNT(DISTINCT user_id)
+        FROM songplays
+        GROUP BY 1
+    """, distinct_counts, ('hour', 'users')),
+    'songs_per_artist': ("""
+        SELECT artist_id, COUNT(DISTINCT song_id)
+        FROM songplays
+        WHERE artist_id IS NOT NULL
+        GROUP BY 1
+    """, distinct_counts, ('artist', 'songs'))
+}
+
+
+def build_sketches(conn, num_songplays, seed=0):
+    """
+    Fills distinct_sketches from the synthetic songplays load_scale loaded,
+    the way the ETL does
+    :param conn: connection to the benchmark database
+    :param num_songplays: number of songplays
+    :param seed: random seed given to load_scale
+    :return: dict with the number and size of the sketches and the seconds
+    spent building them
+    """
+    songplays = synthetic_tables(num_songplays, seed=seed)['songplays']
+    cur = conn.cursor()
+    start = time.perf_counter()
+    sketches = SketchAggregator()
+    sketches.update(songplays)
+    written = sketches.flush(cur)
+    conn.commit()
+    seconds = time.perf_counter() - start
+    cur.execute("SELECT SUM(LENGTH(registers)) FROM distinct_sketches")
+    return {'sketches': written, 'bytes': int(cur.fetchone()[0]),
+            'seconds': seconds}
+
+
+def time_call(func, args, repeat, warmup=1):
+    """
+    Calls a sketch helper repeatedly and measures its latency
+    :param func: helper of sketches.py
+    :param args: its arguments after the cursor
+    :param repeat: number of timed calls
+    :param warmup: number of untimed calls first
+    :return: last result and dict of latency percentiles in milliseconds
+    """
+    latencies = []
+    for i in range(warmup + repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        if i >= warmup:
+            latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    return result, {'p50': percentile(latencies, 50),
+                    'p95': percentile(latencies, 95)}
+
+
+def relative_errors(exact_rows, estimate):
+    """
+    :param exact_rows: rows of the exact query, one count or bucket/count
+    pairs
+    :param estimate: output of distinct_count or distinct_counts
+    :return: list of absolute relative errors, one per bucket
+    """
+    if not isinstance(estimate, dict):
+        return [abs(estimate - exact_rows[0][0]) / exact_rows[0][0]]
+    return [abs(estimate.get(bucket, 0) - exact) / exact
+            for bucket, exact in exact_rows]
+
+
+def run_scale(conn, num_songplays, repeat):
+    """
+    Loads one scale, builds its sketches and compares both ways of counting
+    :param conn: connection to the benchmark database
+    :param num_songplays: number of songplays
+    :param repeat: number of timed runs per query
+    :return: dict with the sketch sizes and per query results
+    """
+    load_scale(conn, num_songplays)
+    result = {'scale': num_songplays,
+              'build': build_sketches(conn, num_songplays), 'queries': {}}
+    cur = conn.cursor()
+    for name, (query, func, args) in COMPARISONS.items():
+        exact = time_query(cur, query, {}, repeat)
+        cur.execute(query)
+        exact_rows = cur.fetchall()
+        estimate, sketch = time_call(func, (cur,) + args, repeat)
+        errors = relative_errors(exact_rows, estimate)
+        result['queries'][name] = {
+            'buckets': len(errors),
+            'mean_error': sum(errors) / len(errors),
+            'max_error': max(errors),
+            'exact_p50': exact['p50'], 'sketch_p50': sketch['p50']
+        }
+        conn.rollback()
+    return result
+
+
+def print_result(result):
+    """
+    Prints the accuracy and latency comparison of one scale
+    :param result: output of run_scale
+    :return:
+    """
+    build = result['build']
+    print(f"\nscale {result['scale']} songplays")
+    print(f"  {build['sketches']} sketches, {build['bytes'] / 1024:.1f} KB, "
+          f"built in {build['seconds']:.2f} s")
+    print(f"  {'query':<18} {'buckets':>8} {'mean err':>9} {'max err':>9}"
+          f" {'exact ms':>9} {'sketch ms':>10}")
+    for name, r in result['queries'].items():
+        print(f"  {name:<18} {r['buckets']:>8} {r['mean_error']:>9.2%}"
+              f" {r['max_error']:>9.2%} {r['exact_p50']:>9.2f}"
+              f" {r['sketch_p50']:>10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compares the distinct count sketches with exact "
+                    "COUNT(DISTINCT) queries on synthetic data."
+    )
+    parser.add_argument("--scales", type=int, nargs='+',
+                        default=DEFAULT_SCALES,
+                        help="Numbers of songplays to benchmark.")
+    parser.add_argument("--repeat", type=int, default=10,
+                        help="Number of timed runs per query.")
+    parser.add_argument("--dbname", default="sparkifydb_bench",
+                        help="Benchmark database, dropped and recreated.")
+    parser.add_argument("--json", default=None,
+                        help="Write the results to this file.")
+    args = parser.parse_args()
+
+    conn = create_benchmark_database(args.dbname)
+    results = []
+    for scale in args.scales:
+        results.append(run_scale(conn, scale, args.repeat))
+        print_result(results[-1])
+    conn.close()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,290 @@
+import argparse
+import numpy as np
+import pandas as pd
+import psycopg2
+from psycopg2.extras import execute_batch
+from sql_queries import sketch_upsert, sketch_select, sketch_range_select
+from sql_queries import sketch_table_lock
+
+##############################################################################
+# HyperLogLog sketches of the distinct users and songs in songplays, per
+# day, hour and artist. The ETL folds every loaded batch of songplays into
+# the sketches of the buckets it touched and merges them into the
+# distinct_sketches table. A sketch is merged with another by taking the
+# register wise maximum, so the distinct count of any range of buckets is
+# estimated without reading songplays. Adding a play twice does not change
+# a sketch, so reloading files is safe.
+
+PRECISION = 12
+REGISTERS = 1 << PRECISION
+# standard error of an estimate is about 1.04 / sqrt(REGISTERS), 1.6%
+
+# grain -> function of the songplays frame returning the bucket of each row
+GRAINS = {
+    'day': lambda df: df['start_time'].dt.strftime('%Y-%m-%d'),
+    'hour': lambda df: df['start_time'].dt.strftime('%Y-%m-%d %H'),
+    'artist': lambda df: df['artist_id']
+}
+# metric -> songplays column whose distinct values are counted
+METRICS = {
+    'users': 'user_id',
+    'songs': 'song_id'
+}
+
+
+def hash_values(values):
+    """
+    Stable 64 bit hashes of user ids (numbers) or song ids (strings)
+    :param values: Series of ids, missing ones are dropped
+    :return: numpy array of uint64
+    """
+    values = values.dropna()
+    if values.empty:
+        return np.array([], dtype=np.uint64)
+    if values.dtype == object:
+        numbers = pd.to_numeric(values, errors='coerce')
+        if numbers.notna().all():
+            values = numbers
+    if values.dtype.kind in 'iuf':
+        return pd.util.hash_array(values.astype(np.int64).to_numpy())
+    return pd.util.hash_array(values.astype(str).to_numpy(dtype=object))
+
+
+class HyperLogLog:
+    """
+    Distinct count sketch with REGISTERS one byte registers
+    """
+
+    def __init__(self, registers=None):
+        """
+        :param registers: numpy uint8 array to start from, empty if None
+        """
+        self.registers = np.zeros(REGISTERS, dtype=np.uint8) \
+            if registers is None else registers
+
+    def add_hashes(self, hashes):
+        """
+        Adds hashed values. The first PRECISION bits choose the register,
+        which keeps the highest position of the first set bit seen in the
+        remaining bits.
+        :param hashes: numpy array of uint64
+        :return:
+        """
+        if len(hashes) == 0:
+            return
+        index = (hashes >> np.uint64(64 - PRECISION)).astype(np.intp)
+        rest = hashes & np.uint64((1 << (64 - PRECISION)) - 1)
+        # rest has fewer than 53 bits, so it converts to float exactly and
+        # frexp returns its bit length
+        _, bit_length = np.frexp(rest.astype(np.float64))
+        rank = (64 - PRECISION + 1 - bit_length).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+
+    def merge(self, other):
+        """
+        Folds another sketch into this one
+        :param other: HyperLogLog
+        :return: self
+        """
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def estimate(self):
+        """
+        :return: estimated number of distinct values
+        """
+        m = REGISTERS
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / np.sum(
+            np.ldexp(1.0, -self.registers.astype(int))
+        )
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if raw <= 2.5 * m and zeros:
+            # linear counting is more accurate for small cardinalities
+            return m * np.log(m / zeros)
+        return float(raw)
+
+    def to_bytes(self):
+        """
+        Sparse encoding (register index and value pairs) while few registers
+        are set, one byte per register otherwise
+        :return: bytes
+        """
+        index = np.flatnonzero(self.registers)
+        if len(index) * 3 < REGISTERS:
+            return b'S' + index.astype('<u2').tobytes() + \
+                self.registers[index].tobytes()
+        return b'D' + self.registers.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        :param data: output of to_bytes
+        :return: HyperLogLog
+        """
+        data = bytes(data)
+        if data[:1] == b'D':
+            return cls(np.frombuffer(data[1:], dtype=np.uint8).copy())
+        count = (len(data) - 1) // 3
+        index = np.frombuffer(data[1:1 + 2 * count], dtype='<u2')
+        sketch = cls()
+        sketch.registers[index] = np.frombuffer(data[1 + 2 * count:],
+                                                dtype=np.uint8)
+        return sketch
+
+
+##############################################################################
+class SketchAggregator:
+    """
+    Keeps the sketches of the buckets touched since the last flush, which
+    merges them into distinct_sketches inside the current transaction
+    """
+
+    def __init__(self):
+        self.pending = {}
+
+    def update(self, songplays):
+        """
+        Folds songplays into the pending sketches
+        :param songplays: DataFrame with start_time, user_id, song_id and
+        artist_id columns
+        :return:
+        """
+        if songplays.empty:
+            return
+        buckets = {grain: bucket_of(songplays)
+                   for grain, bucket_of in GRAINS.items()}
+        for metric, column in METRICS.items():
+            # hash every value once, then split the hashes per bucket
+            values = songplays[column].dropna()
+            hashes = pd.Series(hash_values(values), index=values.index)
+            for grain, bucket in buckets.items():
+                for name, group in hashes.groupby(bucket, sort=False):
+                    key = (grain, str(name), metric)
+                    sketch = self.pending.get(key)
+                    if sketch is None:
+                        sketch = self.pending[key] = HyperLogLog()
+                    sketch.add_hashes(group.to_numpy())
+
+    def flush(self, cur):
+        """
+        Merges the pending sketches with the stored ones. The table is
+        locked against other writers until the transaction ends, so
+        concurrent loads (e.g. streaming.py next to etl.py) wait for each
+        other instead of overwriting each other's registers, also for
+        buckets neither has stored yet.
+        The pending sketches are dropped even if the write fails, a retry
+        folds the songplays in again.
+        :param cur: cursor to database
+        :return: number of sketches written
+        """
+        pending, self.pending = self.pending, {}
+        if not pending:
+            return 0
+        cur.execute(sketch_table_lock)
+        by_kind = {}
+        for grain, bucket, metric in pending:
+            by_kind.setdefault((grain, metric), []).append(bucket)
+        for (grain, metric), buckets in by_kind.items():
+            cur.execute(sketch_select, (grain, metric, sorted(buckets)))
+            for bucket, registers in cur.fetchall():
+                pending[(grain, bucket, metric)].merge(
+                    HyperLogLog.from_bytes(registers)
+                )
+        rows = [
+            (grain, bucket, metric, sketch.to_bytes())
+            for (grain, bucket, metric), sketch in sorted(pending.items())
+        ]
+        execute_batch(cur, sketch_upsert, rows, page_size=500)
+        return len(rows)
+
+
+##############################################################################
+# Query helpers
+
+def fetch_sketches(cur, grain, metric, first=None, last=None):
+    """
+    Loads the stored sketches of a bucket range
+    :param cur: cursor to database
+    :param grain: 'day', 'hour' or 'artist'
+    :param metric: 'users' or 'songs'
+    :param first: first bucket, e.g. '2018-11-01' for days, None for all
+    :param last: last bucket (inclusive), None for all
+    :return: dict of bucket to HyperLogLog
+    """
+    cur.execute(sketch_range_select, {
+        'grain': grain, 'metric': metric, 'first': first, 'last': last
+    })
+    return {bucket: HyperLogLog.from_bytes(registers)
+            for bucket, registers in cur.fetchall()}
+
+
+def distinct_count(cur, grain, metric, first=None, last=None, buckets=None):
+    """
+    Estimates the distinct users or songs over a range of buckets, e.g. the
+    unique listeners of a week from the day sketches
+    :param cur: cursor to database
+    :param grain: 'day', 'hour' or 'artist'
+    :param metric: 'users' or 'songs'
+    :param first: first bucket, None for all
+    :param last: last bucket (inclusive), None for all
+    :param buckets: only merge these buckets, e.g. a list of artist ids
+    :return: estimated distinct count
+    """
+    merged = HyperLogLog()
+    for bucket, sketch in fetch_sketches(cur, grain, metric, first,
+                                         last).items():
+        if buckets is None or bucket in buckets:
+            merged.merge(sketch)
+    return merged.estimate()
+
+
+def distinct_counts(cur, grain, metric, first=None, last=None):
+    """
+    Estimates the distinct users or songs of every bucket in a range, e.g.
+    the daily unique listeners
+    :param cur: cursor to database
+    :param grain: 'day', 'hour' or 'artist'
+    :param metric: 'users' or 'songs'
+    :param first: first bucket, None for all
+    :param last: last bucket (inclusive), None for all
+    :return: dict of bucket to estimated distinct count
+    """
+    return {bucket: sketch.estimate() for bucket, sketch in
+            fetch_sketches(cur, grain, metric, first, last).items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Estimates distinct users or songs from the sketches in "
+                    "sparkifydb."
+    )
+    parser.add_argument("metric", choices=sorted(METRICS))
+    parser.add_argument("--grain", choices=sorted(GRAINS), default='day')
+    parser.add_argument("--first", default=None,
+                        help="First bucket, e.g. 2018-11-01 or "
+                             "'2018-11-01 13'.")
+    parser.add_argument("--last", default=None,
+                        help="Last bucket (inclusive).")
+    parser.add_argument("--per-bucket", action="store_true",
+                        help="Print the estimate of every bucket instead of "
+                             "the merged range.")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(
+        "host=127.0.0.1 dbname=sparkifydb user=student password=student"
+    )
+    cur = conn.cursor()
+    if args.per_bucket:
+        for bucket, estimate in distinct_counts(
+                cur, args.grain, args.metric, args.first, args.last).items():
+            print(f"{bucket}\t{estimate:.0f}")
+    else:
+        estimate = distinct_count(cur, args.grain, args.metric, args.first,
+                                  args.last)
+        print(f"{estimate:.0f}")
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+import json
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from etl import MS_PER_HOUR, frame_rows, time_rows, user_rows
+from etl import match_songs, songplay_rows
+
+##############################################################################
+# CPU cost per event of turning NextSong events into the time, user and
+# songplay rows the writers take, without the database: the column
+# operations of etl.py against the former df.iterrows() loops, with the
+# song lookup answered from memory in both cases.
+
+DEFAULT_SIZES = [10000, 100000]
+
+
+def synthetic_events(num_events, match_ratio=0.2, seed=0):
+    """
+    Generates NextSong events with the columns of the Sparkify logs
+    :param num_events: number of events
+    :param match_ratio: share of played songs found in the songs table
+    :param seed: random seed
+    :return: tuple of (events, matches as returned by song_select)
+    """
+    rng = np.random.default_rng(seed)
+    num_users = max(100, num_events // 1000)
+    num_songs = max(500, num_events // 20)
+    user = rng.integers(1, num_users + 1, num_events)
+    song = np.minimum(rng.zipf(1.3, num_events) - 1, num_songs - 1)
+    lengths = rng.uniform(60, 600, num_songs).round(5)
+    events = pd.DataFrame({
+        'artist': [f"Artist {i % (num_songs // 5)}" for i in song],
+        'firstName': [f"First{i}" for i in user],
+        'gender': np.where(user % 2 == 0, 'F', 'M'),
+        'itemInSession': rng.integers(0, 100, num_events),
+        'lastName': [f"Last{i}" for i in user],
+        'length': lengths[song],
+        'level': rng.choice(['free', 'paid'], num_events),
+        'location': [f"City {i % 500}" for i in user],
+        'page': 'NextSong',
+        'sessionId': user * 10 + rng.integers(0, 10, num_events),
+        'song': [f"Song {i}" for i in song],
+        'ts': 1541030400000 + np.sort(
+            rng.integers(0, 30 * 86400000, num_events)),
+        'userAgent': rng.choice([
+            'Mozilla/5.0 (Windows NT 6.1; WOW64)',
+            'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4)',
+            'Mozilla/5.0 (X11; Linux x86_64)'
+        ], num_events),
+        'userId': user
+    })
+    matched = np.flatnonzero(rng.random(num_songs) < match_ratio)
+    matches = pd.DataFrame({
+        'song': [f"Song {i}" for i in matched],
+        'artist': [f"Artist {i % (num_songs // 5)}" for i in matched],
+        'length': lengths[matched],
+        'song_id': [f"SO{i:016d}" for i in matched],
+        'artist_id': [f"AR{i % (num_songs // 5):016d}" for i in matched]
+    })
+    return events, matches
+
+
+def prepare(events):
+    """
+    :param events: output of synthetic_events
+    :return: events as load_log_events converts them before the inserts
+    """
+    events = events.assign(time_key=events['ts'] // MS_PER_HOUR)
+    return events.astype({'ts': 'datetime64[ms]'})
+
+
+##############################################################################
+# The former loops of load_log_events, cur.execute replaced by appending the
+# rows and song_select by a dict lookup
+
+def iterrows_time(df):
+    time_data = []
+    for val in pd.Series(df['ts'], index=df.index):
+        time_data.append([val, val.hour, val.day, val.weekofyear, val.month,
+                          val.year, val.day_name()])
+    time_df = pd.DataFrame.from_records(data=time_data, columns=[
+        "timestamp", "hour", "day", "weekofyear", "month", "year", "weekday"
+    ])
+    return [list(row) for i, row in time_df.iterrows()]
+
+
+def iterrows_users(df):
+    user_df = df[['userId', 'firstName', 'lastName', 'gender', 'level']]
+    return [list(row) for i, row in user_df.iterrows()]
+
+
+def iterrows_songplays(df, lookup):
+    rows = []
+    for index, row in df.iterrows():
+        songid, artistid = lookup.get((row.song, row.artist, row.length),
+                                      (None, None))
+        rows.append((row.ts, row.time_key, row.userId, row.level, songid,
+                     artistid, row.sessionId, row.itemInSession,
+                     row.location, row.userAgent))
+    return rows
+
+
+##############################################################################
+def vectorized_time(df):
+    return frame_rows(time_rows(df['ts']))
+
+
+def vectorized_users(df):
+    return frame_rows(user_rows(df))
+
+
+def vectorized_songplays(df, matches):
+    return frame_rows(songplay_rows(df, match_songs(df, matches)))
+
+
+def best_seconds(func, args, repeat):
+    """
+    :param func: stage to time
+    :param args: its arguments
+    :param repeat: number of runs
+    :return: fastest run in seconds and the rows it returned
+    """
+    best, rows = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = func(*args)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best, rows
+
+
+def run_size(num_events, repeat):
+    """
+    Times every stage both ways on one number of events
+    :param num_events: number of NextSong events
+    :param repeat: number of runs per stage, the fastest counts
+    :return: dict with microseconds per event per stage and variant
+    """
+    events, matches = synthetic_events(num_events)
+    df = prepare(events)
+    lookup = {(song, artist, length): (song_id, artist_id)
+              for song, artist, length, song_id, artist_id
+              in matches.itertuples(index=False)}
+    stages = {
+        'time': ((iterrows_time, (df,)), (vectorized_time, (df,))),
+        'users': ((iterrows_users, (df,)), (vectorized_users, (df,))),
+        'songplays': ((iterrows_songplays, (df, lookup)),
+                      (vectorized_songplays, (df, matches)))
+    }
+    result = {'events': num_events, 'stages': {}}
+    for name, ((old, old_args), (new, new_args)) in stages.items():
+        old_seconds, old_rows = best_seconds(old, old_args, repeat)
+        new_seconds, new_rows = best_seconds(new, new_args, repeat)
+        result['stages'][name] = {
+            'iterrows_us': old_seconds / num_events * 1e6,
+            'vectorized_us': new_seconds / num_events * 1e6,
+            'iterrows_rows': len(old_rows),
+            'vectorized_rows': len(new_rows)
+        }
+    if [list(r) for r in iterrows_songplays(df, lookup)] != \
+            vectorized_songplays(df, matches):
+        raise AssertionError("vectorized songplays differ from iterrows")
+    return result
+
+
+def print_result(result):
+    """
+    Prints the per event cost of one size
+    :param result: output of run_size
+    :return:
+    """
+    print(f"\n{result['events']} events")
+    print(f"  {'stage':<10} {'iterrows us/ev':>15} {'vector us/ev':>13}"
+          f" {'speedup':>8} {'rows':>15}")
+    for name, r in result['stages'].items():
+        print(f"  {name:<10} {r['iterrows_us']:>15.2f}"
+              f" {r['vectorized_us']:>13.2f}"
+              f" {r['iterrows_us'] / r['vectorized_us']:>7.0f}x"
+              f" {r['iterrows_rows']:>7}/{r['vectorized_rows']:<7}")
+    old = sum(r['iterrows_us'] for r in result['stages'].values())
+    new = sum(r['vectorized_us'] for r in result['stages'].values())
+    print(f"  {'total':<10} {old:>15.2f} {new:>13.2f} {old / new:>7.0f}x"
+          f"  ({1e6 / old:,.0f} vs {1e6 / new:,.0f} events/s per core)")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measures the CPU cost per event of assembling time, "
+                    "user and songplay rows with df.iterrows() and with "
+                    "column operations."
+    )
+    parser.add_argument("--sizes", type=int, nargs='+',
+                        default=DEFAULT_SIZES,
+                        help="Numbers of NextSong events.")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Runs per stage, the fastest counts.")
+    parser.add_argument("--json", default=None,
+                        help="Write the results to this file.")
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        results.append(run_size(size, args.repeat))
+        print_result(results[-1])
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,12 @@ user_table_drop = "DROP TABLE IF EXISTS users"
 song_table_drop = "DROP TABLE IF EXISTS songs"
 artist_table_drop = "DROP TABLE IF EXISTS artists"
 time_table_drop = "DROP TABLE IF EXISTS time"
+time_hour_table_drop = "DROP TABLE IF EXISTS time_hours"
+load_version_table_drop = "DROP TABLE IF EXISTS load_version"
+session_table_drop = "DROP TABLE IF EXISTS sessions"
+load_files_table_drop = "DROP TABLE IF EXISTS load_files"
+stream_offset_table_drop = "DROP TABLE IF EXISTS stream_offsets"
+sketch_table_drop = "DROP TABLE IF EXISTS distinct_sketches"
 
 ##############################################################################
 # Queries to create tables
@@ -14,15 +20,19 @@ songplay_table_create = ("""
     CREATE TABLE IF NOT EXISTS songplays(
         songplay_id SERIAL PRIMARY KEY,
         start_time TIMESTAMP NOT NULL REFERENCES time (start_time),
+        time_key INT NOT NULL REFERENCES time_hours (time_key),
         user_id INT NOT NULL REFERENCES users (user_id),
         level VARCHAR,
         song_id VARCHAR REFERENCES songs (song_id),
         artist_id VARCHAR REFERENCES artists (artist_id),
         session_id INT,
+        item_in_session INT NOT NULL,
         location VARCHAR,
-        user_agent TEXT
+        user_agent TEXT,
+        UNIQUE (user_id, session_id, item_in_session, start_time)
     )
-""")
+""")  # songplay_id is a surrogate key, the unique event key lets a rerun of
+# a log file insert only the plays that are not loaded yet
 
 user_table_create = ("""
     CREATE TABLE IF NOT EXISTS users(
@@ -66,14 +76,90 @@ time_table_create = ("""
     )
 """)
 
+time_hour_table_create = ("""
+    CREATE TABLE IF NOT EXISTS time_hours(
+        time_key INT PRIMARY KEY,
+        hour_start TIMESTAMP NOT NULL,
+        hour INT,
+        day INT,
+        week INT,
+        month INT,
+        year INT,
+        weekday VARCHAR
+    )
+""")  # Compact time dimension, one row per hour. time_key is ts // 3600000,
+# the hours since the epoch, and songplays carries it next to start_time so
+# hourly and calendar reports join on an integer against a few thousand rows
+# instead of on the millisecond start_time against one time row per event
+
+session_table_create = ("""
+    CREATE TABLE IF NOT EXISTS sessions(
+        session_id INT NOT NULL,
+        user_id INT NOT NULL,
+        start_time TIMESTAMP NOT NULL,
+        end_time TIMESTAMP NOT NULL,
+        num_events INT NOT NULL,
+        num_songs INT NOT NULL,
+        first_play_time TIMESTAMP,
+        last_item_in_session INT,
+        event_items INT[] NOT NULL,
+        song_items INT[] NOT NULL,
+        PRIMARY KEY (session_id, user_id)
+    )
+""")  # Session length is end_time - start_time, time to first play is
+# first_play_time - start_time. event_items and song_items hold the distinct
+# item_in_session values seen, num_events and num_songs are their sizes.
+
+load_version_table_create = ("""
+    CREATE TABLE IF NOT EXISTS load_version(
+        id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+        version BIGINT NOT NULL,
+        updated_at TIMESTAMP NOT NULL DEFAULT now()
+    )
+""")  # Single row table, bumped by the ETL on every commit so readers can
+# tell whether cached query results are still current
+
+load_files_table_create = ("""
+    CREATE TABLE IF NOT EXISTS load_files(
+        file_path VARCHAR PRIMARY KEY,
+        version BIGINT NOT NULL,
+        rows INT NOT NULL,
+        loaded_at TIMESTAMP NOT NULL DEFAULT now()
+    )
+""")  # Files loaded by the ETL, written in the transaction that loaded them.
+# version is the load version that transaction committed.
+
+stream_offset_table_create = ("""
+    CREATE TABLE IF NOT EXISTS stream_offsets(
+        file_path VARCHAR PRIMARY KEY,
+        byte_offset BIGINT NOT NULL,
+        updated_at TIMESTAMP NOT NULL DEFAULT now()
+    )
+""")  # Position up to which streaming.py loaded a tailed file, written in
+# the transaction of the micro-batch that read it
+
+sketch_table_create = ("""
+    CREATE TABLE IF NOT EXISTS distinct_sketches(
+        grain VARCHAR NOT NULL,
+        bucket VARCHAR NOT NULL,
+        metric VARCHAR NOT NULL,
+        registers BYTEA NOT NULL,
+        PRIMARY KEY (grain, metric, bucket)
+    )
+""")  # HyperLogLog sketches of the distinct users and songs in songplays
+# (sketches.py). grain is day, hour or artist and bucket is 'YYYY-MM-DD',
+# 'YYYY-MM-DD HH' or the artist_id, so ranges of days and hours sort as text
+
 ##############################################################################
 # Queries to insert records
 
 songplay_table_insert = ("""
-    INSERT INTO songplays (start_time, user_id, level, song_id, 
-    artist_id, session_id, location, user_agent)
-    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-""")
+    INSERT INTO songplays (start_time, time_key, user_id, level, song_id, 
+    artist_id, session_id, item_in_session, location, user_agent)
+    VALUES %s
+    ON CONFLICT (user_id, session_id, item_in_session, start_time) DO NOTHING
+    RETURNING songplay_id
+""")  # filled by execute_values, the returned ids count the plays inserted
 
 user_table_insert = ("""
     INSERT INTO users (user_id, first_name, last_name, gender, level) 
@@ -103,16 +189,118 @@ time_table_insert = ("""
 """)  # We added On Conflict do nothing as without this it will give error for
 # duplicate values
 
+time_hour_table_insert = ("""
+    INSERT INTO time_hours (time_key, hour_start, hour, day, week, month,
+    year, weekday)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+    ON CONFLICT (time_key) DO NOTHING
+""")
+
+session_table_upsert = ("""
+    INSERT INTO sessions (session_id, user_id, start_time, end_time,
+    num_events, num_songs, first_play_time, last_item_in_session,
+    event_items, song_items)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    ON CONFLICT (session_id, user_id) DO UPDATE SET
+    start_time = LEAST(sessions.start_time, EXCLUDED.start_time),
+    end_time = GREATEST(sessions.end_time, EXCLUDED.end_time),
+    num_events = cardinality(ARRAY(
+        SELECT DISTINCT unnest(sessions.event_items || EXCLUDED.event_items)
+    )),
+    num_songs = cardinality(ARRAY(
+        SELECT DISTINCT unnest(sessions.song_items || EXCLUDED.song_items)
+    )),
+    first_play_time = LEAST(sessions.first_play_time,
+                            EXCLUDED.first_play_time),
+    last_item_in_session = GREATEST(sessions.last_item_in_session,
+                                    EXCLUDED.last_item_in_session),
+    event_items = ARRAY(
+        SELECT DISTINCT unnest(sessions.event_items || EXCLUDED.event_items)
+        ORDER BY 1
+    ),
+    song_items = ARRAY(
+        SELECT DISTINCT unnest(sessions.song_items || EXCLUDED.song_items)
+        ORDER BY 1
+    )
+""")  # Rows are per file deltas, merging them here lets a session span
+# several files. Counts come from the union of the items, every event has
+# its own item_in_session, so loading the same events again changes nothing.
+
+load_version_insert = ("""
+    INSERT INTO load_version (version) VALUES (0)
+    ON CONFLICT (id) DO NOTHING
+""")
+
+load_version_bump = ("""
+    UPDATE load_version SET version = version + 1, updated_at = now()
+    RETURNING version
+""")
+
+load_file_insert = ("""
+    INSERT INTO load_files (file_path, version, rows)
+    VALUES (%s, %s, %s)
+    ON CONFLICT (file_path) DO UPDATE SET
+    version = EXCLUDED.version,
+    rows = EXCLUDED.rows,
+    loaded_at = now()
+""")
+
+stream_offset_upsert = ("""
+    INSERT INTO stream_offsets (file_path, byte_offset)
+    VALUES (%s, %s)
+    ON CONFLICT (file_path) DO UPDATE SET
+    byte_offset = EXCLUDED.byte_offset,
+    updated_at = now()
+""")
+
+sketch_table_lock = ("""
+    LOCK TABLE distinct_sketches IN SHARE ROW EXCLUSIVE MODE
+""")  # one writer at a time until commit, readers are not blocked
+
+sketch_upsert = ("""
+    INSERT INTO distinct_sketches (grain, bucket, metric, registers)
+    VALUES (%s, %s, %s, %s)
+    ON CONFLICT (grain, metric, bucket) DO UPDATE SET
+    registers = EXCLUDED.registers
+""")  # registers already hold the merge with the stored sketch
+
 ##############################################################################
 # Query to find songs
 
 song_select = ("""
-    SELECT song_id, artists.artist_id
-    FROM songs 
+    SELECT events.title, events.name, events.duration,
+    songs.song_id, artists.artist_id
+    FROM unnest(%s::VARCHAR[], %s::VARCHAR[], %s::FLOAT[])
+    AS events (title, name, duration)
+    JOIN songs ON songs.title = events.title
+    AND songs.duration = events.duration
     JOIN artists ON songs.artist_id = artists.artist_id
-    WHERE songs.title = %s
-    AND artists.name = %s
-    AND songs.duration = %s
+    AND artists.name = events.name
+""")  # looks up every distinct (song, artist, length) of a batch at once
+
+load_version_select = ("""
+    SELECT version, updated_at FROM load_version
+""")  # version restarts at 0 when create_tables.py rebuilds the database,
+# updated_at tells the builds apart
+
+loaded_files_select = ("""
+    SELECT file_path FROM load_files
+""")
+
+stream_offsets_select = ("""
+    SELECT file_path, byte_offset FROM stream_offsets
+""")
+
+sketch_select = ("""
+    SELECT bucket, registers FROM distinct_sketches
+    WHERE grain = %s AND metric = %s AND bucket = ANY(%s)
+""")
+
+sketch_range_select = ("""
+    SELECT bucket, registers FROM distinct_sketches
+    WHERE grain = %(grain)s AND metric = %(metric)s
+    AND (%(first)s IS NULL OR bucket >= %(first)s)
+    AND (%(last)s IS NULL OR bucket <= %(last)s)
 """)
 
 ##############################################################################
@@ -123,15 +311,27 @@ create_table_queries = [
     artist_table_create,
     song_table_create,
     time_table_create,
-    songplay_table_create
+    time_hour_table_create,
+    songplay_table_create,
+    session_table_create,
+    load_version_table_create,
+    load_files_table_create,
+    stream_offset_table_create,
+    sketch_table_create
 ]
 
 drop_table_queries = [
+    session_table_drop,
     songplay_table_drop,
     user_table_drop,
     song_table_drop,
     artist_table_drop,
-    time_table_drop
+    time_table_drop,
+    time_hour_table_drop,
+    load_version_table_drop,
+    load_files_table_drop,
+    stream_offset_table_drop,
+    sketch_table_drop
 ]
 
 
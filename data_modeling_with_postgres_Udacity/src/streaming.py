@@ -0,0 +1,545 @@
+import os
+import json
+import time
+import socket
+import argparse
+import selectors
+from collections import deque
+import numpy as np
+import pandas as pd
+import psycopg2
+from psycopg2.extras import execute_batch
+from sql_queries import load_version_bump, stream_offset_upsert
+from sql_queries import stream_offsets_select
+from sessions import SessionAggregator
+from sketches import SketchAggregator
+from etl import process_log_events
+
+##############################################################################
+# Streaming ingestion. Tails NDJSON event files in a landing directory and/or
+# reads NDJSON lines sent to a local TCP socket, groups the events into
+# micro-batches and loads every batch in one transaction through the same
+# stages as etl.process_log_file. A batch is cut when it holds as many
+# events as the recent load rate commits in half the latency target (at most
+# max_batch_events) or when its oldest event waited as long as the latency
+# target leaves after the recent batch load times.
+
+REQUIRED_FIELDS = ('page', 'ts', 'sessionId', 'itemInSession', 'userId')
+
+
+class DirectorySource:
+    """
+    Tails the plain .json files below a directory, new files and lines
+    appended to known files alike. Only complete lines are read, a line
+    still being written is picked up on a later poll. The last line of a
+    file without a trailing newline counts as complete once the file was
+    not modified for settle_seconds.
+    """
+
+    def __init__(self, path, offsets=None, chunk_bytes=2 ** 20,
+                 settle_seconds=1.0):
+        """
+        :param path: landing directory
+        :param offsets: dict of file path to the byte offset already loaded
+        :param chunk_bytes: bytes read from a file at a time
+        :param settle_seconds: age after which an unterminated last line is
+        read
+        """
+        self.path = path
+        self.offsets = dict(offsets or {})
+        self.chunk_bytes = chunk_bytes
+        self.settle_seconds = settle_seconds
+
+    def files(self):
+        """
+        :return: sorted paths of the .json files below the directory
+        """
+        found = []
+        for root, dirs, files in os.walk(self.path):
+            found.extend(os.path.join(os.path.abspath(root), f)
+                         for f in files if f.endswith('.json'))
+        return sorted(found)
+
+    def read(self, limit):
+        """
+        Reads up to limit complete lines, advancing the read offsets
+        :param limit: maximum number of lines
+        :return: list of lines as bytes
+        """
+        lines = []
+        for path in self.files():
+            if len(lines) >= limit:
+                break
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                continue
+            offset = self.offsets.get(path, 0)
+            if size < offset:
+                # truncated or replaced, start over
+                offset = 0
+            if size == offset:
+                continue
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                buffer, eof = b'', False
+                while len(lines) < limit:
+                    chunk = f.read(self.chunk_bytes)
+                    if not chunk:
+                        eof = True
+                        break
+                    parts = (buffer + chunk).split(b'\n')
+                    buffer = parts.pop()
+                    taken = parts[:limit - len(lines)]
+                    for line in taken:
+                        offset += len(line) + 1
+                        if line.strip():
+                            lines.append(line)
+                    if len(taken) < len(parts):
+                        break
+                if eof and buffer.strip() and \
+                        time.time() - os.path.getmtime(path) >= \
+                        self.settle_seconds:
+                    offset += len(buffer)
+                    lines.append(buffer)
+            self.offsets[path] = offset
+        return lines
+
+    def positions(self):
+        """
+        :return: dict of file path to the offset read so far, stored with
+        the batch that contains the lines up to it
+        """
+        return dict(self.offsets)
+
+
+class SocketSource:
+    """
+    Accepts TCP connections on a local port and reads NDJSON lines from
+    them. Lines are not acknowledged, producers that need delivery
+    guarantees should write to the landing directory.
+    """
+
+    def __init__(self, host, port):
+        """
+        :param host: interface to listen on
+        :param port: port to listen on
+        """
+        self.server = socket.create_server((host, port))
+        self.server.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.server, selectors.EVENT_READ)
+        self.buffers = {}
+        self.lines = deque()
+
+    def _receive(self):
+        for key, _ in self.selector.select(timeout=0):
+            if key.fileobj is self.server:
+                conn, _ = self.server.accept()
+                conn.setblocking(False)
+                self.selector.register(conn, selectors.EVENT_READ)
+                self.buffers[conn] = b''
+                continue
+            conn = key.fileobj
+            try:
+                data = conn.recv(2 ** 16)
+            except ConnectionError:
+                data = b''
+            parts = (self.buffers[conn] + data).split(b'\n')
+            self.buffers[conn] = parts.pop()
+            if not data:
+                # connection closed, an unterminated last line still counts
+                parts.append(self.buffers.pop(conn))
+                self.selector.unregister(conn)
+                conn.close()
+            self.lines.extend(line for line in parts if line.strip())
+
+    def read(self, limit):
+        """
+        Reads up to limit complete lines received so far
+        :param limit: maximum number of lines
+        :return: list of lines as bytes
+        """
+        self._receive()
+        return [self.lines.popleft()
+                for _ in range(min(limit, len(self.lines)))]
+
+    def positions(self):
+        return {}
+
+    def close(self):
+        for conn in list(self.buffers):
+            conn.close()
+        self.server.close()
+
+
+def parse_events(lines):
+    """
+    Parses NDJSON lines, skipping malformed lines and events without the
+    fields the load needs
+    :param lines: list of lines as bytes
+    :return: tuple of (DataFrame of events, number of rejected lines)
+    """
+    records, rejected = [], 0
+    for line in lines:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            rejected += 1
+            continue
+        if not isinstance(record, dict) or \
+                any(record.get(f) is None for f in REQUIRED_FIELDS):
+            rejected += 1
+            continue
+        records.append(record)
+    return pd.DataFrame.from_records(records), rejected
+
+
+##############################################################################
+class StreamMetrics:
+    """
+    Lag and throughput of the last window_seconds of micro-batches. Lag is
+    the time from reading an event to committing it, event lag the time
+    from the event's ts to the commit.
+    """
+
+    def __init__(self, latency_target, window_seconds=60.0,
+                 metrics_file=None):
+        """
+        :param latency_target: end-to-end latency target in seconds
+        :param window_seconds: length of the rolling window
+        :param metrics_file: append one json line per batch to this file
+        """
+        self.latency_target = latency_target
+        self.window_seconds = window_seconds
+        self.metrics_file = metrics_file
+        self.batches = deque()
+        self.total_events = 0
+        self.total_rejected = 0
+
+    def record(self, events, rejected, arrivals, max_ts, load_seconds,
+               committed_at):
+        """
+        Records a committed micro-batch
+        :param events: events loaded
+        :param rejected: lines rejected by parse_events
+        :param arrivals: times the lines were read, time.time() seconds
+        :param max_ts: latest event ts in milliseconds, or None
+        :param load_seconds: time spent parsing, loading and committing
+        :param committed_at: time.time() of the commit
+        :return:
+        """
+        lags = committed_at - np.asarray(arrivals)
+        batch = {
+            'committed_at': committed_at,
+            'events': events,
+            'rejected': rejected,
+            'load_seconds': load_seconds,
+            'lag_p50': float(np.percentile(lags, 50)),
+            'lag_max': float(lags.max()),
+            'event_lag': None if max_ts is None
+            else committed_at - max_ts / 1000
+        }
+        self.batches.append(batch)
+        self.total_events += events
+        self.total_rejected += rejected
+        while self.batches and \
+                committed_at - self.batches[0]['committed_at'] > \
+                self.window_seconds:
+            self.batches.popleft()
+        if self.metrics_file:
+            with open(self.metrics_file, 'a') as f:
+                f.write(json.dumps(batch) + '\n')
+
+    def load_estimate(self):
+        """
+        :return: 95th percentile of the recent batch load times in seconds
+        """
+        if not self.batches:
+            return 0.0
+        return float(np.percentile(
+            [b['load_seconds'] for b in self.batches], 95))
+
+    def batch_limit(self, max_batch_events):
+        """
+        Number of events the recent load rate commits in half the latency
+        target, the other half is left for waiting and polling. Without
+        recent batches a small first batch measures the rate.
+        :param max_batch_events: upper bound
+        :return: events
+        """
+        seconds = sum(b['load_seconds'] for b in self.batches)
+        events = sum(b['events'] + b['rejected'] for b in self.batches)
+        if not seconds or not events:
+            return min(max_batch_events, 100)
+        return max(1, min(max_batch_events,
+                          int(events / seconds * self.latency_target / 2)))
+
+    def max_wait(self, poll_interval):
+        """
+        How long the oldest buffered event may wait before its batch is cut,
+        so that waiting, polling and loading stay within the latency target
+        :param poll_interval: sleep between polls of idle sources
+        :return: seconds
+        """
+        return max(0.0, self.latency_target - self.load_estimate() -
+                   poll_interval)
+
+    def summary(self):
+        """
+        :return: report line for the rolling window
+        """
+        if not self.batches:
+            return "no batches in the last window"
+        span = self.batches[-1]['committed_at'] - \
+            self.batches[0]['committed_at'] + \
+            self.batches[0]['load_seconds']
+        events = sum(b['events'] for b in self.batches)
+        lag_max = max(b['lag_max'] for b in self.batches)
+        lag_p50 = float(np.median([b['lag_p50'] for b in self.batches]))
+        status = 'ok' if lag_max <= self.latency_target else 'MISSED'
+        return (f"{events / span:,.0f} events/s over {len(self.batches)} "
+                f"batches, lag p50 {lag_p50:.2f}s max {lag_max:.2f}s "
+                f"(target {self.latency_target:.2f}s {status}), load p95 "
+                f"{self.load_estimate():.2f}s, {self.total_events} events "
+                f"{self.total_rejected} rejected in total")
+
+
+##############################################################################
+def connect():
+    return psycopg2.connect(
+        "host=127.0.0.1 dbname=sparkifydb user=student password=student"
+    )
+
+
+def is_transient(error):
+    """
+    Tells failures worth retrying (lost connection, serialization failure,
+    deadlock) from errors in the data, which fail again on every retry
+    :param error: exception raised while loading a batch
+    :return: bool
+    """
+    if isinstance(error, psycopg2.extensions.QueryCanceledError):
+        return False
+    return isinstance(error, (psycopg2.OperationalError,
+                              psycopg2.InterfaceError))
+
+
+def load_lines(cur, lines, sessions, sketches, dead_letters):
+    """
+    Loads lines inside a savepoint. When they fail for a reason other than
+    a transient one, the savepoint is rolled back and both halves are
+    loaded on their own, until the lines that fail alone are found and set
+    aside as dead letters.
+    :param cur: cursor to database
+    :param lines: list of lines as bytes
+    :param sessions: SessionAggregator
+    :param sketches: SketchAggregator
+    :param dead_letters: list the failing (line, error) pairs are added to
+    :return: tuple of (events loaded, lines rejected by parse_events,
+    latest event ts)
+    """
+    df, rejected = parse_events(lines)
+    if df.empty:
+        return 0, rejected, None
+    cur.execute("SAVEPOINT micro_batch")
+    try:
+        process_log_events(cur, df, sessions, sketches)
+        cur.execute("RELEASE SAVEPOINT micro_batch")
+        return len(df), rejected, int(df['ts'].max())
+    except Exception as e:
+        if is_transient(e):
+            raise
+        cur.execute("ROLLBACK TO SAVEPOINT micro_batch")
+        cur.execute("RELEASE SAVEPOINT micro_batch")
+        # the aggregators drop what they held for the failed lines
+        sessions.pending, sketches.pending = {}, {}
+        if len(lines) == 1:
+            dead_letters.append((lines[0], f"{type(e).__name__}: {e}"))
+            return 0, 0, None
+    half = len(lines) // 2
+    first = load_lines(cur, lines[:half], sessions, sketches, dead_letters)
+    second = load_lines(cur, lines[half:], sessions, sketches, dead_letters)
+    max_ts = [ts for ts in (first[2], second[2]) if ts is not None]
+    return (first[0] + second[0], first[1] + second[1],
+            max(max_ts) if max_ts else None)
+
+
+def load_batch(conn, lines, positions, sessions, sketches,
+               dead_letter_file=None):
+    """
+    Loads a micro-batch and the file offsets it reached in one transaction.
+    Lines the database rejects do not hold up the stream, they are left
+    out of the batch and appended to dead_letter_file.
+    :param conn: connection to database
+    :param lines: list of lines as bytes
+    :param positions: dict of file path to byte offset
+    :param sessions: SessionAggregator
+    :param sketches: SketchAggregator
+    :param dead_letter_file: file the rejected lines are appended to, one
+    json object with the line and the error each, None only counts them
+    :return: tuple of (events loaded, lines rejected, latest event ts)
+    """
+    cur = conn.cursor()
+    dead_letters = []
+    events, rejected, max_ts = load_lines(cur, lines, sessions, sketches,
+                                          dead_letters)
+    execute_batch(cur, stream_offset_upsert, list(positions.items()))
+    cur.execute(load_version_bump)
+    conn.commit()
+
+    for line, error in dead_letters:
+        print(f"Rejected line, {error}".rstrip())
+    if dead_letters and dead_letter_file:
+        with open(dead_letter_file, 'a') as f:
+            for line, error in dead_letters:
+                f.write(json.dumps({
+                    'line': line.decode('utf-8', 'replace').rstrip('\n'),
+                    'error': error
+                }) + '\n')
+    return events, rejected + len(dead_letters), max_ts
+
+
+def run(sources, latency_target=2.0, max_batch_events=5000,
+        poll_interval=0.1, report_every=10.0, metrics_file=None,
+        duration=None, dead_letter_file=None):
+    """
+    Polls the sources and loads micro-batches until interrupted. A batch
+    failing for a transient reason is retried with backoff, the directory
+    offsets only advance with a committed batch.
+    :param sources: DirectorySource and/or SocketSource
+    :param latency_target: end-to-end latency target in seconds
+    :param max_batch_events: cut a batch at this many events
+    :param poll_interval: sleep between polls when no new line arrived
+    :param report_every: seconds between metric reports
+    :param metrics_file: append one json line per batch to this file
+    :param duration: stop after this many seconds, None runs until
+    interrupted
+    :param dead_letter_file: append the lines the database rejects to this
+    file
+    :return: StreamMetrics
+    """
+    conn = connect()
+    sessions = SessionAggregator()
+    sketches = SketchAggregator()
+    metrics = StreamMetrics(latency_target, metrics_file=metrics_file)
+    lines, arrivals = [], []
+    started = last_report = time.time()
+
+    def flush():
+        nonlocal conn
+        backoff = 1.0
+        while True:
+            start = time.time()
+            try:
+                if conn.closed:
+                    conn = connect()
+                positions = {}
+                for source in sources:
+                    positions.update(source.positions())
+                events, rejected, max_ts = load_batch(
+                    conn, lines, positions, sessions, sketches,
+                    dead_letter_file
+                )
+                break
+            except psycopg2.Error as e:
+                if not is_transient(e):
+                    raise
+                if not conn.closed:
+                    conn.rollback()
+                print(f"Batch of {len(lines)} lines failed, retrying in "
+                      f"{backoff:.0f}s: {e}".rstrip())
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+        now = time.time()
+        metrics.record(events, rejected, arrivals, max_ts, now - start, now)
+
+    try:
+        while duration is None or time.time() - started < duration:
+            received = 0
+            limit = metrics.batch_limit(max_batch_events)
+            for source in sources:
+                new = source.read(max(0, limit - len(lines)))
+                arrivals.extend([time.time()] * len(new))
+                lines.extend(new)
+                received += len(new)
+
+            if lines and (len(lines) >= limit or
+                          time.time() - arrivals[0] >=
+                          metrics.max_wait(poll_interval)):
+                flush()
+                lines, arrivals = [], []
+            elif not received:
+                time.sleep(poll_interval)
+
+            if time.time() - last_report >= report_every:
+                print(metrics.summary())
+                last_report = time.time()
+        if lines:
+            flush()
+    except KeyboardInterrupt:
+        # lines read but not committed are read again on the next start
+        pass
+    finally:
+        for source in sources:
+            if isinstance(source, SocketSource):
+                source.close()
+        conn.close()
+    print(metrics.summary())
+    return metrics
+
+
+def committed_offsets():
+    """
+    :return: dict of file path to the byte offset committed so far
+    """
+    conn = connect()
+    cur = conn.cursor()
+    cur.execute(stream_offsets_select)
+    offsets = dict(cur.fetchall())
+    conn.close()
+    return offsets
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Streams log events from a landing directory and/or a "
+                    "local socket into sparkifydb in micro-batches."
+    )
+    parser.add_argument("--landing-dir", default=None,
+                        help="Directory whose .json files are tailed.")
+    parser.add_argument("--socket", default=None, metavar="HOST:PORT",
+                        help="Accept NDJSON lines on this TCP address.")
+    parser.add_argument("--latency-target", type=float, default=2.0,
+                        help="Seconds from reading an event to its commit.")
+    parser.add_argument("--max-batch-events", type=int, default=5000,
+                        help="Cut a micro-batch at this many events.")
+    parser.add_argument("--poll-interval", type=float, default=0.1,
+                        help="Seconds between polls of idle sources.")
+    parser.add_argument("--report-every", type=float, default=10.0,
+                        help="Seconds between lag and throughput reports.")
+    parser.add_argument("--metrics-file", default=None,
+                        help="Append one json line per batch to this file.")
+    parser.add_argument("--duration", type=float, default=None,
+                        help="Stop after this many seconds.")
+    parser.add_argument("--dead-letter-file", default=None,
+                        help="Append lines the database rejects to this "
+                             "file.")
+    args = parser.parse_args()
+
+    sources = []
+    if args.landing_dir:
+        sources.append(DirectorySource(args.landing_dir, committed_offsets()))
+    if args.socket:
+        host, port = args.socket.rsplit(':', 1)
+        sources.append(SocketSource(host, int(port)))
+    if not sources:
+        parser.error("give --landing-dir and/or --socket")
+
+    run(sources, args.latency_target, args.max_batch_events,
+        args.poll_interval, args.report_every, args.metrics_file,
+        args.duration, args.dead_letter_file)
+
+
+if __name__ == '__main__':
+    main()
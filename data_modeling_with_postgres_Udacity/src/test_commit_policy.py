@@ -0,0 +1,79 @@
+import pytest
+import commit_policy
+from commit_policy import CommitPolicy
+
+
+class Clock:
+    """
+    Stands in for time.perf_counter, advanced by the tests
+    """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(commit_policy.time, 'perf_counter', clock)
+    return clock
+
+
+def run_batch(policy, clock, work_seconds, commit_seconds, rows=10,
+              num_bytes=1000):
+    """
+    Adds files until the policy commits, then reports the commit
+    :return: number of files in the batch
+    """
+    files = 0
+    while True:
+        files += 1
+        policy.add(f"file{files}.json", rows, num_bytes)
+        clock.now += work_seconds
+        if policy.should_commit():
+            break
+    clock.now += commit_seconds
+    policy.committed(commit_seconds)
+    return files
+
+
+def test_batch_grows_while_commits_dominate(clock):
+    policy = CommitPolicy(max_files=16)
+    sizes = [run_batch(policy, clock, 0.001, 0.01) for _ in range(6)]
+    assert sizes == [1, 2, 4, 8, 16, 16]
+
+
+def test_batch_shrinks_when_commits_get_cheap(clock):
+    policy = CommitPolicy()
+    for _ in range(4):
+        run_batch(policy, clock, 0.001, 0.01)
+    assert policy.batch_files == 16
+    sizes = [run_batch(policy, clock, 0.05, 0.001) for _ in range(5)]
+    assert sizes == [16, 8, 4, 2, 1]
+    assert policy.batch_files == 1
+
+
+def test_batch_stays_inside_the_target_band(clock):
+    policy = CommitPolicy()
+    policy.batch_files = 4
+    # commits take 0.01 / (4 * 0.04 + 0.01) = 6% of the batch time
+    run_batch(policy, clock, 0.04, 0.01)
+    assert policy.batch_files == 4
+
+
+@pytest.mark.parametrize('limits, rows, num_bytes, work_seconds', [
+    ({'max_rows': 25}, 10, 1000, 0.001),
+    ({'max_bytes': 2500}, 1, 1000, 0.001),
+    ({'max_seconds': 0.25}, 1, 1000, 0.1)
+])
+def test_limit_cuts_batch_and_resets_file_count(clock, limits, rows,
+                                                num_bytes, work_seconds):
+    policy = CommitPolicy(**limits)
+    policy.batch_files = 64
+    files = run_batch(policy, clock, work_seconds, 0.0001, rows, num_bytes)
+    assert files == 3
+    assert policy.batch_files == 3
+    assert policy.files == [] and policy.rows == 0 and policy.bytes == 0
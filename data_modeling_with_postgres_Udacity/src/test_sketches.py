@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sketches import HyperLogLog, SketchAggregator, hash_values, REGISTERS
+
+# standard error of an estimate, the tests allow four of them
+STANDARD_ERROR = 1.04 / np.sqrt(REGISTERS)
+
+
+def sketch_of(values):
+    sketch = HyperLogLog()
+    sketch.add_hashes(hash_values(pd.Series(np.asarray(values))))
+    return sketch
+
+
+@pytest.mark.parametrize('num_distinct', [1, 50, 1000, 20000, 300000])
+def test_estimate_is_within_expected_error(num_distinct):
+    rng = np.random.default_rng(num_distinct)
+    # every id drawn about three times, as repeated plays of a user
+    ids = rng.integers(0, num_distinct, 3 * num_distinct)
+    ids[:num_distinct] = np.arange(num_distinct)
+    exact = pd.Series(ids).nunique()
+
+    estimate = sketch_of(ids).estimate()
+
+    assert abs(estimate - exact) <= 4 * STANDARD_ERROR * exact + 0.5
+
+
+def test_song_ids_are_hashed_as_strings():
+    ids = [f"SO{i:016d}" for i in range(5000)]
+    estimate = sketch_of(ids * 2).estimate()
+    assert abs(estimate - 5000) <= 4 * STANDARD_ERROR * 5000
+
+
+def test_merge_equals_sketch_of_union():
+    rng = np.random.default_rng(0)
+    first = rng.integers(0, 40000, 30000)
+    second = rng.integers(20000, 60000, 30000)
+
+    merged = sketch_of(first).merge(sketch_of(second))
+
+    union = sketch_of(np.concatenate([first, second]))
+    assert np.array_equal(merged.registers, union.registers)
+    assert merged.estimate() == union.estimate()
+
+
+def test_adding_values_again_changes_nothing():
+    sketch = sketch_of(range(1000))
+    registers = sketch.registers.copy()
+    sketch.add_hashes(hash_values(pd.Series(range(1000))))
+    assert np.array_equal(sketch.registers, registers)
+
+
+@pytest.mark.parametrize('num_distinct, encoding', [
+    (0, b'S'), (10, b'S'), (1000, b'S'), (100000, b'D')
+])
+def test_serialization_round_trips(num_distinct, encoding):
+    sketch = sketch_of(range(num_distinct))
+
+    data = sketch.to_bytes()
+    restored = HyperLogLog.from_bytes(memoryview(data))
+
+    assert data[:1] == encoding
+    assert np.array_equal(restored.registers, sketch.registers)
+    assert restored.registers.flags.writeable
+
+
+def test_encoded_sizes():
+    small = sketch_of(range(100))
+    # two bytes of index and one of value per set register
+    assert len(small.to_bytes()) == 1 + 3 * np.count_nonzero(small.registers)
+    assert len(sketch_of(range(100000)).to_bytes()) == 1 + REGISTERS
+
+
+def test_aggregator_splits_plays_per_bucket():
+    plays = pd.DataFrame({
+        'start_time': pd.to_datetime(['2018-11-01 10:00', '2018-11-01 11:00',
+                                      '2018-11-02 10:00']),
+        'user_id': [1, 2, 1],
+        'song_id': ['SO1', None, 'SO1'],
+        'artist_id': ['AR1', 'AR1', None]
+    })
+    sketches = SketchAggregator()
+    sketches.update(plays)
+
+    estimates = {key: round(sketch.estimate())
+                 for key, sketch in sketches.pending.items()}
+
+    assert estimates[('day', '2018-11-01', 'users')] == 2
+    assert estimates[('day', '2018-11-02', 'users')] == 1
+    assert estimates[('hour', '2018-11-01 10', 'users')] == 1
+    assert estimates[('artist', 'AR1', 'users')] == 2
+    assert estimates[('day', '2018-11-01', 'songs')] == 1
+    assert ('artist', 'None', 'songs') not in estimates
@@ -0,0 +1,114 @@
+import json
+import psycopg2
+import pytest
+import streaming
+from sessions import SessionAggregator
+from sketches import SketchAggregator
+
+
+def event_line(item, song='Song'):
+    return json.dumps({
+        'page': 'NextSong', 'ts': 1541030400000 + item * 1000,
+        'sessionId': 7, 'itemInSession': item, 'userId': '8', 'song': song
+    }).encode()
+
+
+class FakeCursor:
+    """
+    Records the statements load_lines sends around process_log_events
+    """
+
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, query, vars=None):
+        self.statements.append(query)
+
+
+class FakeLoad:
+    """
+    Stands in for process_log_events: folds the events into the session
+    aggregator like the real one, then fails on events of a bad song or
+    keeps the items it loaded
+    """
+
+    def __init__(self, error=psycopg2.DataError):
+        self.error = error
+        self.calls = 0
+        self.loaded = []
+
+    def __call__(self, cur, df, sessions, sketches):
+        self.calls += 1
+        sessions.update(df)
+        if (df['song'] == 'bad').any():
+            raise self.error("value out of range")
+        self.loaded.extend(df['itemInSession'])
+        sessions.pending = {}
+
+
+@pytest.fixture
+def fake_load(monkeypatch):
+    load = FakeLoad()
+    monkeypatch.setattr(streaming, 'process_log_events', load)
+    return load
+
+
+def test_bisection_isolates_single_bad_line(fake_load):
+    lines = [event_line(i) for i in range(16)]
+    lines[11] = event_line(11, song='bad')
+    sessions, dead_letters = SessionAggregator(), []
+
+    events, rejected, max_ts = streaming.load_lines(
+        FakeCursor(), lines, sessions, SketchAggregator(), dead_letters
+    )
+
+    assert events == 15 and rejected == 0
+    assert sorted(fake_load.loaded) == [i for i in range(16) if i != 11]
+    assert dead_letters == [(lines[11], "DataError: value out of range")]
+    assert max_ts == 1541030400000 + 15 * 1000
+    # the deltas of the failed attempts are not left for the next flush
+    assert sessions.pending == {}
+    # 1 + 2 + 2 + 2 + 2 attempts down the halves holding the bad line
+    assert fake_load.calls == 9
+
+
+def test_every_attempt_runs_in_a_savepoint(fake_load):
+    lines = [event_line(0, song='bad'), event_line(1)]
+    cur = FakeCursor()
+
+    streaming.load_lines(cur, lines, SessionAggregator(), SketchAggregator(),
+                         [])
+
+    assert cur.statements == [
+        "SAVEPOINT micro_batch",
+        "ROLLBACK TO SAVEPOINT micro_batch", "RELEASE SAVEPOINT micro_batch",
+        "SAVEPOINT micro_batch",
+        "ROLLBACK TO SAVEPOINT micro_batch", "RELEASE SAVEPOINT micro_batch",
+        "SAVEPOINT micro_batch", "RELEASE SAVEPOINT micro_batch"
+    ]
+
+
+def test_malformed_lines_are_rejected_without_bisection(fake_load):
+    lines = [event_line(0), b'{not json', b'{"page": "NextSong"}']
+    dead_letters = []
+
+    events, rejected, _ = streaming.load_lines(
+        FakeCursor(), lines, SessionAggregator(), SketchAggregator(),
+        dead_letters
+    )
+
+    assert (events, rejected, fake_load.calls) == (1, 2, 1)
+    assert dead_letters == []
+
+
+def test_transient_error_is_raised_for_retry(monkeypatch):
+    load = FakeLoad(error=psycopg2.OperationalError)
+    monkeypatch.setattr(streaming, 'process_log_events', load)
+    lines = [event_line(0, song='bad'), event_line(1)]
+    dead_letters = []
+
+    with pytest.raises(psycopg2.OperationalError):
+        streaming.load_lines(FakeCursor(), lines, SessionAggregator(),
+                             SketchAggregator(), dead_letters)
+
+    assert load.calls == 1 and dead_letters == []
@@ -0,0 +1,160 @@
+import json
+import argparse
+from read_benchmark import create_benchmark_database, load_scale
+from read_benchmark import time_query, explain, plan_nodes
+
+##############################################################################
+# Compares the millisecond time dimension (time, joined on start_time) with
+# the hourly one (time_hours, joined on the integer time_key) on synthetic
+# data: the size of both dimensions and of the key songplays carries, and
+# the plan cost, buffers and latency of the same report over either join.
+
+DEFAULT_SCALES = [100000, 1000000]
+
+COMPARISONS = {
+    'plays_per_hour': ("""
+        SELECT time.hour, COUNT(*) AS plays
+        FROM songplays
+        JOIN time ON songplays.start_time = time.start_time
+        GROUP BY time.hour
+    """, """
+        SELECT time_hours.hour, COUNT(*) AS plays
+        FROM songplays
+        JOIN time_hours ON songplays.time_key = time_hours.time_key
+        GROUP BY time_hours.hour
+    """),
+    'plays_per_weekday': ("""
+        SELECT time.weekday, COUNT(*) AS plays
+        FROM songplays
+        JOIN time ON songplays.start_time = time.start_time
+        GROUP BY time.weekday
+    """, """
+        SELECT time_hours.weekday, COUNT(*) AS plays
+        FROM songplays
+        JOIN time_hours ON songplays.time_key = time_hours.time_key
+        GROUP BY time_hours.weekday
+    """),
+    'plays_per_week_level': ("""
+        SELECT time.week, songplays.level, COUNT(*) AS plays
+        FROM songplays
+        JOIN time ON songplays.start_time = time.start_time
+        WHERE time.hour BETWEEN 18 AND 23
+        GROUP BY time.week, songplays.level
+    """, """
+        SELECT time_hours.week, songplays.level, COUNT(*) AS plays
+        FROM songplays
+        JOIN time_hours ON songplays.time_key = time_hours.time_key
+        WHERE time_hours.hour BETWEEN 18 AND 23
+        GROUP BY time_hours.week, songplays.level
+    """)
+}
+
+
+def table_sizes(cur):
+    """
+    On disk size of both time dimensions and of songplays.time_key
+    :param cur: cursor to the benchmark database
+    :return: dict of name to bytes
+    """
+    cur.execute("""
+        SELECT pg_total_relation_size('time'),
+               pg_total_relation_size('time_hours'),
+               pg_total_relation_size('songplays'),
+               (SELECT SUM(pg_column_size(time_key)) FROM songplays)
+    """)
+    names = ['time', 'time_hours', 'songplays', 'songplays.time_key']
+    return dict(zip(names, (int(v) for v in cur.fetchone())))
+
+
+def plan_cost(json_plan):
+    """
+    :param json_plan: plan returned by explain
+    :return: dict with the planner cost and the shared buffers touched
+    """
+    root = json_plan['Plan']
+    return {
+        'cost': root['Total Cost'],
+        'buffers': sum(node.get('Shared Hit Blocks', 0) +
+                       node.get('Shared Read Blocks', 0)
+                       for node in plan_nodes(root))
+    }
+
+
+def run_scale(conn, num_songplays, repeat):
+    """
+    Loads one scale and compares both joins on it
+    :param conn: connection to the benchmark database
+    :param num_songplays: number of songplays
+    :param repeat: number of timed runs per query
+    :return: dict with the table sizes and per query results
+    """
+    counts = load_scale(conn, num_songplays)
+    cur = conn.cursor()
+    result = {'scale': num_songplays, 'rows': counts,
+              'sizes': table_sizes(cur), 'queries': {}}
+    for name, (by_start_time, by_time_key) in COMPARISONS.items():
+        result['queries'][name] = {}
+        for variant, query in (('start_time', by_start_time),
+                               ('time_key', by_time_key)):
+            latency = time_query(cur, query, {}, repeat)
+            json_plan, _ = explain(cur, query, {})
+            result['queries'][name][variant] = dict(latency,
+                                                    **plan_cost(json_plan))
+        conn.rollback()
+    return result
+
+
+def print_result(result):
+    """
+    Prints the size and join comparison of one scale
+    :param result: output of run_scale
+    :return:
+    """
+    rows, sizes = result['rows'], result['sizes']
+    print(f"\nscale {result['scale']} songplays")
+    print(f"  time        {rows['time']:>10} rows {sizes['time'] / 2 ** 20:>9.2f}"
+          f" MB")
+    print(f"  time_hours  {rows['time_hours']:>10} rows "
+          f"{sizes['time_hours'] / 2 ** 20:>9.2f} MB")
+    print(f"  songplays.time_key adds about "
+          f"{sizes['songplays.time_key'] / 2 ** 20:.2f} MB to "
+          f"{sizes['songplays'] / 2 ** 20:.2f} MB")
+    print(f"  {'query':<22} {'join':<11} {'cost':>11} {'buffers':>9}"
+          f" {'p50 ms':>9} {'p95 ms':>9}")
+    for name, variants in result['queries'].items():
+        for variant, r in variants.items():
+            print(f"  {name:<22} {variant:<11} {r['cost']:>11.0f}"
+                  f" {r['buffers']:>9} {r['p50']:>9.2f} {r['p95']:>9.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compares joining songplays to the millisecond time "
+                    "table on start_time with joining the hourly time_hours "
+                    "table on time_key."
+    )
+    parser.add_argument("--scales", type=int, nargs='+',
+                        default=DEFAULT_SCALES,
+                        help="Numbers of songplays to benchmark.")
+    parser.add_argument("--repeat", type=int, default=10,
+                        help="Number of timed runs per query.")
+    parser.add_argument("--dbname", default="sparkifydb_bench",
+                        help="Benchmark database, dropped and recreated.")
+    parser.add_argument("--json", default=None,
+                        help="Write the results to this file.")
+    args = parser.parse_args()
+
+    conn = create_benchmark_database(args.dbname)
+    results = []
+    for scale in args.scales:
+        results.append(run_scale(conn, scale, args.repeat))
+        print_result(results[-1])
+    conn.close()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
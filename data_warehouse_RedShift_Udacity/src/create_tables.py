@@ -1,34 +1,49 @@
+import argparse
 import configparser
 import psycopg2
 from sql_queries import create_table_queries, drop_table_queries
+from statement_runner import StatementRunner, read_settings
 
 
 ##############################################################################
-def drop_tables(cur, conn):
-    for query in drop_table_queries:
-        cur.execute(query)
-        conn.commit()
+def drop_tables(runner):
+    runner.run_step('drop tables', drop_table_queries)
 
 
-def create_tables(cur, conn):
-    for query in create_table_queries:
-        cur.execute(query)
-        conn.commit()
+def create_tables(runner):
+    runner.run_step('create tables', create_table_queries)
 
 
-def main():
+def main(resume=True):
+    """
+    Drops and recreates the staging and star schema tables, each group in
+    one transaction
+    :param resume: skip the steps an unfinished run already committed
+    :return:
+    """
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
 
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}"
-                            .format(*config['CLUSTER'].values()))
-    cur = conn.cursor()
+    def connect():
+        return psycopg2.connect("host={} dbname={} user={} password={} port={}"
+                                .format(*config['CLUSTER'].values()))
 
-    drop_tables(cur, conn)
-    create_tables(cur, conn)
+    runner = StatementRunner(connect, 'create_tables', read_settings(config),
+                             resume)
 
-    conn.close()
+    drop_tables(runner)
+    create_tables(runner)
+
+    runner.finish()
+    runner.print_report()
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(
+        description="Drops and creates the staging and star schema tables."
+    )
+    parser.add_argument("--restart", action="store_true",
+                        help="Ignore the steps an unfinished run committed.")
+    args = parser.parse_args()
+
+    main(not args.restart)
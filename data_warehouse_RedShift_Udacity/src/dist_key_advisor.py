@@ -0,0 +1,618 @@
+import re
+import json
+import zlib
+import argparse
+from collections import Counter
+from sql_queries import create_table_queries, insert_table_queries
+from sql_queries import staging_key_queries
+from staging_sample import sample_staging_events, sample_staging_songs
+from staging_sample import sample_staging_postgres, derive_final_tables
+
+##############################################################################
+# Joins the dashboards run against the star schema. They are not part of
+# insert_table_queries but decide whether songplays should be collocated
+# with a dimension: (fact table, fact column, dimension, dimension column).
+
+ANALYTIC_JOINS = [
+    ('songplays', 'user_id', 'users', 'userid'),
+    ('songplays', 'song_id', 'songs', 'song_id'),
+    ('songplays', 'artist_id', 'artists', 'artist_id'),
+    ('songplays', 'start_time', 'time', 'start_time'),
+    ('songplays', 'time_key', 'time_hours', 'time_key')
+]
+
+SQL_KEYWORDS = {
+    'on', 'where', 'inner', 'left', 'right', 'full', 'join', 'and', 'or',
+    'group', 'order', 'limit', 'union', 'as'
+}
+
+
+##############################################################################
+# Parsing of the queries in sql_queries.py
+
+def matching_paren(sql, start):
+    """
+    Finds the closing parenthesis matching the one at start
+    :param sql: sql text
+    :param start: index of an opening parenthesis
+    :return: index of the matching closing parenthesis
+    """
+    depth = 0
+    for i in range(start, len(sql)):
+        if sql[i] == '(':
+            depth += 1
+        elif sql[i] == ')':
+            depth -= 1
+            if depth == 0:
+                return i
+    raise ValueError("Unbalanced parenthesis in query")
+
+
+def split_top_level(text):
+    """
+    Splits text on commas that are not nested inside parenthesis
+    :param text: comma separated sql fragment
+    :return: list of stripped items
+    """
+    items, depth, current = [], 0, []
+    for char in text:
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        if char == ',' and depth == 0:
+            items.append(''.join(current).strip())
+            current = []
+        else:
+            current.append(char)
+    if ''.join(current).strip():
+        items.append(''.join(current).strip())
+    return items
+
+
+def select_list_bounds(sql):
+    """
+    Finds the select list, between SELECT [DISTINCT] and the top level FROM
+    :param sql: sql statement containing a SELECT
+    :return: tuple of (start, end) indexes of the select list
+    """
+    select = re.search(r'\bSELECT\s+(?:DISTINCT\s+)?', sql, re.I)
+    depth = 0
+    for i in range(select.end(), len(sql)):
+        if sql[i] == '(':
+            depth += 1
+        elif sql[i] == ')':
+            depth -= 1
+        elif depth == 0 and re.match(r'FROM\b', sql[i:], re.I) and \
+                not re.match(r'\w', sql[i - 1]):
+            return select.end(), i
+    return select.end(), len(sql)
+
+
+def parse_create_table(sql):
+    """
+    Extracts table name, columns and distribution settings from a CREATE
+    TABLE statement
+    :param sql: CREATE TABLE statement
+    :return: dict with name, columns, diststyle, distkey and sortkey
+    """
+    name = re.search(
+        r'CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)', sql, re.I
+    ).group(1).lower()
+    body_start = sql.index('(', sql.lower().index(name))
+    body_end = matching_paren(sql, body_start)
+    tail = sql[body_end + 1:]
+
+    columns, distkey, sortkey = [], None, []
+    for item in split_top_level(sql[body_start + 1:body_end]):
+        tokens = item.split()
+        if tokens[0].upper() in ('PRIMARY', 'FOREIGN', 'UNIQUE',
+                                 'CONSTRAINT'):
+            continue
+        column = tokens[0].lower()
+        columns.append({
+            'name': column,
+            'type': re.match(r'\w+\s+([\w ]+?(?:\s*\([^)]*\))?)(?=\s|$)',
+                             item).group(1).upper(),
+            'definition': item
+        })
+        if re.search(r'\bDISTKEY\b', item, re.I):
+            distkey = column
+        if re.search(r'\bSORTKEY\b', item, re.I):
+            sortkey.append(column)
+
+    match = re.search(r'DISTKEY\s*\(\s*(\w+)\s*\)', tail, re.I)
+    if match:
+        distkey = match.group(1).lower()
+    match = re.search(r'SORTKEY\s*\(([^)]*)\)', tail, re.I)
+    if match:
+        sortkey = [c.strip().lower() for c in match.group(1).split(',')]
+    match = re.search(r'DISTSTYLE\s+(\w+)', tail, re.I)
+    diststyle = match.group(1).upper() if match else (
+        'KEY' if distkey else 'AUTO'
+    )
+
+    return {
+        'name': name,
+        'columns': columns,
+        'diststyle': diststyle,
+        'distkey': distkey,
+        'sortkey': sortkey
+    }
+
+
+def parse_insert_query(sql, tables):
+    """
+    Extracts the target, sources, join columns and column lineage of an
+    INSERT ... SELECT statement
+    :param sql: INSERT statement
+    :param tables: dict of table name to parsed CREATE TABLE
+    :return: dict describing the query
+    """
+    match = re.search(r'INSERT\s+INTO\s+(\w+)\s*(\([^)]*\))?', sql, re.I)
+    target = match.group(1).lower()
+    if match.group(2):
+        target_columns = [
+            c.strip().lower() for c in match.group(2)[1:-1].split(',')
+        ]
+    else:
+        target_columns = [c['name'] for c in tables[target]['columns']]
+
+    select_start, select_end = select_list_bounds(sql)
+    select = re.search(r'\bSELECT\s+(DISTINCT\s+)?', sql, re.I)
+    select_items = split_top_level(sql[select_start:select_end])
+    rest = sql[select_end:]
+
+    sources = {}
+    for table, alias in re.findall(
+            r'(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?', rest, re.I):
+        table = table.lower()
+        alias = alias.lower() if alias and \
+            alias.lower() not in SQL_KEYWORDS else table
+        sources[alias] = table
+
+    joins = [
+        (sources[a.lower()], c1.lower(), sources[b.lower()], c2.lower())
+        for a, c1, b, c2 in re.findall(
+            r'(\w+)\.(\w+)\s*=\s*(\w+)\.(\w+)', rest)
+        if a.lower() in sources and b.lower() in sources
+    ]
+
+    # Column lineage: which source column each target column comes from and
+    # whether it is passed through unchanged
+    lineage, aliases = {}, {}
+    for target_column, item in zip(target_columns, select_items):
+        expression = re.sub(r"'[^']*'", '', item)
+        alias = re.search(r'\bAS\s+(\w+)\s*$', expression, re.I)
+        if alias:
+            expression = expression[:alias.start()]
+        source = None
+        qualified = re.findall(r'(\w+)\.(\w+)', expression)
+        if qualified:
+            source = (sources[qualified[0][0].lower()],
+                      qualified[0][1].lower())
+        else:
+            for word in re.findall(r'[A-Za-z_]\w*', expression):
+                word = word.lower()
+                owners = [
+                    t for t in sources.values()
+                    if word in [c['name'] for c in tables[t]['columns']]
+                ]
+                if owners:
+                    source = (owners[0], word)
+                    break
+                if word in aliases:
+                    source = aliases[word][0]
+                    break
+        direct = source is not None and re.fullmatch(
+            r'\s*(?:\w+\.)?' + source[1] + r'\s*', expression, re.I
+        ) is not None
+        lineage[target_column] = (source, direct)
+        if alias:
+            aliases[alias.group(1).lower()] = (source, direct)
+
+    return {
+        'target': target,
+        'sources': sorted(set(sources.values())),
+        'joins': joins,
+        'distinct': bool(select.group(1)),
+        'lineage': lineage
+    }
+
+
+##############################################################################
+# Slice simulation and cost model
+
+def slice_of(value, num_slices):
+    """
+    Places a distribution key value on a slice. NULLs all land on one slice
+    as they do on the cluster.
+    :param value: value of the distribution key
+    :param num_slices: number of slices in the cluster
+    :return: slice number
+    """
+    if value is None:
+        return 0
+    return zlib.crc32(repr(value).encode('utf8')) % num_slices
+
+
+def simulate_placement(rows, column, num_slices):
+    """
+    Simulates how rows are spread over slices for a distribution key
+    :param rows: list of row dicts
+    :param column: distribution key column
+    :param num_slices: number of slices in the cluster
+    :return: dict with rows per slice and skew statistics
+    """
+    counts = Counter(slice_of(row[column], num_slices) for row in rows)
+    per_slice = [counts.get(i, 0) for i in range(num_slices)]
+    mean = len(rows) / num_slices if rows else 0
+    values = [row[column] for row in rows]
+    return {
+        'rows_per_slice': per_slice,
+        'skew': round(max(per_slice) / mean, 3) if mean else 1.0,
+        'empty_slices': per_slice.count(0),
+        'distinct_values': len(set(values)),
+        'null_fraction': round(values.count(None) / len(values), 3)
+        if values else 0.0
+    }
+
+
+def _moved(rows, num_slices):
+    # Rows that leave their slice when redistributed on a new hash
+    return rows * (num_slices - 1) / num_slices
+
+
+def join_cost(left, right, pairs, layout, counts, num_slices):
+    """
+    Estimates rows shipped between slices to run a join, the way the
+    Redshift planner picks DS_DIST_NONE, DS_DIST_INNER, DS_DIST_BOTH or
+    DS_BCAST_INNER
+    :param left: left table
+    :param right: right table
+    :param pairs: list of (left column, right column) equality conditions
+    :return: tuple of (strategy, rows moved, columns the result is
+    distributed on)
+    """
+    l_dist, r_dist = layout[left], layout[right]
+    l_rows, r_rows = counts[left], counts[right]
+
+    if l_dist['diststyle'] == 'ALL' or r_dist['diststyle'] == 'ALL':
+        return 'DS_DIST_ALL_NONE', 0.0, set()
+
+    l_key = l_dist['distkey'] if l_dist['diststyle'] == 'KEY' else None
+    r_key = r_dist['distkey'] if r_dist['diststyle'] == 'KEY' else None
+    for left_col, right_col in pairs:
+        if l_key == left_col and r_key == right_col:
+            return 'DS_DIST_NONE', 0.0, {(left, left_col), (right, right_col)}
+    for left_col, right_col in pairs:
+        if l_key == left_col:
+            return 'DS_DIST_INNER', _moved(r_rows, num_slices), \
+                {(left, left_col), (right, right_col)}
+        if r_key == right_col:
+            return 'DS_DIST_OUTER', _moved(l_rows, num_slices), \
+                {(left, left_col), (right, right_col)}
+
+    left_col, right_col = pairs[0]
+    both = _moved(l_rows + r_rows, num_slices)
+    broadcast = min(l_rows, r_rows) * num_slices
+    if broadcast < both:
+        bigger = left if l_rows >= r_rows else right
+        keep = {(bigger, layout[bigger]['distkey'])} \
+            if layout[bigger]['diststyle'] == 'KEY' else set()
+        return 'DS_BCAST_INNER', float(broadcast), keep
+    return 'DS_DIST_BOTH', both, {(left, left_col), (right, right_col)}
+
+
+def insert_cost(query, layout, counts, num_slices):
+    """
+    Estimates rows shipped between slices by one INSERT ... SELECT
+    :return: dict with the plan steps and total rows moved
+    """
+    steps, total = [], 0.0
+
+    if query['joins']:
+        left, _, right, _ = query['joins'][0]
+        pairs = [(lc, rc) for lt, lc, rt, rc in query['joins']
+                 if (lt, rt) == (left, right)]
+        pairs += [(rc, lc) for lt, lc, rt, rc in query['joins']
+                  if (lt, rt) == (right, left)]
+        strategy, moved, distributed_on = join_cost(
+            left, right, pairs, layout, counts, num_slices
+        )
+        steps.append((f"join {left}.{pairs[0][0]} = {right}.{pairs[0][1]}",
+                      strategy, moved))
+        total += moved
+    else:
+        source = query['sources'][0]
+        distributed_on = {(source, layout[source]['distkey'])} \
+            if layout[source]['diststyle'] == 'KEY' else set()
+
+    out_rows = counts[query['target']]
+    passed_through = {
+        source for source, direct in query['lineage'].values() if direct
+    }
+
+    if query['distinct']:
+        moved = 0.0 if distributed_on & passed_through \
+            else _moved(out_rows, num_slices)
+        steps.append(('distinct', 'local' if not moved else
+                      'DS_DIST_AGG', moved))
+        total += moved
+        if moved:
+            distributed_on = set()
+
+    target = layout[query['target']]
+    if target['diststyle'] == 'ALL':
+        moved = float(out_rows * (num_slices - 1))
+        strategy = 'broadcast to all slices'
+    else:
+        source, direct = query['lineage'].get(target['distkey'],
+                                              (None, False))
+        local = target['diststyle'] == 'KEY' and direct and \
+            source in distributed_on
+        moved = 0.0 if local else _moved(out_rows, num_slices)
+        strategy = 'local write' if local else 'redistribute on write'
+    steps.append((f"write {query['target']}", strategy, moved))
+    total += moved
+
+    return {'target': query['target'], 'steps': steps, 'moved': total}
+
+
+def workload_cost(queries, layout, counts, num_slices):
+    """
+    Sums the rows moved by the insert queries and the analytic joins
+    :return: tuple of (total rows moved, list of per query details)
+    """
+    details = [insert_cost(q, layout, counts, num_slices) for q in queries]
+    for fact, fact_col, dim, dim_col in ANALYTIC_JOINS:
+        strategy, moved, _ = join_cost(
+            fact, dim, [(fact_col, dim_col)], layout, counts, num_slices
+        )
+        details.append({
+            'target': f"{fact} x {dim}",
+            'steps': [(f"join {fact}.{fact_col} = {dim}.{dim_col}",
+                       strategy, moved)],
+            'moved': moved
+        })
+    return sum(d['moved'] for d in details), details
+
+
+##############################################################################
+# Advisor
+
+def _join_columns(name, queries):
+    columns = set()
+    for query in queries:
+        for left, left_col, right, right_col in query['joins']:
+            if left == name:
+                columns.add(left_col)
+            if right == name:
+                columns.add(right_col)
+    for fact, fact_col, dim, dim_col in ANALYTIC_JOINS:
+        if fact == name:
+            columns.add(fact_col)
+        if dim == name:
+            columns.add(dim_col)
+    return columns
+
+
+def candidate_keys(table, tables, queries):
+    """
+    Lists the columns worth trying as distribution key for a table: its
+    join columns, its current key and the columns feeding another table's
+    join column unchanged
+    :param table: parsed CREATE TABLE
+    :param tables: dict of table name to parsed CREATE TABLE
+    :param queries: parsed insert queries
+    :return: sorted list of column names
+    """
+    name = table['name']
+    candidates = _join_columns(name, queries)
+    if table['distkey']:
+        candidates.add(table['distkey'])
+    for query in queries:
+        keys = _join_columns(query['target'], queries)
+        if tables[query['target']]['distkey']:
+            keys.add(tables[query['target']]['distkey'])
+        for target_column, (source, direct) in query['lineage'].items():
+            if direct and source[0] == name and target_column in keys:
+                candidates.add(source[1])
+    return sorted(candidates)
+
+
+def suggest_sortkey(table, distkey):
+    """
+    Suggests a sort key: the timestamp column for range restricted scans,
+    else the distribution key so joins on it can merge
+    :return: tuple of (column, reason)
+    """
+    for column in table['columns']:
+        if column['type'].startswith('TIMESTAMP'):
+            return column['name'], 'timestamp column, range restricted scans'
+    if distkey:
+        return distkey, 'same as distkey, allows merge joins'
+    if table['sortkey']:
+        return table['sortkey'][0], 'kept current sort key'
+    return None, 'no join or range column'
+
+
+def advise(data, num_slices, max_skew=1.5, all_max_rows=3000000, scale=1.0,
+           passes=2):
+    """
+    Recommends DIST and SORT keys for every table in create_table_queries
+    :param data: dict of table name to sampled rows
+    :param num_slices: number of slices to simulate
+    :param max_skew: highest acceptable max/mean rows per slice
+    :param all_max_rows: largest estimated table size for DISTSTYLE ALL
+    :param scale: factor from sample size to full table size
+    :param passes: rounds of per table improvement
+    :return: dict with per table recommendation and workload costs
+    """
+    tables = {}
+    for sql in create_table_queries:
+        table = parse_create_table(sql)
+        tables[table['name']] = table
+    queries = [
+        parse_insert_query(sql, tables)
+        for sql in staging_key_queries + insert_table_queries
+        if sql.lstrip().upper().startswith('INSERT')
+    ]
+    counts = {name: len(data[name]) for name in tables}
+
+    current = {
+        name: {
+            'diststyle': 'KEY' if t['distkey'] else
+            ('ALL' if t['diststyle'] == 'ALL' else 'EVEN'),
+            'distkey': t['distkey']
+        }
+        for name, t in tables.items()
+    }
+    current_cost, current_details = workload_cost(
+        queries, current, counts, num_slices
+    )
+
+    placements = {
+        name: {
+            column: simulate_placement(data[name], column, num_slices)
+            for column in candidate_keys(tables[name], tables, queries)
+        }
+        for name in tables
+    }
+
+    layout = {name: dict(dist) for name, dist in current.items()}
+    facts = {fact for fact, _, _, _ in ANALYTIC_JOINS}
+    for _ in range(passes):
+        for name in sorted(tables, key=lambda n: -counts[n]):
+            options = [{'diststyle': 'EVEN', 'distkey': None}]
+            options += [
+                {'diststyle': 'KEY', 'distkey': column}
+                for column, placement in placements[name].items()
+                if placement['skew'] <= max_skew
+            ]
+            if not name.startswith('staging_') and name not in facts and \
+                    counts[name] * scale <= all_max_rows:
+                options.append({'diststyle': 'ALL', 'distkey': None})
+
+            scored = []
+            for option in options:
+                trial = dict(layout, **{name: option})
+                cost, _ = workload_cost(queries, trial, counts, num_slices)
+                scored.append((cost, option['diststyle'] != 'KEY', option))
+            layout[name] = min(scored, key=lambda s: (s[0], s[1]))[2]
+
+    cost, details = workload_cost(queries, layout, counts, num_slices)
+
+    recommendations = {}
+    for name, table in tables.items():
+        sortkey, reason = suggest_sortkey(table, layout[name]['distkey'])
+        recommendations[name] = {
+            'rows_sampled': counts[name],
+            'current': {
+                'diststyle': current[name]['diststyle'],
+                'distkey': current[name]['distkey'],
+                'sortkey': table['sortkey']
+            },
+            'suggested': {
+                'diststyle': layout[name]['diststyle'],
+                'distkey': layout[name]['distkey'],
+                'sortkey': sortkey,
+                'sortkey_reason': reason
+            },
+            'candidates': placements[name]
+        }
+
+    return {
+        'num_slices': num_slices,
+        'tables': recommendations,
+        'current_rows_moved': round(current_cost * scale),
+        'suggested_rows_moved': round(cost * scale),
+        'current_plan': current_details,
+        'suggested_plan': details
+    }
+
+
+def print_report(report):
+    """
+    Prints the advisor report in a readable form
+    :param report: output of advise
+    :return:
+    """
+    print(f"Simulated slices: {report['num_slices']}\n")
+    for name, table in report['tables'].items():
+        current, suggested = table['current'], table['suggested']
+        print(f"{name} ({table['rows_sampled']} sampled rows)")
+        print(f"  current  : DISTSTYLE {current['diststyle']}"
+              f" DISTKEY {current['distkey']} SORTKEY {current['sortkey']}")
+        print(f"  suggested: DISTSTYLE {suggested['diststyle']}"
+              f" DISTKEY {suggested['distkey']}"
+              f" SORTKEY {suggested['sortkey']}"
+              f" ({suggested['sortkey_reason']})")
+        for column, placement in table['candidates'].items():
+            print(f"    {column:<14} skew {placement['skew']:<6}"
+                  f" distinct {placement['distinct_values']:<7}"
+                  f" nulls {placement['null_fraction']:<6}"
+                  f" empty slices {placement['empty_slices']}")
+        print()
+
+    for title, plan in (('Current', report['current_plan']),
+                        ('Suggested', report['suggested_plan'])):
+        print(f"{title} layout, rows moved between slices:")
+        for query in plan:
+            for step, strategy, moved in query['steps']:
+                print(f"  {query['target']:<20} {step:<45} {strategy:<24}"
+                      f" {moved:,.0f}")
+    print(f"\nTotal rows moved, current: {report['current_rows_moved']:,}"
+          f", suggested: {report['suggested_rows_moved']:,}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Offline DIST/SORT key advisor. Samples staging data "
+                    "from local json files or a Postgres stand-in, "
+                    "simulates placement over slices and estimates "
+                    "redistribution for insert_table_queries."
+    )
+    parser.add_argument("--log-data", default="../../data_modeling_with_"
+                        "postgres_Udacity/data/log_data",
+                        help="Directory with log json files.")
+    parser.add_argument("--song-data", default="../../data_modeling_with_"
+                        "postgres_Udacity/data/song_data",
+                        help="Directory with song json files.")
+    parser.add_argument("--dsn", default=None,
+                        help="Sample staging tables from this Postgres DSN "
+                             "instead of local files.")
+    parser.add_argument("--sample", type=int, default=None,
+                        help="Rows to sample per staging table.")
+    parser.add_argument("--slices", type=int, default=4,
+                        help="Number of slices to simulate.")
+    parser.add_argument("--max-skew", type=float, default=1.5,
+                        help="Highest acceptable max/mean rows per slice.")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="Full table size divided by sample size.")
+    parser.add_argument("--json", default=None,
+                        help="Also write the report to this file.")
+    args = parser.parse_args()
+
+    if args.dsn:
+        import psycopg2
+        conn = psycopg2.connect(args.dsn)
+        cur = conn.cursor()
+        events = sample_staging_postgres(cur, 'staging_events', args.sample)
+        songs = sample_staging_postgres(cur, 'staging_songs', args.sample)
+        conn.close()
+    else:
+        events = sample_staging_events(args.log_data, args.sample)
+        songs = sample_staging_songs(args.song_data, args.sample)
+
+    report = advise(derive_final_tables(events, songs), args.slices,
+                    max_skew=args.max_skew, scale=args.scale)
+    print_report(report)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, default=str)
+
+
+if __name__ == "__main__":
+    main()
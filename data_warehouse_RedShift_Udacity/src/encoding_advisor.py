@@ -0,0 +1,487 @@
+import re
+import json
+import zlib
+import struct
+import argparse
+from datetime import datetime, date
+from collections import Counter
+from sql_queries import create_table_queries
+from staging_sample import sample_staging_events, sample_staging_songs
+from staging_sample import sample_staging_postgres, synthetic_staging
+from staging_sample import derive_final_tables
+from dist_key_advisor import parse_create_table, matching_paren
+from dist_key_advisor import split_top_level
+
+##############################################################################
+# Offline column compression advisor. Rows of every table are derived from
+# sampled staging data, put in sort key order and cut into 1 MB blocks as
+# Redshift stores them. The compressed size of every column is estimated
+# per block under each encoding its type supports. AZ64, LZO and ZSTD are
+# proprietary or tuned inside Redshift, so they are approximated: AZ64 by
+# frame of reference bit packing, LZO by zlib level 1 and ZSTD by the
+# zstandard package (zlib level 9 when it is not installed).
+
+BLOCK_BYTES = 2 ** 20
+
+# encodings Redshift accepts per type family
+ENCODINGS = {
+    'smallint': ['RAW', 'AZ64', 'BYTEDICT', 'DELTA', 'LZO', 'MOSTLY8',
+                 'RUNLENGTH', 'ZSTD'],
+    'integer': ['RAW', 'AZ64', 'BYTEDICT', 'DELTA', 'DELTA32K', 'LZO',
+                'MOSTLY8', 'MOSTLY16', 'RUNLENGTH', 'ZSTD'],
+    'bigint': ['RAW', 'AZ64', 'BYTEDICT', 'DELTA', 'DELTA32K', 'LZO',
+               'MOSTLY8', 'MOSTLY16', 'MOSTLY32', 'RUNLENGTH', 'ZSTD'],
+    'float': ['RAW', 'BYTEDICT', 'RUNLENGTH', 'ZSTD'],
+    'timestamp': ['RAW', 'AZ64', 'BYTEDICT', 'DELTA', 'DELTA32K', 'LZO',
+                  'RUNLENGTH', 'ZSTD'],
+    'date': ['RAW', 'AZ64', 'BYTEDICT', 'DELTA', 'DELTA32K', 'LZO',
+             'RUNLENGTH', 'ZSTD'],
+    'boolean': ['RAW', 'RUNLENGTH', 'ZSTD'],
+    'char': ['RAW', 'BYTEDICT', 'LZO', 'RUNLENGTH', 'ZSTD'],
+    'varchar': ['RAW', 'BYTEDICT', 'LZO', 'RUNLENGTH', 'ZSTD']
+}
+
+# among the encodings smaller than RAW and within TIE_MARGIN of the smallest,
+# the first in this list wins, cheaper to decode encodings come first
+PREFERENCE = ['AZ64', 'RUNLENGTH', 'BYTEDICT', 'DELTA', 'DELTA32K',
+              'MOSTLY8', 'MOSTLY16', 'MOSTLY32', 'LZO', 'ZSTD', 'RAW']
+TIE_MARGIN = 1.1
+
+# estimates over fewer rows than this are mostly block and header overhead
+MIN_ROWS = 1000
+
+EPOCH = datetime(2000, 1, 1)
+
+
+def type_family(column_type):
+    """
+    Maps a column type to a key of ENCODINGS
+    :param column_type: upper case type such as 'VARCHAR(50)'
+    :return: type family
+    """
+    base = column_type.split('(')[0].strip()
+    if base in ('SMALLINT', 'INT2'):
+        return 'smallint'
+    if base in ('INTEGER', 'INT', 'INT4'):
+        return 'integer'
+    if base in ('BIGINT', 'INT8'):
+        return 'bigint'
+    if base in ('FLOAT', 'FLOAT8', 'FLOAT4', 'REAL', 'DOUBLE PRECISION',
+                'DOUBLE'):
+        return 'float'
+    if base.startswith('TIMESTAMP'):
+        return 'timestamp'
+    if base == 'DATE':
+        return 'date'
+    if base in ('BOOLEAN', 'BOOL'):
+        return 'boolean'
+    if base in ('CHAR', 'CHARACTER', 'NCHAR', 'BPCHAR'):
+        return 'char'
+    return 'varchar'
+
+
+FIXED_WIDTHS = {'smallint': 2, 'integer': 4, 'bigint': 8, 'float': 8,
+                'timestamp': 8, 'date': 4, 'boolean': 1}
+
+MOSTLY_BYTES = {'MOSTLY8': 1, 'MOSTLY16': 2, 'MOSTLY32': 4}
+
+
+def _number(value, family):
+    """
+    Integer form of a value as Redshift stores it, None for NULL
+    """
+    if value is None or value == '':
+        return None
+    if family == 'timestamp':
+        if not isinstance(value, datetime):
+            value = datetime.utcfromtimestamp(int(value) / 1000)
+        return int((value - EPOCH).total_seconds() * 10 ** 6)
+    if family == 'date':
+        if isinstance(value, datetime):
+            value = value.date()
+        return (value - EPOCH.date()).days
+    return int(float(value))
+
+
+def encode_raw(value, family, column_type):
+    """
+    Bytes of a value in an uncompressed block
+    :param value: python value
+    :param family: type family of the column
+    :param column_type: upper case column type
+    :return: bytes, a single zero byte stands for NULL
+    """
+    if value is None or (value == '' and family in FIXED_WIDTHS):
+        return b'\x00'
+    if family == 'float':
+        return struct.pack('<d', float(value))
+    if family == 'boolean':
+        return b'\x01' if value else b'\x02'
+    if family in FIXED_WIDTHS:
+        return _number(value, family).to_bytes(
+            FIXED_WIDTHS[family], 'little', signed=True
+        )
+    text = str(value).encode('utf8')
+    if family == 'char':
+        match = re.search(r'\((\d+)\)', column_type)
+        width = int(match.group(1)) if match else 1
+        return text[:width].ljust(width)
+    return struct.pack('<H', len(text)) + text
+
+
+def _blocks(raw_values):
+    """
+    Cuts raw values into blocks of BLOCK_BYTES uncompressed bytes
+    """
+    block, size = [], 0
+    for raw in raw_values:
+        block.append(raw)
+        size += len(raw)
+        if size >= BLOCK_BYTES:
+            yield block
+            block, size = [], 0
+    if block:
+        yield block
+
+
+def _bytedict(raw_block):
+    # one byte per value for the 256 most frequent values of the block, the
+    # others are stored raw behind an escape byte
+    counts = Counter(raw_block)
+    top = dict(counts.most_common(256))
+    return sum(len(v) for v in top) + sum(
+        1 if v in top else 1 + len(v) for v in raw_block
+    )
+
+
+def _runlength(raw_block):
+    size, previous, run = 0, None, 0
+    for raw in raw_block:
+        if raw == previous and run < 127:
+            run += 1
+            continue
+        size += 1 + len(raw)
+        previous, run = raw, 1
+    return size
+
+
+def _delta(numbers, width, delta_bytes):
+    limit = 2 ** (8 * delta_bytes - 1) - 1
+    size, previous = width, None
+    for number in numbers:
+        if number is None:
+            size += delta_bytes
+        elif previous is not None and abs(number - previous) <= limit:
+            size += delta_bytes
+        else:
+            size += delta_bytes + width
+        if number is not None:
+            previous = number
+    return size
+
+
+def _mostly(numbers, width, small_bytes):
+    limit = 2 ** (8 * small_bytes - 1) - 1
+    return sum(
+        small_bytes if n is None or abs(n) <= limit else small_bytes + width
+        for n in numbers
+    )
+
+
+def _bit_width(values):
+    if not values:
+        return 0
+    return (max(values) - min(values)).bit_length()
+
+
+def _az64(numbers, width, group=1024):
+    # frame of reference bit packing per group of values, on the values or
+    # on their deltas, whichever packs tighter
+    size = 0
+    for i in range(0, len(numbers), group):
+        values = [n for n in numbers[i:i + group] if n is not None]
+        deltas = [b - a for a, b in zip(values, values[1:])]
+        bits = min(_bit_width(values), _bit_width(deltas))
+        size += 2 * width + (len(numbers[i:i + group]) * bits + 7) // 8
+    return size
+
+
+def _compressor(name):
+    if name == 'LZO':
+        return lambda data: len(zlib.compress(data, 1))
+    try:
+        import zstandard
+        compressor = zstandard.ZstdCompressor(level=3)
+        return lambda data: len(compressor.compress(data))
+    except ImportError:
+        return lambda data: len(zlib.compress(data, 9))
+
+
+def estimate_column(values, column_type):
+    """
+    Estimates the stored size of a column under every encoding its type
+    supports
+    :param values: column values in sort key order
+    :param column_type: upper case column type
+    :return: dict of encoding to estimated bytes
+    """
+    family = type_family(column_type)
+    width = FIXED_WIDTHS.get(family, 0)
+    sizes = {encoding: 0 for encoding in ENCODINGS[family]}
+    compressors = {name: _compressor(name)
+                   for name in ('LZO', 'ZSTD') if name in sizes}
+    raw_values = [encode_raw(v, family, column_type) for v in values]
+
+    start = 0
+    for block in _blocks(raw_values):
+        numbers = None
+        if family in ('smallint', 'integer', 'bigint', 'timestamp', 'date'):
+            numbers = [_number(v, family)
+                       for v in values[start:start + len(block)]]
+        start += len(block)
+        data = b''.join(block)
+        for encoding in sizes:
+            if encoding == 'RAW':
+                size = len(data)
+            elif encoding == 'BYTEDICT':
+                size = _bytedict(block)
+            elif encoding == 'RUNLENGTH':
+                size = _runlength(block)
+            elif encoding == 'DELTA':
+                size = _delta(numbers, width, 1)
+            elif encoding == 'DELTA32K':
+                size = _delta(numbers, width, 2)
+            elif encoding in MOSTLY_BYTES:
+                size = _mostly(numbers, width, MOSTLY_BYTES[encoding])
+            elif encoding == 'AZ64':
+                size = _az64(numbers, width)
+            else:
+                size = compressors[encoding](data)
+            sizes[encoding] += size
+    return sizes
+
+
+def recommend(sizes):
+    """
+    Picks an encoding: the first of PREFERENCE within TIE_MARGIN of the
+    smallest estimate. Only encodings strictly smaller than RAW qualify, an
+    encoding never inflates a column.
+    :param sizes: output of estimate_column
+    :return: encoding name
+    """
+    smaller = {encoding: size for encoding, size in sizes.items()
+               if encoding != 'RAW' and size < sizes['RAW']}
+    if not smaller:
+        return 'RAW'
+    best = min(smaller.values())
+    for encoding in PREFERENCE:
+        if encoding in smaller and smaller[encoding] <= best * TIE_MARGIN:
+            return encoding
+    return 'RAW'
+
+
+def _sort_value(value):
+    # NULLs first, mixed types compared by their text
+    if value is None:
+        return (0, '')
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, (datetime, date)):
+        return (1, value.timestamp() if isinstance(value, datetime)
+                else value.toordinal())
+    return (2, str(value))
+
+
+def advise_table(table, rows):
+    """
+    Estimates every column of a table in sort key order
+    :param table: parsed CREATE TABLE
+    :param rows: list of row dicts keyed by lower case column name
+    :return: dict of column name to report dict
+    """
+    for column in table['columns']:
+        if re.search(r'\bIDENTITY\b', column['definition'], re.I):
+            # identity values are assigned in insert order
+            rows = [dict(row, **{column['name']: i})
+                    for i, row in enumerate(rows, 1)]
+    if table['sortkey']:
+        rows = sorted(rows, key=lambda row: tuple(
+            _sort_value(row.get(c)) for c in table['sortkey']
+        ))
+
+    report = {}
+    for column in table['columns']:
+        name = column['name']
+        current = re.search(r'\bENCODE\s+(\w+)', column['definition'], re.I)
+        sizes = estimate_column([row.get(name) for row in rows],
+                                column['type'])
+        encoding = recommend(sizes)
+        reason = 'smallest estimate'
+        if table['sortkey'] and name == table['sortkey'][0]:
+            # a compressed leading sort key column packs far more rows per
+            # block than the other columns, range restricted scans then
+            # read more blocks of those columns than needed
+            encoding, reason = 'RAW', 'first sort key column'
+        report[name] = {
+            'rows': len(rows),
+            'type': column['type'],
+            'current': current.group(1).upper() if current else 'default',
+            'recommended': encoding,
+            'reason': reason,
+            'sizes': sizes
+        }
+    return report
+
+
+def _kb(size):
+    return f"{size / 1024:.1f} KB"
+
+
+def annotate_create_table(sql, table, report):
+    """
+    Rewrites a CREATE TABLE statement with the recommended encodings, every
+    column commented with its estimated sizes
+    :param sql: CREATE TABLE statement from sql_queries.py
+    :param table: parsed CREATE TABLE
+    :param report: output of advise_table
+    :return: annotated statement
+    """
+    body_start = sql.index('(', sql.lower().index(table['name']))
+    body_end = matching_paren(sql, body_start)
+    items = split_top_level(sql[body_start + 1:body_end])
+
+    lines = []
+    for i, item in enumerate(items):
+        item = ' '.join(item.split())
+        name = item.split()[0].lower()
+        comma = ',' if i < len(items) - 1 else ''
+        if name not in report:
+            lines.append(f"    {item}{comma}")
+            continue
+        column = report[name]
+        item = re.sub(r'\s+ENCODE\s+\w+', '', item, flags=re.I)
+        type_pattern = r'\s*'.join(
+            re.escape(part) for part in column['type'].split()
+        ).replace(r'\(', r'\s*\(')
+        match = re.match(
+            rf'\w+\s+{type_pattern}(?:\s+IDENTITY\s*\([^)]*\))?', item, re.I
+        )
+        end = match.end() if match else len(item)
+        item = f"{item[:end]} ENCODE {column['recommended']}{item[end:]}"
+        raw = column['sizes']['RAW']
+        chosen = column['sizes'][column['recommended']]
+        note = f"{column['recommended'].lower()} {_kb(chosen)} vs raw " \
+               f"{_kb(raw)} ({raw / max(chosen, 1):.1f}x)"
+        if column['reason'] != 'smallest estimate':
+            best = min(column['sizes'], key=column['sizes'].get)
+            note += f", {column['reason']}, {best.lower()} would be " \
+                    f"{_kb(column['sizes'][best])}"
+        if column['rows'] < MIN_ROWS:
+            note += f", only {column['rows']} rows sampled"
+        lines.append(f"    {item}{comma}  -- {note}")
+
+    return sql[:body_start].strip() + "\n(\n" + '\n'.join(lines) + \
+        "\n)" + sql[body_end + 1:].rstrip() + "\n"
+
+
+def advise(data, table_names=None):
+    """
+    Runs the advisor over the tables of create_table_queries
+    :param data: output of derive_final_tables
+    :param table_names: tables to advise on, defaults to all
+    :return: tuple of (report dict, list of annotated statements)
+    """
+    report, statements = {}, []
+    for sql in create_table_queries:
+        table = parse_create_table(sql)
+        if table_names and table['name'] not in table_names:
+            continue
+        table_report = advise_table(table, data.get(table['name'], []))
+        report[table['name']] = table_report
+        statements.append(annotate_create_table(sql, table, table_report))
+    return report, statements
+
+
+def print_report(report):
+    """
+    Prints current and recommended encoding per column
+    :param report: output of advise
+    :return:
+    """
+    for name, columns in report.items():
+        raw = sum(c['sizes']['RAW'] for c in columns.values())
+        chosen = sum(c['sizes'][c['recommended']] for c in columns.values())
+        rows = next(iter(columns.values()))['rows'] if columns else 0
+        print(f"{name} ({rows} rows): {_kb(raw)} raw, {_kb(chosen)}"
+              f" recommended"
+              + (" - too few rows, estimates unreliable"
+                 if rows < MIN_ROWS else ''))
+        for column, c in columns.items():
+            smallest = sorted(c['sizes'].items(), key=lambda item: item[1])
+            print(f"    {column:<18} {c['type']:<12} {c['current']:<9}"
+                  f" -> {c['recommended']:<9} "
+                  + ', '.join(f"{e.lower()} {_kb(s)}"
+                              for e, s in smallest[:3]))
+        print()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Offline column encoding advisor. Samples staging data, "
+                    "estimates compressed column sizes in sort key order "
+                    "and prints CREATE TABLE statements with the "
+                    "recommended encodings."
+    )
+    parser.add_argument("--log-data", default="../../data_modeling_with_"
+                        "postgres_Udacity/data/log_data",
+                        help="Directory with log json files.")
+    parser.add_argument("--song-data", default="../../data_modeling_with_"
+                        "postgres_Udacity/data/song_data",
+                        help="Directory with song json files.")
+    parser.add_argument("--dsn", default=None,
+                        help="Sample staging tables from this Postgres DSN "
+                             "instead of local files.")
+    parser.add_argument("--sample", type=int, default=None,
+                        help="Rows to sample per staging table.")
+    parser.add_argument("--synthetic-events", type=int, default=None,
+                        help="Use this many synthetic events instead of "
+                             "sampled data.")
+    parser.add_argument("--tables", nargs='+', default=None,
+                        help="Tables to advise on, defaults to all.")
+    parser.add_argument("--output", default=None,
+                        help="Write the annotated CREATE TABLE statements "
+                             "to this file instead of printing them.")
+    parser.add_argument("--json", default=None,
+                        help="Also write the report to this file.")
+    args = parser.parse_args()
+
+    if args.synthetic_events:
+        events, songs = synthetic_staging(args.synthetic_events)
+    elif args.dsn:
+        import psycopg2
+        conn = psycopg2.connect(args.dsn)
+        cur = conn.cursor()
+        events = sample_staging_postgres(cur, 'staging_events', args.sample)
+        songs = sample_staging_postgres(cur, 'staging_songs', args.sample)
+        conn.close()
+    else:
+        events = sample_staging_events(args.log_data, args.sample)
+        songs = sample_staging_songs(args.song_data, args.sample)
+
+    report, statements = advise(derive_final_tables(events, songs),
+                                args.tables)
+    print_report(report)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write('\n'.join(statements))
+    else:
+        print('\n'.join(statements))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
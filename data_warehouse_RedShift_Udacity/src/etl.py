@@ -1,35 +1,157 @@
+import re
+import argparse
 import configparser
+from datetime import date
+import boto3
 import psycopg2
-from sql_queries import copy_table_queries, insert_table_queries
+from sql_queries import build_copy_queries, build_insert_queries
+from maintenance import load_state, save_state, read_thresholds, maintain
+from maintenance import statement_table, record_changes, rows_changed
+from statement_runner import StatementRunner, read_settings
+
+STAGING_TABLES = ['staging_events', 'staging_songs']
+FINAL_TABLES = ['songplays', 'users', 'songs', 'artists', 'time', 'time_hours']
 
 
 ##############################################################################
-def load_staging_tables(cur, conn):
+def staging_steps(copy_table_queries):
+    """
+    Groups the output of build_copy_queries into steps. The COPY statements
+    into a *_load table and the INSERT moving its rows into the keyed
+    staging table run in one transaction, which first empties both tables,
+    so a run only stages its own files and a failed step leaves no rows
+    behind and can simply run again.
+    TRUNCATE commits implicitly on Redshift and gets a step of its own.
+    :param copy_table_queries: output of build_copy_queries
+    :return: list of (step name, statements)
+    """
+    copies, steps, truncates = {}, [], []
     for query in copy_table_queries:
-        cur.execute(query)
-        conn.commit()
+        keyword = query.split()[0].upper()
+        if keyword == 'COPY':
+            copies.setdefault(statement_table(query), []).append(query)
+        elif keyword == 'TRUNCATE':
+            truncates.append(query)
+        else:
+            source = re.search(r'\bFROM\s+(\w+)', query, re.I).group(1)
+            source = source.lower()
+            steps.append((f"load {statement_table(query)}",
+                          [f"DELETE FROM {source};",
+                           f"DELETE FROM {statement_table(query)};"] +
+                          copies.pop(source, []) + [query]))
+    steps += [(f"copy {table}", queries) for table, queries in copies.items()]
+    if truncates:
+        steps.append(('truncate load tables', truncates))
+    return steps
+
+
+def s3_has_objects():
+    """
+    :return: function telling whether an s3://bucket/key prefix holds any
+    object, using the default AWS credentials
+    """
+    s3 = boto3.client('s3')
+
+    def has_objects(prefix):
+        bucket, _, key = prefix[len('s3://'):].partition('/')
+        response = s3.list_objects_v2(Bucket=bucket, Prefix=key, MaxKeys=1)
+        return response.get('KeyCount', 0) > 0
+
+    return has_objects
+
+
+def run_and_record(runner, name, queries, state=None):
+    """
+    Runs a step and adds the rows every COPY/INSERT changed to the
+    maintenance state once the step committed
+    :param runner: StatementRunner
+    :param name: step name
+    :param queries: statements of the step
+    :param state: maintenance state, None skips the bookkeeping
+    :return:
+    """
+    rows = runner.run_step(name, queries, on_statement=rows_changed)
+    if state is None or rows is None:
+        return
+    for query, changed in zip(queries, rows):
+        if statement_table(query):
+            record_changes(state, statement_table(query), changed)
+    save_state(state)
 
 
-def insert_tables(cur, conn):
-    for query in insert_table_queries:
-        cur.execute(query)
-        conn.commit()
+def load_staging_tables(runner, copy_table_queries, state=None):
+    for name, queries in staging_steps(copy_table_queries):
+        run_and_record(runner, name, queries, state)
 
 
-def main():
+def insert_tables(runner, insert_table_queries, state=None):
+    # one transaction, the star schema is never seen half loaded
+    run_and_record(runner, 'load star schema', insert_table_queries, state)
+
+
+def main(start_date=None, end_date=None, maintenance=True, resume=True):
+    """
+    Loads the staging tables from S3 and the star schema from staging, then
+    runs ANALYZE/VACUUM on the tables whose changes crossed a threshold
+    :param start_date: first day of log data to load, None loads everything
+    :param end_date: last day of log data to load (inclusive)
+    :param maintenance: run the post load ANALYZE/VACUUM stage
+    :param resume: skip the steps an unfinished run of the same date range
+    already committed
+    :return:
+    """
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
 
-    conn = psycopg2.connect(
-        "host={} dbname={} user={} password={} port={}".format(
-            *config['CLUSTER'].values()))
-    cur = conn.cursor()
+    def connect():
+        return psycopg2.connect(
+            "host={} dbname={} user={} password={} port={}".format(
+                *config['CLUSTER'].values()))
+
+    runner = StatementRunner(connect, f"etl {start_date} {end_date}",
+                             read_settings(config), resume)
 
-    load_staging_tables(cur, conn)
-    insert_tables(cur, conn)
+    state = load_state() if maintenance else None
+    thresholds = read_thresholds(config)
 
-    conn.close()
+    # days without log files would fail their COPY, they are skipped
+    has_objects = s3_has_objects() if start_date is not None else None
+    load_staging_tables(
+        runner,
+        build_copy_queries(config, start_date, end_date, has_objects),
+        state
+    )
+    if maintenance:
+        # fresh statistics on staging before planning the inserts
+        runner.ensure_connection()
+        maintain(runner.conn, runner.cur, state, STAGING_TABLES, thresholds)
+
+    insert_tables(runner, build_insert_queries(start_date, end_date), state)
+    if maintenance:
+        runner.ensure_connection()
+        maintain(runner.conn, runner.cur, state, FINAL_TABLES, thresholds)
+        save_state(state)
+
+    runner.finish()
+    runner.print_report()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(
+        description="Loads staging tables from S3 and the star schema from "
+                    "staging. Without dates the whole log_data prefix is "
+                    "loaded."
+    )
+    parser.add_argument("--start-date", type=date.fromisoformat,
+                        default=None, help="First day to load, YYYY-MM-DD.")
+    parser.add_argument("--end-date", type=date.fromisoformat,
+                        default=None, help="Last day to load, YYYY-MM-DD.")
+    parser.add_argument("--skip-maintenance", action="store_true",
+                        help="Do not run ANALYZE/VACUUM after the load.")
+    parser.add_argument("--restart", action="store_true",
+                        help="Ignore the steps an unfinished run of the same "
+                             "date range committed.")
+    args = parser.parse_args()
+
+    main(args.start_date, args.end_date, not args.skip_maintenance,
+         not args.restart)
@@ -0,0 +1,222 @@
+import os
+import json
+import time
+import argparse
+import statistics
+import configparser
+import psycopg2
+from sql_queries import create_table_queries, drop_table_queries
+from sql_queries import staging_key_queries, insert_table_queries
+from sql_queries import build_copy_queries
+from staging_sample import synthetic_staging
+from dist_key_advisor import parse_create_table
+from local_redshift import to_postgres, copy_json, load_rows
+from statement_runner import statement_label
+
+##############################################################################
+# Runs the warehouse SQL of sql_queries.py on a local PostgreSQL and times
+# every statement, so regressions in the transform SQL show up without a
+# cluster. Absolute numbers are not Redshift numbers, compare runs against
+# each other.
+
+
+def local_config(log_data, song_data, jsonpath='auto'):
+    """
+    dwh.cfg stand-in pointing the COPY statements at local directories
+    :param log_data: local log_data directory
+    :param song_data: local song_data directory
+    :param jsonpath: local jsonpaths file, or 'auto'
+    :return: ConfigParser
+    """
+    config = configparser.ConfigParser()
+    config['IAM_ROLE'] = {'ARN': "''"}
+    config['S3'] = {
+        'LOG_DATA': os.path.abspath(log_data),
+        'LOG_JSONPATH': jsonpath,
+        'SONG_DATA': os.path.abspath(song_data)
+    }
+    return config
+
+
+def timed(cur, label, func, *args):
+    """
+    Runs func and measures it
+    :return: dict with label, seconds and rows
+    """
+    start = time.perf_counter()
+    rows = func(*args)
+    seconds = time.perf_counter() - start
+    if rows is None:
+        rows = cur.rowcount
+    return {'label': label, 'seconds': seconds, 'rows': rows}
+
+
+def run_cycle(cur, load_statements, synthetic=None):
+    """
+    Drops and creates all tables, loads the staging tables and runs the
+    transform, timing every statement
+    :param cur: cursor on an autocommit connection
+    :param load_statements: rendered COPY statements, used without synthetic
+    :param synthetic: tuple of (staging_events rows, staging_songs rows)
+    :return: list of timings in execution order
+    """
+    tables = {}
+    for sql in create_table_queries:
+        table = parse_create_table(sql)
+        tables[table['name']] = table
+
+    timings = []
+
+    def execute(sql):
+        cur.execute(to_postgres(sql))
+
+    for sql in drop_table_queries:
+        execute(sql)
+    for sql in create_table_queries:
+        timings.append(timed(cur, statement_label(sql), execute, sql))
+
+    if synthetic:
+        events, songs = synthetic
+        timings.append(timed(cur, 'COPY staging_events_load', load_rows,
+                             cur, 'staging_events_load', events))
+        timings.append(timed(cur, 'COPY staging_songs_load', load_rows,
+                             cur, 'staging_songs_load', songs))
+    else:
+        for sql in load_statements:
+            timings.append(timed(cur, statement_label(sql), copy_json,
+                                 cur, sql, tables))
+
+    for sql in staging_key_queries + insert_table_queries:
+        timings.append(timed(cur, statement_label(sql), execute, sql))
+
+    # several COPY statements for one table get their own labels
+    seen = {}
+    for timing in timings:
+        seen[timing['label']] = seen.get(timing['label'], 0) + 1
+        if seen[timing['label']] > 1:
+            timing['label'] += f" #{seen[timing['label']]}"
+    return timings
+
+
+def summarize(cycles):
+    """
+    Median time per statement over all cycles
+    :param cycles: list of run_cycle results
+    :return: list of dicts with label, median, min, max and rows
+    """
+    summary = []
+    for i, first in enumerate(cycles[0]):
+        seconds = [cycle[i]['seconds'] for cycle in cycles]
+        summary.append({
+            'label': first['label'],
+            'median': statistics.median(seconds),
+            'min': min(seconds),
+            'max': max(seconds),
+            'rows': first['rows']
+        })
+    return summary
+
+
+def compare(summary, baseline, tolerance, min_delta=0.005):
+    """
+    Flags statements slower than in a baseline report
+    :param summary: output of summarize
+    :param baseline: summary saved by an earlier run
+    :param tolerance: allowed relative slowdown, 0.2 is 20%
+    :param min_delta: ignore slowdowns below this many seconds
+    :return: list of (label, baseline median, new median)
+    """
+    before = {s['label']: s['median'] for s in baseline}
+    regressions = []
+    for s in summary:
+        old = before.get(s['label'])
+        if old is not None and s['median'] > old * (1 + tolerance) and \
+                s['median'] - old > min_delta:
+            regressions.append((s['label'], old, s['median']))
+    return regressions
+
+
+def print_summary(summary):
+    """
+    Prints the timing report
+    :param summary: output of summarize
+    :return:
+    """
+    print(f"{'statement':<42} {'rows':>10} {'median s':>10} {'min s':>9}"
+          f" {'max s':>9}")
+    for s in summary:
+        print(f"{s['label']:<42} {s['rows']:>10} {s['median']:>10.4f}"
+              f" {s['min']:>9.4f} {s['max']:>9.4f}")
+    print(f"{'total':<42} {'':>10} "
+          f"{sum(s['median'] for s in summary):>10.4f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Runs create_table_queries, the staging load and "
+                    "insert_table_queries on a local PostgreSQL with "
+                    "Redshift shims and times every statement."
+    )
+    parser.add_argument("--dsn", default="host=127.0.0.1 dbname=studentdb "
+                                         "user=student password=student",
+                        help="Local Postgres to run on. Tables are dropped.")
+    parser.add_argument("--log-data", default="../../data_modeling_with_"
+                        "postgres_Udacity/data/log_data",
+                        help="Directory with log json files.")
+    parser.add_argument("--song-data", default="../../data_modeling_with_"
+                        "postgres_Udacity/data/song_data",
+                        help="Directory with song json files.")
+    parser.add_argument("--jsonpath", default="auto",
+                        help="Local jsonpaths file for the log data.")
+    parser.add_argument("--synthetic-events", type=int, default=None,
+                        help="Load this many synthetic events instead of "
+                             "the json files.")
+    parser.add_argument("--synthetic-songs", type=int, default=10000,
+                        help="Number of synthetic songs.")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of full cycles to run.")
+    parser.add_argument("--json", default=None,
+                        help="Write the timing summary to this file.")
+    parser.add_argument("--baseline", default=None,
+                        help="Summary of an earlier run to compare with.")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed relative slowdown against baseline.")
+    args = parser.parse_args()
+
+    synthetic = None
+    if args.synthetic_events:
+        synthetic = synthetic_staging(args.synthetic_events,
+                                      num_songs=args.synthetic_songs)
+    load_statements = build_copy_queries(
+        local_config(args.log_data, args.song_data, args.jsonpath)
+    )
+    load_statements = [
+        sql for sql in load_statements
+        if sql.lstrip().upper().startswith('COPY')
+    ]
+
+    conn = psycopg2.connect(args.dsn)
+    conn.autocommit = True
+    cur = conn.cursor()
+    cycles = [run_cycle(cur, load_statements, synthetic)
+              for _ in range(args.repeat)]
+    conn.close()
+
+    summary = summarize(cycles)
+    print_summary(summary)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(summary, json.load(f), args.tolerance)
+        for label, old, new in regressions:
+            print(f"REGRESSION {label}: {old:.4f}s -> {new:.4f}s")
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+import io
+import os
+import re
+import json
+from staging_sample import STAGING_EVENTS_COLUMNS, STAGING_SONGS_COLUMNS
+from dist_key_advisor import select_list_bounds, split_top_level
+
+##############################################################################
+# Shims running the Redshift statements of sql_queries.py on a local
+# PostgreSQL. Distribution, sort and encoding clauses only matter on the
+# cluster and are dropped. Redshift does not enforce primary keys, so they
+# are dropped too, otherwise the DISTINCT inserts would fail locally.
+
+REDSHIFT_SHIMS = [
+    (r'INTEGER\s+IDENTITY\s*\(\s*\d+\s*,\s*\d+\s*\)', 'SERIAL'),
+    (r'\s*\bDISTSTYLE\s+\w+', ''),
+    (r'\s*\bDISTKEY\s*\(\s*\w+\s*\)', ''),
+    (r'\s*\b(?:COMPOUND\s+|INTERLEAVED\s+)?SORTKEY\s*\([^)]*\)', ''),
+    (r'\s+\b(?:DISTKEY|SORTKEY)\b', ''),
+    (r'\s+ENCODE\s+\w+', ''),
+    (r'\s+PRIMARY\s+KEY', '')
+]
+
+LOAD_COLUMNS = {
+    'staging_events_load': [
+        c for c in STAGING_EVENTS_COLUMNS if c != 'song_key'
+    ],
+    'staging_songs_load': [
+        c for c in STAGING_SONGS_COLUMNS if c != 'song_key'
+    ]
+}
+
+INTEGER_TYPES = ('SMALLINT', 'INTEGER', 'INT', 'BIGINT')
+FLOAT_TYPES = ('FLOAT', 'REAL', 'DOUBLE', 'DECIMAL', 'NUMERIC')
+
+
+def expand_lateral_aliases(sql):
+    """
+    Redshift lets a select list item use the alias of an earlier item, as
+    time_table_insert does with start_time. PostgreSQL does not, so the
+    alias is replaced by the expression it names.
+    :param sql: sql statement
+    :return: statement without lateral alias references
+    """
+    if not re.search(r'\bSELECT\b', sql, re.I):
+        return sql
+
+    start, end = select_list_bounds(sql)
+    aliases, items, changed = {}, [], False
+    for item in split_top_level(sql[start:end]):
+        alias = re.search(r'\s+AS\s+(\w+)\s*$', item, re.I)
+        expression = item[:alias.start()] if alias else item
+        for name, aliased in aliases.items():
+            # string literals such as INTERVAL '1 hour' are left alone
+            parts = re.split(r"('[^']*')", expression)
+            parts[::2] = [re.sub(rf'(?<![\w.]){name}\b', f"({aliased})",
+                                 part) for part in parts[::2]]
+            expanded = ''.join(parts)
+            changed = changed or expanded != expression
+            expression = expanded
+        items.append(expression + (item[alias.start():] if alias else ''))
+        if alias:
+            aliases[alias.group(1)] = expression.strip()
+
+    if not changed:
+        return sql
+    return sql[:start] + ',\n       '.join(items) + '\n' + sql[end:]
+
+
+def to_postgres(sql):
+    """
+    Rewrites a Redshift statement into one PostgreSQL accepts
+    :param sql: Redshift statement
+    :return: PostgreSQL statement
+    """
+    for pattern, replacement in REDSHIFT_SHIMS:
+        sql = re.sub(pattern, replacement, sql, flags=re.I)
+    return expand_lateral_aliases(sql)
+
+
+def _csv_value(value, column_type):
+    """
+    Formats a value for COPY ... CSV, converting json values the way
+    Redshift COPY does: empty strings in numeric columns become NULL
+    :param value: json value
+    :param column_type: upper case column type or None
+    :return: csv field
+    """
+    if column_type and column_type.startswith(INTEGER_TYPES + FLOAT_TYPES):
+        if value is None or value == '':
+            return ''
+        if column_type.startswith(INTEGER_TYPES):
+            return str(int(float(value)))
+        return repr(float(value))
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+def copy_rows(cur, table, rows, columns, types=None, chunk_size=50000):
+    """
+    Bulk loads row dicts with COPY ... FROM STDIN
+    :param cur: cursor to the database
+    :param table: table to load
+    :param rows: iterable of row dicts keyed by lower case column name
+    :param columns: columns to load
+    :param types: dict of column to upper case type, enables conversion
+    :param chunk_size: rows sent per COPY
+    :return: number of rows loaded
+    """
+    types = types or {}
+    statement = f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH CSV"
+    loaded, buffer = 0, io.StringIO()
+
+    def flush():
+        buffer.seek(0)
+        cur.copy_expert(statement, buffer)
+        buffer.seek(0)
+        buffer.truncate()
+
+    for row in rows:
+        buffer.write(','.join(
+            _csv_value(row.get(c), types.get(c)) for c in columns
+        ))
+        buffer.write('\n')
+        loaded += 1
+        if loaded % chunk_size == 0:
+            flush()
+    if loaded % chunk_size:
+        flush()
+    return loaded
+
+
+def load_rows(cur, table, rows, columns=None):
+    """
+    Loads sampled staging rows into a table
+    :param cur: cursor to the database
+    :param table: table to load
+    :param rows: list of row dicts keyed by lower case column name
+    :param columns: columns to load, defaults to LOAD_COLUMNS of the table
+    :return: number of rows loaded
+    """
+    return copy_rows(cur, table, rows, columns or LOAD_COLUMNS[table])
+
+
+def _local_files(prefix):
+    """
+    Lists local json files matching an S3 style key prefix
+    :param prefix: local path used as prefix
+    :return: sorted list of file paths
+    """
+    directory = prefix if os.path.isdir(prefix) else os.path.dirname(prefix)
+    matches = []
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            if path.startswith(prefix) and name.endswith('.json'):
+                matches.append(path)
+    return sorted(matches)
+
+
+def _json_records(file_path):
+    with open(file_path) as f:
+        for line in f:
+            if line.strip():
+                yield {k.lower(): v for k, v in json.loads(line).items()}
+
+
+def copy_json(cur, statement, tables):
+    """
+    Stands in for COPY ... FORMAT AS json when the FROM path of the
+    statement is a local directory or prefix. A local jsonpaths file maps
+    json keys to columns by position, 'auto' maps them by name.
+    :param cur: cursor to the database
+    :param statement: rendered COPY statement
+    :param tables: dict of table name to parsed CREATE TABLE
+    :return: number of rows loaded
+    """
+    table, source = re.search(
+        r"COPY\s+(\w+)\s+FROM\s+'([^']*)'", statement, re.I
+    ).groups()
+    json_format = re.search(
+        r"FORMAT\s+AS\s+json\s+'([^']*)'", statement, re.I
+    ).group(1)
+
+    columns = [c['name'] for c in tables[table.lower()]['columns']]
+    types = {c['name']: c['type'] for c in tables[table.lower()]['columns']}
+    keys = columns
+    if json_format != 'auto' and os.path.exists(json_format):
+        with open(json_format) as f:
+            keys = [
+                next(g for g in re.search(
+                    r"\['(.+?)'\]|\.(\w+)", path).groups() if g).lower()
+                for path in json.load(f)['jsonpaths']
+            ]
+
+    rows = (
+        {column: record.get(key) for column, key in zip(columns, keys)}
+        for file_path in _local_files(source)
+        for record in _json_records(file_path)
+    )
+    return copy_rows(cur, table, rows, columns, types)
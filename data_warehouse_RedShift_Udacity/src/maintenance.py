@@ -0,0 +1,240 @@
+import os
+import re
+import json
+import time
+
+##############################################################################
+# Post load ANALYZE/VACUUM scheduler. COPY runs with STATUPDATE OFF and
+# COMPUPDATE OFF, the rows every run changes are counted per table and
+# statistics and sort order are only fixed up once a threshold is crossed.
+
+DEFAULT_THRESHOLDS = {
+    # ANALYZE when this share of the table changed since the last ANALYZE
+    'ANALYZE_CHANGED_PCT': 10.0,
+    # VACUUM SORT ONLY when more than this share of the table is unsorted
+    'VACUUM_UNSORTED_PCT': 5.0,
+    # VACUUM DELETE ONLY when more than this share of rows is deleted
+    'VACUUM_DELETED_PCT': 10.0,
+    # sort threshold passed to VACUUM ... TO n PERCENT
+    'VACUUM_SORT_TO_PCT': 95.0
+}
+
+DEFAULT_STATE_FILE = 'maintenance_state.json'
+
+table_info_select = ("""
+SELECT "table", tbl_rows, estimated_visible_rows, unsorted, stats_off,
+       sortkey1
+FROM svv_table_info
+WHERE "table" IN %s;
+""")
+
+
+def read_thresholds(config):
+    """
+    Reads thresholds from the MAINTENANCE section of dwh.cfg, falling back
+    to DEFAULT_THRESHOLDS
+    :param config: parsed dwh.cfg
+    :return: dict of threshold name to value
+    """
+    thresholds = dict(DEFAULT_THRESHOLDS)
+    if config.has_section('MAINTENANCE'):
+        for key in thresholds:
+            if config.has_option('MAINTENANCE', key):
+                thresholds[key] = config.getfloat('MAINTENANCE', key)
+    return thresholds
+
+
+def load_state(path=DEFAULT_STATE_FILE):
+    """
+    Loads the rows changed per table since the last ANALYZE and VACUUM
+    :param path: json file holding the state between runs
+    :return: dict of table name to counters
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(state, path=DEFAULT_STATE_FILE):
+    """
+    Saves the maintenance state for the next run
+    :param state: dict of table name to counters
+    :param path: json file holding the state between runs
+    :return:
+    """
+    with open(path, 'w') as f:
+        json.dump(state, f, indent=2)
+
+
+def statement_table(query):
+    """
+    Finds the table a COPY or INSERT statement writes to
+    :param query: sql statement
+    :return: lower case table name or None
+    """
+    match = re.search(r'^\s*(?:COPY|INSERT\s+INTO)\s+(\w+)', query, re.I)
+    return match.group(1).lower() if match else None
+
+
+def record_changes(state, table, rows):
+    """
+    Adds the rows a statement changed to the counters of a table
+    :param state: dict of table name to counters
+    :param table: table the statement wrote to
+    :param rows: number of rows changed
+    :return:
+    """
+    counters = state.setdefault(
+        table, {'changed_since_analyze': 0, 'changed_since_vacuum': 0}
+    )
+    counters['changed_since_analyze'] += max(rows, 0)
+    counters['changed_since_vacuum'] += max(rows, 0)
+
+
+def rows_copied(cur):
+    """
+    Number of rows loaded by the last COPY in this session
+    :param cur: cursor to the database
+    :return: number of rows
+    """
+    cur.execute("SELECT pg_last_copy_count();")
+    return cur.fetchone()[0]
+
+
+def rows_changed(cur, query):
+    """
+    Number of rows the statement just executed on cur changed
+    :param cur: cursor to the database
+    :param query: the statement
+    :return: number of rows
+    """
+    if query.lstrip().upper().startswith('COPY'):
+        return rows_copied(cur)
+    return cur.rowcount
+
+
+def table_info(cur, tables):
+    """
+    Fetches size, unsorted and stale statistics percentages of tables
+    :param cur: cursor to the database
+    :param tables: table names
+    :return: dict of table name to info dict
+    """
+    cur.execute(table_info_select, (tuple(tables),))
+    info = {}
+    for name, rows, visible, unsorted, stats_off, sortkey in cur.fetchall():
+        info[name] = {
+            'tbl_rows': rows or 0,
+            'visible_rows': visible or 0,
+            'unsorted': float(unsorted or 0),
+            'stats_off': float(stats_off or 0),
+            'sorted': sortkey is not None
+        }
+    return info
+
+
+def plan_maintenance(state, info, tables, thresholds):
+    """
+    Decides which tables need ANALYZE and which kind of VACUUM
+    :param state: dict of table name to counters
+    :param info: output of table_info
+    :param tables: tables to consider
+    :param thresholds: output of read_thresholds
+    :return: list of (table, statement, reason)
+    """
+    plan = []
+    for table in tables:
+        if table not in info:
+            # empty tables are not listed in svv_table_info
+            continue
+        counters = state.get(
+            table, {'changed_since_analyze': 0, 'changed_since_vacuum': 0}
+        )
+        table_rows = max(info[table]['tbl_rows'], 1)
+        changed_pct = 100.0 * counters['changed_since_analyze'] / table_rows
+        deleted_pct = 100.0 * (
+            info[table]['tbl_rows'] - info[table]['visible_rows']
+        ) / table_rows
+        unsorted_pct = info[table]['unsorted']
+
+        needs_sort = info[table]['sorted'] and \
+            counters['changed_since_vacuum'] > 0 and \
+            unsorted_pct > thresholds['VACUUM_UNSORTED_PCT']
+        needs_delete = deleted_pct > thresholds['VACUUM_DELETED_PCT']
+        sort_to = int(thresholds['VACUUM_SORT_TO_PCT'])
+
+        if needs_sort and needs_delete:
+            plan.append((table, f"VACUUM FULL {table} TO {sort_to} PERCENT;",
+                         f"{unsorted_pct:.1f}% unsorted, "
+                         f"{deleted_pct:.1f}% deleted"))
+        elif needs_sort:
+            plan.append((table,
+                         f"VACUUM SORT ONLY {table} TO {sort_to} PERCENT;",
+                         f"{unsorted_pct:.1f}% unsorted"))
+        elif needs_delete:
+            plan.append((table, f"VACUUM DELETE ONLY {table};",
+                         f"{deleted_pct:.1f}% deleted"))
+
+        if changed_pct >= thresholds['ANALYZE_CHANGED_PCT'] or \
+                info[table]['stats_off'] >= \
+                thresholds['ANALYZE_CHANGED_PCT']:
+            plan.append((table, f"ANALYZE {table};",
+                         f"{changed_pct:.1f}% rows changed, statistics "
+                         f"{info[table]['stats_off']:.1f}% off"))
+    return plan
+
+
+def run_maintenance(conn, cur, state, plan):
+    """
+    Runs the planned statements and resets the counters they cover. The
+    transaction table_info opened is ended first, also when nothing is
+    planned, so it does not stay idle in transaction. VACUUM can not run
+    inside a transaction block so autocommit is switched on. The statement_timeout
+    a StatementRunner left on the session is lifted, maintenance takes as
+    long as it takes.
+    :param conn: connection to the database
+    :param cur: cursor to the database
+    :param state: dict of table name to counters
+    :param plan: output of plan_maintenance
+    :return:
+    """
+    # psycopg2 refuses to switch autocommit on inside a transaction
+    conn.rollback()
+    if not plan:
+        print("No table crossed a maintenance threshold")
+        return
+
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    try:
+        cur.execute("SET statement_timeout TO 0;")
+        for table, statement, reason in plan:
+            start = time.time()
+            cur.execute(statement)
+            print(f"{statement} ({reason}) took {time.time() - start:.1f}s")
+            counters = state.setdefault(
+                table,
+                {'changed_since_analyze': 0, 'changed_since_vacuum': 0}
+            )
+            if statement.startswith('ANALYZE'):
+                counters['changed_since_analyze'] = 0
+            else:
+                counters['changed_since_vacuum'] = 0
+    finally:
+        conn.autocommit = autocommit
+
+
+def maintain(conn, cur, state, tables, thresholds):
+    """
+    Plans and runs maintenance for a group of tables
+    :param conn: connection to the database
+    :param cur: cursor to the database
+    :param state: dict of table name to counters
+    :param tables: tables to consider
+    :param thresholds: output of read_thresholds
+    :return:
+    """
+    plan = plan_maintenance(state, table_info(cur, tables), tables,
+                            thresholds)
+    run_maintenance(conn, cur, state, plan)
@@ -1,9 +1,10 @@
-import configparser
+from datetime import datetime, timedelta
 
 ##############################################################################
-# CONFIG
-config = configparser.ConfigParser()
-config.read('dwh.cfg')
+# Statements are plain templates. Nothing here reads dwh.cfg or touches the
+# disk at import time, COPY and INSERT statements are rendered on demand by
+# build_copy_queries and build_insert_queries from the config and the run
+# parameters.
 
 # DROP TABLES
 staging_events_table_drop = "DROP TABle IF EXISTS staging_events;"
@@ -13,6 +14,9 @@ user_table_drop = "DROP TABLE IF EXISTS users;"
 song_table_drop = "DROP TABLE IF EXISTS songs;"
 artist_table_drop = "DROP TABLE IF EXISTS artists;"
 time_table_drop = "DROP TABLE  IF EXISTS time;"
+time_hour_table_drop = "DROP TABLE IF EXISTS time_hours;"
+staging_events_load_table_drop = "DROP TABLE IF EXISTS staging_events_load;"
+staging_songs_load_table_drop = "DROP TABLE IF EXISTS staging_songs_load;"
 
 # CREATE TABLES
 staging_events_table_create = ("""
@@ -35,12 +39,62 @@ CREATE TABLE IF NOT EXISTS staging_events
     status INTEGER,
     ts BIGINT,
     userAgent VARCHAR,
-    userId INTEGER
-);
+    userId INTEGER,
+    song_key CHAR(32)
+)
+DISTSTYLE KEY
+DISTKEY ( song_key );
 """)
 
 staging_songs_table_create = ("""
 CREATE TABLE IF NOT EXISTS staging_songs
+(
+    num_songs INTEGER,
+    artist_id VARCHAR,
+    artist_latitude FLOAT,
+    artist_longitude FLOAT,
+    artist_location VARCHAR,
+    artist_name VARCHAR,
+    song_id VARCHAR,
+    title VARCHAR,
+    duration FLOAT,
+    year FLOAT,
+    song_key CHAR(32)
+)
+DISTSTYLE KEY
+DISTKEY ( song_key );
+""")
+
+# COPY lands the raw json in the *_load tables, which keep the column order
+# of the jsonpaths file and are spread evenly. The staging tables add the
+# song_key and are distributed on it, so the songplays join is collocated.
+staging_events_load_table_create = ("""
+CREATE TABLE IF NOT EXISTS staging_events_load
+(
+    artist VARCHAR,
+    auth VARCHAR,
+    firstName VARCHAR(50),
+    gender CHAR,
+    itemInSession INTEGER,
+    lastName VARCHAR(50),
+    length FLOAT,
+    level VARCHAR,
+    location VARCHAR,
+    method VARCHAR,
+    page VARCHAR,
+    registration FLOAT,
+    sessionId INTEGER,
+    song VARCHAR,
+    status INTEGER,
+    ts BIGINT,
+    userAgent VARCHAR,
+    userId INTEGER
+)
+DISTSTYLE EVEN;
+""")
+
+staging_songs_load_table_create = ("""
+CREATE TABLE IF NOT EXISTS staging_songs_load
 (
     num_songs INTEGER,
     artist_id VARCHAR,
@@ -52,7 +106,8 @@ CREATE TABLE IF NOT EXISTS staging_songs
     title VARCHAR,
     duration FLOAT,
     year FLOAT
-);
+)
+DISTSTYLE EVEN;
 """)
 
 songplay_table_create = ("""
@@ -60,11 +115,13 @@ CREATE TABLE IF NOT EXISTS songplays
 (
     songplay_id INTEGER IDENTITY (1, 1) PRIMARY KEY ,
     start_time TIMESTAMP,
+    time_key INTEGER,
     user_id INTEGER,
     level VARCHAR,
     song_id VARCHAR,
     artist_id VARCHAR,
     session_id INTEGER,
+    item_in_session INTEGER,
     location VARCHAR,
     user_agent VARCHAR
 )
@@ -125,58 +182,125 @@ DISTKEY ( start_time )
 SORTKEY (start_time);
 """)
 
+# One row per hour, keyed by the hours since the epoch (ts / 3600000).
+# songplays carries time_key next to start_time, hourly and calendar reports
+# join it to this small table, copied to every node, instead of joining
+# start_time to the time table, which has about one row per event.
+time_hour_table_create = ("""
+CREATE TABLE IF NOT EXISTS time_hours
+(
+    time_key INTEGER PRIMARY KEY,
+    hour_start TIMESTAMP,
+    hour INTEGER,
+    day INTEGER,
+    week INTEGER,
+    month INTEGER,
+    year INTEGER ENCODE BYTEDICT,
+    weekday VARCHAR(9) ENCODE BYTEDICT
+)
+DISTSTYLE ALL
+SORTKEY (time_key);
+""")
+
 # STAGING TABLES
 staging_events_copy = ("""
-COPY staging_events
-FROM {}
-iam_role {}
-FORMAT AS json {};
-""").format(
-    config['S3']['LOG_DATA']
-    , config['IAM_ROLE']['ARN']
-    , config['S3']['LOG_JSONPATH']
-)
+COPY staging_events_load
+FROM '{source}'
+iam_role {iam_role}
+FORMAT AS json {jsonpath}
+STATUPDATE OFF
+COMPUPDATE OFF;
+""")
 
 staging_songs_copy = ("""
-COPY staging_songs
-FROM {}
-iam_role {}
-FORMAT AS json 'auto';
-""").format(config['S3']['SONG_DATA'], config['IAM_ROLE']['ARN'])
+COPY staging_songs_load
+FROM '{source}'
+iam_role {iam_role}
+FORMAT AS json 'auto'
+STATUPDATE OFF
+COMPUPDATE OFF;
+""")
+
+# Normalized, hashed song/artist key. Both staging tables must compute it
+# the same way. Rows without a song get a key of their own so they do not
+# all pile up on one slice.
+song_key_expression = (
+    "COALESCE(MD5(LOWER(TRIM({title})) || '|' || LOWER(TRIM({artist}))), "
+    "MD5({fallback}))"
+)
+
+staging_events_keyed_insert = ("""
+INSERT INTO staging_events
+SELECT artist, auth, firstName, gender, itemInSession, lastName, length,
+       level, location, method, page, registration, sessionId, song, status,
+       ts, userAgent, userId,
+       {song_key}
+FROM staging_events_load;
+""").format(song_key=song_key_expression.format(
+    title='song', artist='artist',
+    fallback="'event|' || CAST(ts AS VARCHAR) || '|' || "
+             "CAST(sessionId AS VARCHAR) || '|' || "
+             "CAST(itemInSession AS VARCHAR)"
+))
+
+staging_songs_keyed_insert = ("""
+INSERT INTO staging_songs
+SELECT num_songs, artist_id, artist_latitude, artist_longitude,
+       artist_location, artist_name, song_id, title, duration, year,
+       {song_key}
+FROM staging_songs_load;
+""").format(song_key=song_key_expression.format(
+    title='title', artist='artist_name', fallback="'song|' || song_id"
+))
+
+staging_events_load_truncate = "TRUNCATE staging_events_load;"
+staging_songs_load_truncate = "TRUNCATE staging_songs_load;"
 
 # FINAL TABLES
 songplay_table_insert = ("""
-INSERT INTO songplays (START_TIME, USER_ID, LEVEL, SONG_ID, ARTIST_ID, 
-SESSION_ID, LOCATION, USER_AGENT)
+INSERT INTO songplays (START_TIME, TIME_KEY, USER_ID, LEVEL, SONG_ID, 
+ARTIST_ID, SESSION_ID, ITEM_IN_SESSION, LOCATION, USER_AGENT)
 SELECT DISTINCT
        TIMESTAMP 'epoch' + (se.ts / 1000) * INTERVAL '1 second' as start_time,
+                se.ts / 3600000 AS time_key,
                 se.userId,
                 se.level,
                 ss.song_id,
                 ss.artist_id,
                 se.sessionId,
+                se.itemInSession,
                 se.location,
                 se.userAgent
 FROM staging_songs ss
 INNER JOIN staging_events se
-ON (ss.title = se.song AND se.artist = ss.artist_name)
-AND se.page = 'NextSong';
+ON (se.song_key = ss.song_key
+    AND ss.title = se.song AND se.artist = ss.artist_name)
+AND se.page = 'NextSong'{ts_filter}
+AND NOT EXISTS (
+    SELECT 1 FROM songplays sp
+    WHERE sp.start_time = TIMESTAMP 'epoch' + (se.ts / 1000) * INTERVAL '1 second'
+    AND sp.user_id = se.userId
+    AND sp.session_id = se.sessionId
+    AND sp.item_in_session = se.itemInSession
+);
 """)
 
 user_table_insert = ("""
 INSERT INTO users
 SELECT DISTINCT userId, firstName, lastName, gender, level
-FROM staging_events
+FROM staging_events se
 WHERE userId IS NOT NULL
-AND page = 'NextSong';
+AND page = 'NextSong'{ts_filter}
+AND NOT EXISTS (SELECT 1 FROM users u WHERE u.userId = se.userId);
 """)
 
 song_table_insert = ("""
 INSERT INTO songs
 SELECT
     DISTINCT song_id, title, artist_id, year, duration
-FROM staging_songs
-WHERE song_id IS NOT NULL;
+FROM staging_songs ss
+WHERE song_id IS NOT NULL
+AND NOT EXISTS (SELECT 1 FROM songs s WHERE s.song_id = ss.song_id);
 """)
 
 artist_table_insert = ("""
@@ -184,7 +308,8 @@ INSERT INTO artists
 SELECT
     DISTINCT artist_id, artist_name, artist_location, artist_latitude
     , artist_longitude
-FROM staging_songs;
+FROM staging_songs ss
+WHERE NOT EXISTS (SELECT 1 FROM artists a WHERE a.artist_id = ss.artist_id);
 """)
 
 time_table_insert = ("""
@@ -197,21 +322,164 @@ SELECT DISTINCT
        EXTRACT(MONTH FROM start_time) AS month,
        EXTRACT(YEAR FROM start_time) AS year,
        to_char(start_time, 'Day') AS weekday
-FROM staging_events;
+FROM staging_events se
+WHERE ts IS NOT NULL{ts_filter}
+AND NOT EXISTS (
+    SELECT 1 FROM time t
+    WHERE t.start_time = TIMESTAMP 'epoch' + (se.ts / 1000) * INTERVAL '1 second'
+);
+""")
+
+# Only hours not loaded yet, the table has no duplicates to clean up
+time_hour_table_insert = ("""
+INSERT INTO time_hours
+SELECT DISTINCT
+       ts / 3600000 AS time_key,
+       TIMESTAMP 'epoch' + time_key * INTERVAL '1 hour' AS hour_start,
+       EXTRACT(HOUR FROM hour_start) AS hour,
+       EXTRACT(DAY FROM hour_start) AS day,
+       EXTRACT(WEEKS FROM hour_start) AS week,
+       EXTRACT(MONTH FROM hour_start) AS month,
+       EXTRACT(YEAR FROM hour_start) AS year,
+       to_char(hour_start, 'Day') AS weekday
+FROM staging_events
+WHERE ts IS NOT NULL{ts_filter}
+AND ts / 3600000 NOT IN (SELECT time_key FROM time_hours);
 """)
 
+
+##############################################################################
+# Rendering of the statements that depend on config and run parameters
+
+def _config_value(config, section, key):
+    # dwh.cfg keeps S3 paths and the role arn wrapped in single quotes
+    return config[section][key].strip().strip("'")
+
+
+def _epoch_ms(day):
+    return int((datetime(day.year, day.month, day.day) -
+                datetime(1970, 1, 1)).total_seconds() * 1000)
+
+
+def _check_range(start_date, end_date):
+    if (start_date is None) != (end_date is None):
+        raise ValueError("Both start_date and end_date must be given")
+    if start_date is not None and start_date > end_date:
+        raise ValueError(f"start_date {start_date} is after end_date "
+                         f"{end_date}")
+
+
+def log_data_prefixes(log_data, start_date=None, end_date=None,
+                      has_objects=None):
+    """
+    Lists the S3 prefixes holding the log files of a date range. Log files
+    are laid out as log_data/YYYY/MM/YYYY-MM-DD-events.json, months fully
+    inside the range are copied with a single month prefix. COPY fails on a
+    prefix without objects, so prefixes has_objects finds empty are left
+    out.
+    :param log_data: S3 path of the log_data directory
+    :param start_date: first day to load, None loads everything
+    :param end_date: last day to load (inclusive)
+    :param has_objects: function telling whether a prefix holds any object,
+    None keeps every prefix
+    :return: list of S3 prefixes
+    """
+    _check_range(start_date, end_date)
+    log_data = log_data.rstrip('/')
+    if start_date is None:
+        return [log_data]
+
+    prefixes = []
+    day = start_date
+    while day <= end_date:
+        month_start = day.replace(day=1)
+        next_month = (month_start + timedelta(days=32)).replace(day=1)
+        month_end = next_month - timedelta(days=1)
+        if day == month_start and month_end <= end_date:
+            prefixes.append(f"{log_data}/{day:%Y/%m}/")
+            day = next_month
+        else:
+            prefixes.append(f"{log_data}/{day:%Y/%m/%Y-%m-%d}")
+            day += timedelta(days=1)
+    if has_objects is not None:
+        prefixes = [prefix for prefix in prefixes if has_objects(prefix)]
+    return prefixes
+
+
+def build_copy_queries(config, start_date=None, end_date=None,
+                       has_objects=None):
+    """
+    Renders the COPY statements for the staging tables, followed by the
+    statements moving the rows into the keyed staging tables
+    :param config: parsed dwh.cfg
+    :param start_date: first day of log data to load, None loads everything
+    :param end_date: last day of log data to load (inclusive)
+    :param has_objects: function telling whether an S3 prefix holds any
+    object, passed on to log_data_prefixes
+    :return: list of COPY statements
+    """
+    iam_role = f"'{_config_value(config, 'IAM_ROLE', 'ARN')}'"
+    jsonpath = f"'{_config_value(config, 'S3', 'LOG_JSONPATH')}'"
+
+    queries = [
+        staging_events_copy.format(
+            source=prefix, iam_role=iam_role, jsonpath=jsonpath
+        )
+        for prefix in log_data_prefixes(
+            _config_value(config, 'S3', 'LOG_DATA'), start_date, end_date,
+            has_objects
+        )
+    ]
+    queries.append(staging_songs_copy.format(
+        source=_config_value(config, 'S3', 'SONG_DATA'), iam_role=iam_role
+    ))
+    return queries + staging_key_queries
+
+
+def build_insert_queries(start_date=None, end_date=None):
+    """
+    Renders the statements loading the star schema from the staging tables,
+    restricted to the events of a date range
+    :param start_date: first day of events to insert, None inserts all
+    :param end_date: last day of events to insert (inclusive)
+    :return: list of INSERT statements
+    """
+    _check_range(start_date, end_date)
+    if start_date is None:
+        filters = {'se.ts': '', 'ts': ''}
+    else:
+        low = _epoch_ms(start_date)
+        high = _epoch_ms(end_date + timedelta(days=1))
+        filters = {
+            'se.ts': f"\nAND se.ts >= {low} AND se.ts < {high}",
+            'ts': f"\nAND ts >= {low} AND ts < {high}"
+        }
+
+    return [
+        songplay_table_insert.format(ts_filter=filters['se.ts']),
+        user_table_insert.format(ts_filter=filters['ts']),
+        song_table_insert,
+        artist_table_insert,
+        time_table_insert.format(ts_filter=filters['ts']),
+        time_hour_table_insert.format(ts_filter=filters['ts'])
+    ]
+
+
 # QUERY LISTS
 create_table_queries = [
+    staging_events_load_table_create, staging_songs_load_table_create,
     staging_events_table_create, staging_songs_table_create,
     songplay_table_create, user_table_create, song_table_create,
-    artist_table_create, time_table_create
+    artist_table_create, time_table_create, time_hour_table_create
 ]
 drop_table_queries = [
     staging_events_table_drop, staging_songs_table_drop, songplay_table_drop,
-    user_table_drop, song_table_drop, artist_table_drop, time_table_drop
+    user_table_drop, song_table_drop, artist_table_drop, time_table_drop,
+    time_hour_table_drop,
+    staging_events_load_table_drop, staging_songs_load_table_drop
+]
+staging_key_queries = [
+    staging_events_keyed_insert, staging_songs_keyed_insert,
+    staging_events_load_truncate, staging_songs_load_truncate
 ]
-copy_table_queries = [staging_events_copy, staging_songs_copy]
-insert_table_queries = [songplay_table_insert, user_table_insert,
-                        song_table_insert, artist_table_insert,
-                        time_table_insert
-                        ]
+insert_table_queries = build_insert_queries()
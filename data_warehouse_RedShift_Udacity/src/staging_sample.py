@@ -0,0 +1,392 @@
+import os
+import glob
+import json
+import random
+import hashlib
+from datetime import datetime, timedelta
+
+##############################################################################
+# Column order of the staging tables as created in sql_queries.py. Redshift
+# folds identifiers to lower case, so the sampled rows use lower case keys.
+
+STAGING_EVENTS_COLUMNS = [
+    'artist', 'auth', 'firstname', 'gender', 'iteminsession', 'lastname',
+    'length', 'level', 'location', 'method', 'page', 'registration',
+    'sessionid', 'song', 'status', 'ts', 'useragent', 'userid', 'song_key'
+]
+
+STAGING_SONGS_COLUMNS = [
+    'num_songs', 'artist_id', 'artist_latitude', 'artist_longitude',
+    'artist_location', 'artist_name', 'song_id', 'title', 'duration', 'year',
+    'song_key'
+]
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def find_json_files(filepath):
+    """
+    Finds all json files under a directory
+    :param filepath: directory to search recursively
+    :return: sorted list of file paths
+    """
+    all_files = []
+    for root, dirs, files in os.walk(filepath):
+        all_files.extend(glob.glob(os.path.join(root, "*.json")))
+    return sorted(all_files)
+
+
+def _to_int(value):
+    """
+    Converts a json value to int the way COPY does, empty strings become NULL
+    :param value: raw json value
+    :return: int or None
+    """
+    if value is None or value == '':
+        return None
+    return int(value)
+
+
+def song_key(title, artist, fallback):
+    """
+    Python version of song_key_expression in sql_queries.py
+    :param title: song title
+    :param artist: artist name
+    :param fallback: text hashed when title or artist is missing
+    :return: md5 hex digest
+    """
+    if title is None or artist is None:
+        text = fallback
+    else:
+        text = f"{title.strip(' ').lower()}|{artist.strip(' ').lower()}"
+    return hashlib.md5(text.encode('utf8')).hexdigest()
+
+
+def _reservoir(rows, limit, seed):
+    """
+    Keeps a uniform random sample of at most limit rows from an iterable
+    :param rows: iterable of rows
+    :param limit: maximum number of rows to keep, None keeps everything
+    :param seed: seed for the random generator
+    :return: list of sampled rows
+    """
+    if limit is None:
+        return list(rows)
+
+    rng = random.Random(seed)
+    sample = []
+    for i, row in enumerate(rows):
+        if i < limit:
+            sample.append(row)
+        else:
+            j = rng.randint(0, i)
+            if j < limit:
+                sample[j] = row
+    return sample
+
+
+def _iter_events(filepath):
+    for file_path in find_json_files(filepath):
+        with open(file_path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = {k.lower(): v for k, v in json.loads(line).items()}
+                row = {col: record.get(col) for col in STAGING_EVENTS_COLUMNS}
+                for col in ('iteminsession', 'sessionid', 'status', 'userid'):
+                    row[col] = _to_int(row[col])
+                row['song_key'] = song_key(
+                    row['song'], row['artist'],
+                    f"event|{row['ts']}|{row['sessionid']}|"
+                    f"{row['iteminsession']}"
+                )
+                yield row
+
+
+def _iter_songs(filepath):
+    for file_path in find_json_files(filepath):
+        with open(file_path) as f:
+            record = json.load(f)
+        row = {col: record.get(col) for col in STAGING_SONGS_COLUMNS}
+        row['song_key'] = song_key(row['title'], row['artist_name'],
+                                   f"song|{row['song_id']}")
+        yield row
+
+
+def sample_staging_events(filepath, limit=None, seed=0):
+    """
+    Samples log files into rows shaped like staging_events
+    :param filepath: path to the log_data directory
+    :param limit: maximum number of rows, None reads everything
+    :param seed: seed for the sampling
+    :return: list of dicts keyed by staging_events column
+    """
+    return _reservoir(_iter_events(filepath), limit, seed)
+
+
+def sample_staging_songs(filepath, limit=None, seed=0):
+    """
+    Samples song files into rows shaped like staging_songs
+    :param filepath: path to the song_data directory
+    :param limit: maximum number of rows, None reads everything
+    :param seed: seed for the sampling
+    :return: list of dicts keyed by staging_songs column
+    """
+    return _reservoir(_iter_songs(filepath), limit, seed)
+
+
+def sample_staging_postgres(cur, table, limit=None):
+    """
+    Samples a staging table from a Postgres stand-in of the cluster
+    :param cur: cursor to the database
+    :param table: name of the staging table
+    :param limit: maximum number of rows, None reads everything
+    :return: list of dicts keyed by lower case column name
+    """
+    query = f"SELECT * FROM {table}"
+    if limit is not None:
+        query += f" ORDER BY random() LIMIT {int(limit)}"
+    cur.execute(query)
+    columns = [desc[0].lower() for desc in cur.description]
+    return [dict(zip(columns, row)) for row in cur.fetchall()]
+
+
+def synthetic_staging(num_events, num_songs=1000, num_users=500,
+                      match_ratio=0.8, seed=0, start=datetime(2018, 11, 1),
+                      days=30):
+    """
+    Generates staging rows shaped like the Sparkify logs and songs at any
+    scale. Song popularity is skewed, users play in sessions and events are
+    ordered by ts.
+    :param num_events: number of staging_events rows
+    :param num_songs: number of staging_songs rows
+    :param num_users: number of distinct users
+    :param match_ratio: share of NextSong events whose song and artist exist
+    in staging_songs
+    :param seed: seed for the random generator
+    :param start: timestamp of the first event
+    :param days: number of days the events are spread over
+    :return: tuple of (staging_events rows, staging_songs rows)
+    """
+    rng = random.Random(seed)
+    num_artists = max(num_songs // 3, 1)
+    locations = [f"City {i}, ST" for i in range(50)]
+    agents = [f"Mozilla/5.0 (Agent {i})" for i in range(40)]
+
+    songs = []
+    for i in range(num_songs):
+        artist = rng.randrange(num_artists)
+        located = rng.random() < 0.5
+        row = {
+            'num_songs': 1,
+            'artist_id': f"AR{artist:016d}",
+            'artist_latitude': rng.uniform(-60, 60) if located else None,
+            'artist_longitude': rng.uniform(-180, 180) if located else None,
+            'artist_location': rng.choice(locations) if located else '',
+            'artist_name': f"Artist {artist}",
+            'song_id': f"SO{i:016d}",
+            'title': f"Song {i}",
+            'duration': round(rng.uniform(90, 480), 5),
+            'year': rng.choice([0] + list(range(1960, 2011)))
+        }
+        row['song_key'] = song_key(row['title'], row['artist_name'],
+                                   f"song|{row['song_id']}")
+        songs.append(row)
+
+    users = [
+        {
+            'userid': i + 1,
+            'firstname': f"First{i}",
+            'lastname': f"Last{i}",
+            'gender': rng.choice('MF'),
+            'level': rng.choice(['free', 'paid']),
+            'location': rng.choice(locations),
+            'useragent': rng.choice(agents),
+            'registration': 1540000000000.0 + rng.randrange(10 ** 9)
+        }
+        for i in range(num_users)
+    ]
+
+    start_ms = int((start - EPOCH).total_seconds() * 1000)
+    span_ms = days * 24 * 3600 * 1000
+    sessions, next_session = {}, 1
+    events = []
+    for ts in sorted(start_ms + rng.randrange(span_ms)
+                     for _ in range(num_events)):
+        user = users[min(int(rng.paretovariate(1.2)) - 1, num_users - 1)
+                     if rng.random() < 0.5 else rng.randrange(num_users)]
+        session = sessions.get(user['userid'])
+        if session is None or rng.random() < 0.05:
+            session = sessions[user['userid']] = [next_session, 0]
+            next_session += 1
+
+        page = 'NextSong' if rng.random() < 0.8 else rng.choice(
+            ['Home', 'Logout', 'Settings', 'Help', 'Upgrade'])
+        song = artist = length = None
+        if page == 'NextSong':
+            if rng.random() < match_ratio:
+                played = songs[min(int(rng.paretovariate(1.1)) - 1,
+                                   num_songs - 1)]
+                song, artist = played['title'], played['artist_name']
+                length = played['duration']
+            else:
+                song = f"Unknown song {rng.randrange(10 ** 6)}"
+                artist = f"Unknown artist {rng.randrange(10 ** 5)}"
+                length = round(rng.uniform(90, 480), 5)
+
+        row = {
+            'artist': artist,
+            'auth': 'Logged In',
+            'firstname': user['firstname'],
+            'gender': user['gender'],
+            'iteminsession': session[1],
+            'lastname': user['lastname'],
+            'length': length,
+            'level': user['level'],
+            'location': user['location'],
+            'method': 'PUT' if page == 'NextSong' else 'GET',
+            'page': page,
+            'registration': user['registration'],
+            'sessionid': session[0],
+            'song': song,
+            'status': 200,
+            'ts': ts,
+            'useragent': user['useragent'],
+            'userid': user['userid']
+        }
+        row['song_key'] = song_key(
+            song, artist, f"event|{ts}|{session[0]}|{session[1]}"
+        )
+        session[1] += 1
+        events.append(row)
+
+    return events, songs
+
+
+##############################################################################
+# Python equivalents of insert_table_queries, used to estimate the final
+# tables from a staging sample without a cluster.
+
+def _start_time(ts):
+    # TIMESTAMP 'epoch' + (ts / 1000) * INTERVAL '1 second', integer division
+    return EPOCH + timedelta(seconds=ts // 1000)
+
+
+def _distinct(rows):
+    seen = set()
+    result = []
+    for row in rows:
+        key = tuple(row.values())
+        if key not in seen:
+            seen.add(key)
+            result.append(row)
+    return result
+
+
+def derive_final_tables(staging_events, staging_songs):
+    """
+    Builds the star schema rows the insert queries would produce
+    :param staging_events: rows of staging_events
+    :param staging_songs: rows of staging_songs
+    :return: dict of table name to list of row dicts
+    """
+    songs_by_key = {}
+    for song in staging_songs:
+        songs_by_key.setdefault(
+            (song['title'], song['artist_name']), []
+        ).append(song)
+
+    next_songs = [e for e in staging_events if e['page'] == 'NextSong']
+
+    songplays = []
+    for event in next_songs:
+        for song in songs_by_key.get((event['song'], event['artist']), []):
+            songplays.append({
+                'start_time': _start_time(event['ts']),
+                'time_key': event['ts'] // 3600000,
+                'user_id': event['userid'],
+                'level': event['level'],
+                'song_id': song['song_id'],
+                'artist_id': song['artist_id'],
+                'session_id': event['sessionid'],
+                'item_in_session': event['iteminsession'],
+                'location': event['location'],
+                'user_agent': event['useragent']
+            })
+
+    users = [
+        {
+            'userid': e['userid'],
+            'firsname': e['firstname'],
+            'lastname': e['lastname'],
+            'gender': e['gender'],
+            'level': e['level']
+        }
+        for e in next_songs if e['userid'] is not None
+    ]
+
+    songs = [
+        {
+            'song_id': s['song_id'],
+            'title': s['title'],
+            'artist_id': s['artist_id'],
+            'year': s['year'],
+            'duration': s['duration']
+        }
+        for s in staging_songs if s['song_id'] is not None
+    ]
+
+    artists = [
+        {
+            'artist_id': s['artist_id'],
+            'name': s['artist_name'],
+            'location': s['artist_location'],
+            'latitude': s['artist_latitude'],
+            'longitude': s['artist_longitude']
+        }
+        for s in staging_songs
+    ]
+
+    time = []
+    for event in staging_events:
+        if event['ts'] is None:
+            continue
+        start_time = _start_time(event['ts'])
+        time.append({
+            'start_time': start_time,
+            'hour': start_time.hour,
+            'day': start_time.day,
+            'week': start_time.isocalendar()[1],
+            'month': start_time.month,
+            'year': start_time.year,
+            'weekday': start_time.strftime('%A').ljust(9)
+        })
+
+    time_hours = []
+    for event in staging_events:
+        if event['ts'] is None:
+            continue
+        hour_start = EPOCH + timedelta(hours=event['ts'] // 3600000)
+        time_hours.append({
+            'time_key': event['ts'] // 3600000,
+            'hour_start': hour_start,
+            'hour': hour_start.hour,
+            'day': hour_start.day,
+            'week': hour_start.isocalendar()[1],
+            'month': hour_start.month,
+            'year': hour_start.year,
+            'weekday': hour_start.strftime('%A').ljust(9)
+        })
+
+    return {
+        'staging_events_load': staging_events,
+        'staging_songs_load': staging_songs,
+        'staging_events': staging_events,
+        'staging_songs': staging_songs,
+        'songplays': _distinct(songplays),
+        'users': _distinct(users),
+        'songs': _distinct(songs),
+        'artists': _distinct(artists),
+        'time': _distinct(time),
+        'time_hours': _distinct(time_hours)
+    }
@@ -0,0 +1,283 @@
+import os
+import re
+import json
+import time
+import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+
+##############################################################################
+# Transactional, timed statement runner shared by create_tables.py and
+# etl.py. Statements are grouped into named steps, every step runs in one
+# transaction with a statement_timeout set before each statement. Transient
+# failures are retried with exponential backoff and the steps that committed
+# are checkpointed, so a failed run picks up after the last committed step.
+# Redshift commits implicitly on TRUNCATE (and does not allow VACUUM inside
+# a transaction block), such statements belong in a step of their own.
+
+DEFAULT_SETTINGS = {
+    # statement_timeout for every statement, 0 disables it
+    'STATEMENT_TIMEOUT_MS': 0,
+    # statement_timeout for COPY, which can run much longer than the rest
+    'COPY_TIMEOUT_MS': 0,
+    # how often a failed step is retried
+    'RETRIES': 3,
+    # first retry waits this long, every further retry twice as long
+    'BACKOFF_SECONDS': 2.0
+}
+
+DEFAULT_CHECKPOINT_FILE = 'runner_state.json'
+
+IDEMPOTENT_STATEMENT = re.compile(
+    r'^\s*(DROP\s+\w+\s+IF\s+EXISTS|CREATE\s+TABLE\s+IF\s+NOT\s+EXISTS'
+    r'|TRUNCATE|ANALYZE|VACUUM|SET\b)', re.I
+)
+
+
+def statement_label(sql):
+    """
+    Short name of a statement for the timing report
+    :param sql: sql statement
+    :return: label such as 'INSERT INTO songplays'
+    """
+    match = re.search(
+        r'(CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?\w+|INSERT\s+INTO\s+\w+'
+        r'|COPY\s+\w+|TRUNCATE\s+\w+|DROP\s+TABLE\s+(?:IF\s+EXISTS\s+)?\w+)',
+        sql, re.I
+    )
+    if not match:
+        return sql.strip().splitlines()[0]
+    words = re.sub(r'\s+IF\s+(?:NOT\s+)?EXISTS', '', match.group(1),
+                   flags=re.I).split()
+    return ' '.join([w.upper() for w in words[:-1]] + [words[-1].lower()])
+
+
+def is_idempotent(statements):
+    """
+    A step is idempotent when running it twice leaves the same result as
+    running it once, which holds for DROP ... IF EXISTS, CREATE TABLE IF
+    NOT EXISTS, TRUNCATE, ANALYZE and VACUUM
+    :param statements: sql statements of the step
+    :return: bool
+    """
+    return all(IDEMPOTENT_STATEMENT.match(sql) for sql in statements)
+
+
+def read_settings(config):
+    """
+    Reads the RUNNER section of dwh.cfg, falling back to DEFAULT_SETTINGS
+    :param config: parsed dwh.cfg
+    :return: dict of setting name to value
+    """
+    settings = dict(DEFAULT_SETTINGS)
+    if config.has_section('RUNNER'):
+        for key, default in settings.items():
+            if config.has_option('RUNNER', key):
+                settings[key] = type(default)(config.get('RUNNER', key))
+    return settings
+
+
+def statement_timeout(sql, settings):
+    """
+    :param sql: sql statement
+    :param settings: output of read_settings
+    :return: statement_timeout in milliseconds for the statement
+    """
+    if sql.lstrip().upper().startswith('COPY') and \
+            settings['COPY_TIMEOUT_MS']:
+        return settings['COPY_TIMEOUT_MS']
+    return settings['STATEMENT_TIMEOUT_MS']
+
+
+def is_transient(error):
+    """
+    Errors worth retrying: serialization conflicts, deadlocks and lost
+    connections. A cancelled statement (statement_timeout) is not, it would
+    time out again.
+    :param error: exception raised by psycopg2
+    :return: bool
+    """
+    if isinstance(error, psycopg2.extensions.QueryCanceledError):
+        return False
+    if isinstance(error, (psycopg2.errors.SerializationFailure,
+                          psycopg2.errors.DeadlockDetected,
+                          psycopg2.OperationalError,
+                          psycopg2.InterfaceError)):
+        return True
+    # Redshift reports its serializable isolation violation as error 1023
+    return 'Serializable isolation violation' in str(error)
+
+
+def load_checkpoint(path=DEFAULT_CHECKPOINT_FILE):
+    """
+    Loads the committed steps of unfinished runs
+    :param path: json file holding the checkpoints
+    :return: dict of run name to list of committed step names
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_checkpoint(checkpoint, path=DEFAULT_CHECKPOINT_FILE):
+    """
+    Saves the checkpoints, dropping the file once no run is unfinished
+    :param checkpoint: dict of run name to list of committed step names
+    :param path: json file holding the checkpoints
+    :return:
+    """
+    if not checkpoint:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    with open(path, 'w') as f:
+        json.dump(checkpoint, f, indent=2)
+
+
+##############################################################################
+class StatementRunner:
+    """
+    Runs named steps of sql statements, one transaction per step, and times
+    every statement
+    """
+
+    def __init__(self, connect, run_name, settings=None, resume=True,
+                 checkpoint_path=DEFAULT_CHECKPOINT_FILE):
+        """
+        :param connect: function returning a new psycopg2 connection, called
+        again after the connection was lost
+        :param run_name: key of this run in the checkpoint file, the same
+        name resumes an unfinished run
+        :param settings: output of read_settings, None uses the defaults
+        :param resume: skip the steps an unfinished run already committed
+        :param checkpoint_path: json file holding the checkpoints
+        """
+        self.connect = connect
+        self.run_name = run_name
+        self.settings = dict(DEFAULT_SETTINGS, **(settings or {}))
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint = load_checkpoint(checkpoint_path)
+        if not resume:
+            self.checkpoint.pop(run_name, None)
+        self.completed = self.checkpoint.setdefault(run_name, [])
+        self.timings = []
+        self.conn = None
+        self.cur = None
+
+    def ensure_connection(self):
+        """
+        Opens a connection when there is none or the last one was lost
+        :return:
+        """
+        if self.conn is None or self.conn.closed:
+            self.conn = self.connect()
+            self.cur = self.conn.cursor()
+
+    def execute(self, sql):
+        """
+        Executes one statement on the runner's cursor
+        :param sql: sql statement
+        :return:
+        """
+        self.cur.execute(sql)
+
+    def rollback(self):
+        """
+        Rolls back the open transaction, dropping a connection that is no
+        longer usable
+        :return:
+        """
+        try:
+            self.conn.rollback()
+        except psycopg2.Error:
+            self.conn.close()
+
+    def run_step(self, name, statements, idempotent=None, on_statement=None):
+        """
+        Runs the statements of a step in one transaction. Transient errors
+        are retried with exponential backoff. An error raised by the COMMIT
+        itself leaves it unknown whether the step committed, then only
+        idempotent steps are retried.
+        :param name: step name, unique within the run
+        :param statements: list of sql statements
+        :param idempotent: whether the step may run twice, None detects it
+        from the statements
+        :param on_statement: function of (cur, sql) called after every
+        statement, e.g. to count the rows it changed
+        :return: list of on_statement results, None if the step was skipped
+        because an earlier run committed it
+        """
+        if name in self.completed:
+            print(f"skipping {name}, committed by an earlier run")
+            return None
+        if idempotent is None:
+            idempotent = is_idempotent(statements)
+
+        for attempt in range(self.settings['RETRIES'] + 1):
+            timings, results, committing = [], [], False
+            try:
+                self.ensure_connection()
+                for sql in statements:
+                    timeout = statement_timeout(sql, self.settings)
+                    self.execute(f"SET statement_timeout TO {int(timeout)};")
+                    start = time.perf_counter()
+                    self.execute(sql)
+                    seconds = time.perf_counter() - start
+                    result = on_statement(self.cur, sql) \
+                        if on_statement else None
+                    rows = self.cur.rowcount if result is None else result
+                    timings.append({'step': name,
+                                    'label': statement_label(sql),
+                                    'seconds': seconds, 'rows': rows,
+                                    'attempt': attempt + 1})
+                    results.append(result)
+                committing = True
+                start = time.perf_counter()
+                self.conn.commit()
+                timings.append({'step': name, 'label': 'COMMIT',
+                                'seconds': time.perf_counter() - start,
+                                'rows': -1, 'attempt': attempt + 1})
+                break
+            except psycopg2.Error as e:
+                if self.conn is not None and not self.conn.closed:
+                    self.rollback()
+                if not is_transient(e) or \
+                        attempt == self.settings['RETRIES'] or \
+                        (committing and not idempotent):
+                    print(f"step {name} failed: {e}".rstrip())
+                    raise
+                wait = self.settings['BACKOFF_SECONDS'] * 2 ** attempt
+                print(f"step {name} failed ({type(e).__name__}), "
+                      f"retrying in {wait:.1f}s")
+                time.sleep(wait)
+
+        self.timings.extend(timings)
+        self.completed.append(name)
+        save_checkpoint(self.checkpoint, self.checkpoint_path)
+        return results
+
+    def finish(self):
+        """
+        Marks the run as complete, so the next run starts from the first
+        step, and closes the connection
+        :return:
+        """
+        self.checkpoint.pop(self.run_name, None)
+        save_checkpoint(self.checkpoint, self.checkpoint_path)
+        if self.conn is not None and not self.conn.closed:
+            self.conn.close()
+
+    def print_report(self):
+        """
+        Prints the time and rows of every statement of this run
+        :return:
+        """
+        print(f"{'step':<28} {'statement':<34} {'rows':>10} {'seconds':>10}"
+              f" {'try':>4}")
+        for t in self.timings:
+            rows = '' if t['rows'] is None or t['rows'] < 0 else t['rows']
+            print(f"{t['step'][:28]:<28} {t['label'][:34]:<34} {rows:>10}"
+                  f" {t['seconds']:>10.3f} {t['attempt']:>4}")
+        print(f"{'total':<28} {'':<34} {'':>10} "
+              f"{sum(t['seconds'] for t in self.timings):>10.3f}")
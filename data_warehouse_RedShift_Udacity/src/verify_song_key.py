@@ -0,0 +1,103 @@
+import argparse
+import psycopg2
+from sql_queries import create_table_queries, drop_table_queries
+from sql_queries import staging_key_queries, insert_table_queries
+from staging_sample import sample_staging_events, sample_staging_songs
+from staging_sample import synthetic_staging
+from local_redshift import to_postgres, load_rows
+
+##############################################################################
+# The songplays join before the hashed song_key was added. The new join must
+# return exactly the same rows.
+
+legacy_songplay_select = ("""
+SELECT DISTINCT
+       TIMESTAMP 'epoch' + (se.ts / 1000) * INTERVAL '1 second' as start_time,
+                se.ts / 3600000 AS time_key,
+                se.userId,
+                se.level,
+                ss.song_id,
+                ss.artist_id,
+                se.sessionId,
+                se.itemInSession,
+                se.location,
+                se.userAgent
+FROM staging_songs ss
+INNER JOIN staging_events se
+ON (ss.title = se.song AND se.artist = ss.artist_name)
+AND se.page = 'NextSong'
+""")
+
+
+def select_part(insert_query):
+    """
+    Strips the INSERT INTO part of an INSERT ... SELECT statement
+    :param insert_query: INSERT statement
+    :return: the SELECT statement without trailing semicolon
+    """
+    start = insert_query.upper().index('SELECT')
+    return insert_query[start:].strip().rstrip(';')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Loads the sample data into the staging tables on a "
+                    "local Postgres and checks the song_key join returns "
+                    "the same songplays as the legacy title/artist join."
+    )
+    parser.add_argument("--dsn", default="host=127.0.0.1 dbname=studentdb "
+                                         "user=student password=student",
+                        help="Local Postgres to run on.")
+    parser.add_argument("--log-data", default="../../data_modeling_with_"
+                        "postgres_Udacity/data/log_data",
+                        help="Directory with log json files.")
+    parser.add_argument("--song-data", default="../../data_modeling_with_"
+                        "postgres_Udacity/data/song_data",
+                        help="Directory with song json files.")
+    parser.add_argument("--synthetic-events", type=int, default=None,
+                        help="Check on this many synthetic events instead "
+                             "of the json files.")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(args.dsn)
+    cur = conn.cursor()
+
+    for query in drop_table_queries + create_table_queries:
+        cur.execute(to_postgres(query))
+
+    if args.synthetic_events:
+        events, songs = synthetic_staging(args.synthetic_events)
+    else:
+        events = sample_staging_events(args.log_data)
+        songs = sample_staging_songs(args.song_data)
+    load_rows(cur, 'staging_events_load', events)
+    load_rows(cur, 'staging_songs_load', songs)
+    for query in staging_key_queries:
+        cur.execute(to_postgres(query))
+    conn.commit()
+
+    keyed_select = select_part(insert_table_queries[0])
+    cur.execute(f"SELECT count(*) FROM ({legacy_songplay_select}) legacy")
+    legacy_rows = cur.fetchone()[0]
+    cur.execute(f"SELECT count(*) FROM ({keyed_select}) keyed")
+    keyed_rows = cur.fetchone()[0]
+    cur.execute(f"""
+        SELECT count(*) FROM (
+            (({keyed_select}) EXCEPT ALL ({legacy_songplay_select}))
+            UNION ALL
+            (({legacy_songplay_select}) EXCEPT ALL ({keyed_select}))
+        ) difference
+    """)
+    different_rows = cur.fetchone()[0]
+
+    conn.close()
+
+    print(f"legacy join: {legacy_rows} rows, song_key join: {keyed_rows} "
+          f"rows, rows in only one result: {different_rows}")
+    if different_rows or legacy_rows != keyed_rows:
+        raise SystemExit("song_key join is NOT equivalent to the legacy join")
+    print("song_key join is equivalent to the legacy join")
+
+
+if __name__ == "__main__":
+    main()